@@ -1,7 +1,24 @@
+import asyncio
 from fastapi import FastAPI
-from app.routes import whatsapp_routes, webhook_routes
+from app.routes import whatsapp_routes, webhook_routes, admin_routes, documentos_routes
+from app.services.facturacion_service import ciclo_sincronizacion_indice
+from app.services.whatsapp_service import reanudar_emisiones_masivas
+from app.utils import indice_facturas
+from app.utils.catalogos_sat import precargar_catalogos
+from app.utils.archivos_temp import ciclo_barrido
 
 app = FastAPI()
 
 app.include_router(whatsapp_routes.router)
 app.include_router(webhook_routes.router)
+app.include_router(admin_routes.router)
+app.include_router(documentos_routes.router)
+
+@app.on_event("startup")
+async def iniciar_tareas_de_fondo():
+    # Los catálogos del SAT se abren en segundo plano: el arranque no los espera
+    asyncio.create_task(asyncio.to_thread(precargar_catalogos))
+    if indice_facturas.INDICE_ACTIVO:
+        asyncio.create_task(ciclo_sincronizacion_indice())
+    asyncio.create_task(reanudar_emisiones_masivas())
+    asyncio.create_task(ciclo_barrido())
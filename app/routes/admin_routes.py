@@ -0,0 +1,87 @@
+import os
+from datetime import datetime
+import asyncio
+from fastapi import APIRouter, Header, HTTPException, Query
+from app.services.facturacion_service import sincronizar_indice_facturas
+from app.utils import indice_facturas
+from app.utils import archivos_temp
+from app.utils.redis_client import (
+    obtener_metricas_llm,
+    obtener_uso_usuario,
+    obtener_ranking_uso,
+    obtener_uso_funciones,
+)
+
+router = APIRouter(prefix="/admin")
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def _validar_admin(x_admin_token: str | None) -> None:
+    # Sin ADMIN_TOKEN configurado el panel queda cerrado
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="No autorizado")
+
+def _hoy() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+@router.get("/metricas")
+async def metricas_llm(x_admin_token: str | None = Header(None)):
+    """
+    Latencia (media, p50, p95), llamadas, errores y tokens por etapa del pipeline,
+    más el uso acumulado por función.
+    """
+    _validar_admin(x_admin_token)
+    return {"etapas": obtener_metricas_llm(), "funciones": obtener_uso_funciones()}
+
+@router.get("/uso")
+async def uso_por_usuario(
+    user_id: str,
+    fecha: str | None = Query(None, description="YYYY-MM-DD, default hoy"),
+    x_admin_token: str | None = Header(None)
+):
+    """
+    Tokens consumidos por un usuario en un día, por etapa y por función.
+    """
+    _validar_admin(x_admin_token)
+    fecha = fecha or _hoy()
+    return {"user_id": user_id, "fecha": fecha, "uso": obtener_uso_usuario(user_id, fecha)}
+
+@router.get("/uso/top")
+async def usuarios_mas_costosos(
+    fecha: str | None = Query(None, description="YYYY-MM-DD, default hoy"),
+    limite: int = Query(10, ge=1, le=100),
+    x_admin_token: str | None = Header(None)
+):
+    """
+    Usuarios con más tokens consumidos en el día.
+    """
+    _validar_admin(x_admin_token)
+    fecha = fecha or _hoy()
+    return {"fecha": fecha, "usuarios": obtener_ranking_uso(fecha, limite)}
+
+@router.post("/indice/sincronizar")
+async def sincronizar_indice(
+    completo: bool = Query(False, description="Ignora el estado y vuelve a copiar todo"),
+    x_admin_token: str | None = Header(None)
+):
+    """
+    Sincroniza ahora el índice local de facturas (emitidas y recibidas).
+    """
+    _validar_admin(x_admin_token)
+    if not indice_facturas.INDICE_ACTIVO:
+        raise HTTPException(status_code=409, detail="INDICE_FACTURAS_URL no está configurado")
+    return {"guardadas": await asyncio.to_thread(sincronizar_indice_facturas, completo=completo)}
+
+@router.get("/archivos_temp")
+async def metricas_archivos_temp(
+    barrer: bool = Query(False, description="Barre antes de medir"),
+    x_admin_token: str | None = Header(None)
+):
+    """
+    Archivos y bytes en archivos_temp, cuota, archivos en uso y lo borrado
+    por TTL, por huérfano y por cuota desde que arrancó el proceso.
+    """
+    _validar_admin(x_admin_token)
+    if barrer:
+        await asyncio.to_thread(archivos_temp.barrer)
+    return archivos_temp.metricas()
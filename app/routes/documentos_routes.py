@@ -0,0 +1,85 @@
+import os
+import base64
+import hashlib
+import tempfile
+import mimetypes
+from fastapi import APIRouter, Request, HTTPException
+from app.utils.cfdi_xml import es_cfdi_xml, extraer_cfdi
+from app.utils.almacen_archivos import leer_trozos, leer_inicio, TAMANO_TROZO
+
+router = APIRouter(prefix="/documentos-local")
+
+# Sustituto local del servicio de documentos para desarrollo y pruebas:
+#   DOCUMENTOS_API_LOCAL=true
+#   DOCUMENTS_API_URL=http://localhost:8080/documentos-local/process-file
+# Acepta los tres formatos de documentos_service (base64, multipart y raw).
+# Los CFDI se leen igual que en el orquestador; de lo demás sólo devuelve
+# los metadatos del archivo recibido.
+DOCUMENTOS_API_LOCAL = os.getenv("DOCUMENTOS_API_LOCAL", "false").lower() == "true"
+
+
+async def _recibir(request: Request, destino) -> tuple:
+    """Escribe el archivo del cuerpo en `destino`; devuelve (protocolo, nombre)."""
+    tipo = request.headers.get("content-type", "")
+    if tipo.startswith("multipart/form-data"):
+        formulario = await request.form()
+        archivo = formulario.get("file")
+        if archivo is None or not hasattr(archivo, "read"):
+            raise HTTPException(status_code=400, detail="Falta el campo 'file'")
+        while True:
+            trozo = await archivo.read(TAMANO_TROZO)
+            if not trozo:
+                break
+            destino.write(trozo)
+        return "multipart", archivo.filename or "archivo"
+
+    if tipo.startswith("application/json"):
+        datos = await request.json()
+        if not isinstance(datos, dict) or not isinstance(datos.get("base64"), str):
+            raise HTTPException(status_code=400, detail="Falta 'base64'")
+        destino.write(base64.b64decode(datos["base64"]))
+        return "base64", datos.get("filename") or "archivo"
+
+    async for trozo in request.stream():
+        destino.write(trozo)
+    return "raw", request.headers.get("x-filename") or "archivo"
+
+
+@router.post("/process-file")
+async def procesar_archivo_local(request: Request):
+    if not DOCUMENTOS_API_LOCAL:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    fd, ruta = tempfile.mkstemp(prefix="documento-")
+    try:
+        with os.fdopen(fd, "wb") as destino:
+            protocolo, nombre = await _recibir(request, destino)
+
+        h = hashlib.sha256()
+        tamano = 0
+        for trozo in leer_trozos(ruta):
+            h.update(trozo)
+            tamano += len(trozo)
+        sha256 = h.hexdigest()
+        esperado = request.headers.get("x-content-sha256")
+        if esperado and esperado.lower() != sha256:
+            raise HTTPException(status_code=400, detail="X-Content-Sha256 no coincide con el contenido")
+
+        resultado = {
+            "origen": "documentos-local",
+            "protocolo": protocolo,
+            "archivo": nombre,
+            "tipo_mime": mimetypes.guess_type(nombre)[0] or "application/octet-stream",
+            "bytes": tamano,
+            "sha256": sha256,
+        }
+        if es_cfdi_xml(leer_inicio(ruta)):
+            try:
+                with open(ruta, "rb") as f:
+                    resultado.update(extraer_cfdi(f))
+                resultado["origen"] = "documentos-local"
+            except ValueError as e:
+                resultado["error"] = str(e)
+        return resultado
+    finally:
+        os.remove(ruta)
@@ -1,27 +1,68 @@
-from fastapi import APIRouter, Request, Header
-from app.services.whatsapp_service import (recibir_mensaje_texto, recibir_archivo)
-import json
+import os
+from fastapi import APIRouter, Request, Header, HTTPException
+from app.services.whatsapp_service import (recibir_mensaje_texto, recibir_archivo, entrega_repetida)
+from app.utils.almacen_archivos import guardar_stream, ArchivoDemasiadoGrande
 
 router = APIRouter()
 
+# Tamaños máximos del cuerpo: se revisan contra Content-Length antes de leer
+# y otra vez mientras llega (el header puede faltar o mentir)
+WEBHOOK_MAX_BYTES_TEXTO = int(os.getenv("WEBHOOK_MAX_BYTES_TEXTO", str(64 * 1024)))
+WEBHOOK_MAX_BYTES_ARCHIVO = int(os.getenv("WEBHOOK_MAX_BYTES_ARCHIVO", str(25 * 1024 * 1024)))
+
+def _revisar_longitud(content_length: str | None, maximo: int) -> None:
+    try:
+        longitud = int(content_length) if content_length else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Length inválido")
+    if longitud is not None and longitud > maximo:
+        raise HTTPException(status_code=413, detail=f"El cuerpo pasa del máximo de {maximo} bytes")
+
 @router.post("/webhook/orquestador")
 async def webhook_orquestador(
     request: Request,
     x_from: str = Header(...),
     x_filename: str | None = Header(None),
-    content_type: str | None = Header(None)
+    content_type: str | None = Header(None),
+    content_length: str | None = Header(None),
+    x_message_id: str | None = Header(None),
+    x_message_timestamp: str | None = Header(None)
 ):
     """
     Webhook que recibe mensajes de WhatsApp y los encola en Redis para que
-    el worker los procese en orden (FIFO).
+    el worker los procese en orden (FIFO). Los archivos se escriben a disco
+    por trozos y a la cola sólo va su referencia.
+
+    Los reintentos del proveedor (mismo X-Message-Id o, sin él y con
+    WEBHOOK_DEDUP_POR_CONTENIDO, mismo contenido y X-Message-Timestamp en una
+    ventana corta) se confirman sin volver a encolarse.
     """
     if content_type and content_type.startswith("text/plain"):
-        texto_usuario = (await request.body()).decode('utf-8')
-        await recibir_mensaje_texto(x_from, texto_usuario)
+        _revisar_longitud(content_length, WEBHOOK_MAX_BYTES_TEXTO)
+        cuerpo = bytearray()
+        async for trozo in request.stream():
+            cuerpo += trozo
+            if len(cuerpo) > WEBHOOK_MAX_BYTES_TEXTO:
+                raise HTTPException(status_code=413, detail=f"El texto pasa del máximo de {WEBHOOK_MAX_BYTES_TEXTO} bytes")
+        texto_usuario = cuerpo.decode('utf-8')
+        resultado = await recibir_mensaje_texto(x_from, texto_usuario, id_mensaje=x_message_id,
+                                               marca_tiempo=x_message_timestamp)
     else:
-        file_bytes = await request.body()
+        # Un archivo reenviado con el mismo id no se vuelve a leer ni a escribir
+        if entrega_repetida(x_from, x_message_id):
+            return {"status": "duplicate", "message": "Mensaje ya recibido"}
+        _revisar_longitud(content_length, WEBHOOK_MAX_BYTES_ARCHIVO)
         filename = x_filename or "archivo_desconocido"
-        await recibir_archivo(x_from, filename, file_bytes)
+        try:
+            guardado = await guardar_stream(filename, request.stream(), WEBHOOK_MAX_BYTES_ARCHIVO)
+        except ArchivoDemasiadoGrande as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        resultado = await recibir_archivo(x_from, filename, guardado["ruta"], sha256=guardado["sha256"],
+                                          tamano=guardado["bytes"], id_mensaje=x_message_id,
+                                          marca_tiempo=x_message_timestamp)
+
+    if resultado.get("status") == "duplicate":
+        return {"status": "duplicate", "message": "Mensaje ya recibido"}
 
     # Respondemos rápido al proveedor de WhatsApp (no bloqueamos la request)
     return {"status": "accepted", "message": "Mensaje encolado"}
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+from app.services.facturacion_service import consultar_facturas, lista_de_facturas
+from app.utils.redis_client import obtener_resultado
+
+load_dotenv()
+
+# ==========================================================
+#              ANALÍTICA LOCAL DE FACTURAS
+# ==========================================================
+# Preguntas agregadas ("¿cuánto facturé en julio?", "top 5 clientes") se
+# resuelven aquí con columnas NumPy en lugar de pasarle al LLM el JSON crudo
+# para que sume. Al historial sólo llega la tabla resultante.
+
+ANALITICA_MAX_FILAS = int(os.getenv("ANALITICA_MAX_FILAS", "20"))
+
+AGRUPACIONES = ("ninguno", "rfc", "mes", "dia", "status")
+
+
+def _valor(registro: Dict[str, Any], *nombres: str) -> Any:
+    for nombre in nombres:
+        for llave in (nombre, nombre.lower()):
+            if registro.get(llave) not in (None, ""):
+                return registro[llave]
+    return None
+
+
+def _numero(valor: Any) -> float:
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def cargar_columnas(facturas: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """
+    Pasa los registros de Facturama a columnas: rfc, nombre, fecha (ISO),
+    status, subtotal, total e impuestos (total - subtotal + descuento).
+    """
+    registros = [f for f in facturas if isinstance(f, dict)]
+    rfc = np.array([str(_valor(f, "Rfc") or "").upper() for f in registros], dtype=object)
+    nombre = np.array([_valor(f, "TaxName", "Name") or "" for f in registros], dtype=object)
+    fecha = np.array([str(_valor(f, "Date") or "")[:10] for f in registros], dtype=object)
+    status = np.array([str(_valor(f, "Status") or "").lower() for f in registros], dtype=object)
+    total = np.array([_numero(_valor(f, "Total")) for f in registros], dtype=float)
+    subtotal = np.array([_numero(_valor(f, "Subtotal", "SubTotal")) for f in registros], dtype=float)
+    descuento = np.array([_numero(_valor(f, "Discount")) for f in registros], dtype=float)
+    impuestos = total - subtotal + np.nan_to_num(descuento)
+    return {
+        "rfc": rfc, "nombre": nombre, "fecha": fecha, "status": status,
+        "subtotal": subtotal, "total": total, "impuestos": impuestos,
+    }
+
+
+def _llaves(columnas: Dict[str, np.ndarray], agrupar_por: str) -> np.ndarray:
+    if agrupar_por == "rfc":
+        return columnas["rfc"]
+    if agrupar_por == "mes":
+        return np.array([f[:7] for f in columnas["fecha"]], dtype=object)
+    if agrupar_por == "dia":
+        return columnas["fecha"]
+    if agrupar_por == "status":
+        return columnas["status"]
+    return np.full(len(columnas["total"]), "total", dtype=object)
+
+
+def _suma(inverso: np.ndarray, valores: np.ndarray, grupos: int) -> np.ndarray:
+    """
+    Suma por grupo. Si a algún registro del grupo le falta el dato, el grupo
+    queda en NaN: una suma parcial no cuadraría con el total.
+    """
+    faltantes = np.isnan(valores)
+    sumas = np.bincount(inverso, weights=np.where(faltantes, 0.0, valores), minlength=grupos)
+    incompletos = np.bincount(inverso, weights=faltantes.astype(float), minlength=grupos)
+    return np.where(incompletos > 0, np.nan, sumas)
+
+
+def _redondear(valor: float) -> Optional[float]:
+    return None if np.isnan(valor) else round(float(valor), 2)
+
+
+def agregar(columnas: Dict[str, np.ndarray], agrupar_por: str = "ninguno", top: Optional[int] = None,
+            orden: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Agrupa y suma (facturas, subtotal, impuestos, total). Ordena por total,
+    de mayor a menor, o por fecha ascendente si se agrupa por mes/día, y
+    recorta a `top` filas.
+    """
+    n = len(columnas["total"])
+    if n == 0:
+        return {"agrupado_por": agrupar_por, "grupos": 0, "filas": [], "totales": {"facturas": 0, "total": 0.0}}
+
+    llaves, inverso = np.unique(_llaves(columnas, agrupar_por).astype(str), return_inverse=True)
+    grupos = len(llaves)
+    facturas = np.bincount(inverso, minlength=grupos)
+    sumas = {c: _suma(inverso, columnas[c], grupos) for c in ("subtotal", "impuestos", "total")}
+
+    por_fecha = agrupar_por in ("mes", "dia")
+    if por_fecha:
+        indices = np.argsort(llaves)
+    else:
+        indices = np.argsort(np.nan_to_num(sumas["total"]), kind="stable")
+    if (orden or ("asc" if por_fecha else "desc")) == "desc":
+        indices = indices[::-1]
+    indices = indices[:min(top or ANALITICA_MAX_FILAS, ANALITICA_MAX_FILAS)]
+
+    # Razón social del primer registro de cada RFC
+    nombres = {}
+    if agrupar_por == "rfc":
+        _, primeros = np.unique(inverso, return_index=True)
+        nombres = {i: columnas["nombre"][p] for i, p in enumerate(primeros)}
+
+    filas = []
+    for i in indices:
+        fila = {"clave": str(llaves[i])}
+        if nombres.get(i):
+            fila["nombre"] = nombres[i]
+        fila["facturas"] = int(facturas[i])
+        for c in ("subtotal", "impuestos", "total"):
+            fila[c] = _redondear(sumas[c][i])
+        filas.append(fila)
+
+    totales = {"facturas": n}
+    for c in ("subtotal", "impuestos", "total"):
+        totales[c] = _redondear(columnas[c].sum())
+    return {"agrupado_por": agrupar_por, "grupos": grupos, "filas": filas, "totales": totales}
+
+
+def analizar_facturas(filtro: Optional[dict] = None, handle: Optional[str] = None, agrupar_por: str = "ninguno",
+                      top: Optional[int] = None, orden: Optional[str] = None, incluir_canceladas: bool = False,
+                      type: str = "issued") -> Dict[str, Any]:
+    """
+    Función del planificador: carga las facturas del filtro (índice local o
+    Facturama) o de una consulta previa (handle) y devuelve una tabla pequeña
+    con conteos, subtotales, impuestos y totales agrupados.
+    Las canceladas no cuentan salvo que se pidan.
+    """
+    filtro = dict(filtro or {})
+    if handle:
+        facturas = lista_de_facturas(obtener_resultado(handle))
+    else:
+        filtro.setdefault("type", type)
+        facturas = lista_de_facturas(consultar_facturas(filtro))
+
+    columnas = cargar_columnas(facturas)
+    if not incluir_canceladas and filtro.get("status") != "canceled":
+        vigentes = columnas["status"] != "canceled"
+        columnas = {k: v[vigentes] for k, v in columnas.items()}
+
+    resultado = agregar(columnas, agrupar_por if agrupar_por in AGRUPACIONES else "ninguno", top, orden)
+    resultado["filtro"] = {"handle": handle} if handle else filtro
+    resultado["canceladas_excluidas"] = not incluir_canceladas
+    return resultado
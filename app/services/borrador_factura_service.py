@@ -0,0 +1,294 @@
+import os
+import re
+import copy
+import time
+from typing import Optional, Dict, Any, List, Callable
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from app.services.enrutador_service import normalizar
+from app.services.esquemas_planner import ParamsCrearFactura
+from app.services.ia_service import extraer_delta_borrador
+from app.services.impuestos_service import calcular_factura, resumen_totales
+from app.services.plantillas_service import formatear_monto
+from app.utils.catalogos_sat import obtener_catalogo
+from app.utils.redis_client import obtener_borrador, guardar_borrador, eliminar_borrador
+
+load_dotenv()
+
+# ==========================================================
+#              BORRADOR DE FACTURA (SLOT FILLING)
+# ==========================================================
+# crear_factura se arma en varios turnos. En lugar de reenviar todo el
+# historial con el prompt grande para reconstruir el payload cada vez, el
+# usuario tiene un borrador en Redis y cada mensaje sólo le aplica su delta.
+#
+#   recolectando ──(sin faltantes)──▶ confirmando ──("sí")──▶ crear_factura
+#        ▲                                 │
+#        └────────(corrección)─────────────┘
+#
+# "cancelar" borra el borrador; "otro_tema" deja el borrador y sigue el flujo normal.
+
+BORRADOR_TTL_SEGUNDOS = int(os.getenv("BORRADOR_FACTURA_TTL_SEGUNDOS", "3600"))
+EMISOR_CODIGO_POSTAL = os.getenv("CFDI_EMISOR_CODIGO_POSTAL", "20160")
+# Puntaje mínimo para tomar sin preguntar la clave del catálogo que sugiere la descripción
+BORRADOR_PUNTAJE_CLAVE = float(os.getenv("BORRADOR_FACTURA_PUNTAJE_CLAVE", "0.9"))
+
+RFC_PUBLICO_GENERAL = "XAXX010101000"
+
+CAMPOS_RECEPTOR = ("Rfc", "Name", "CfdiUse", "FiscalRegime", "TaxZipCode")
+CAMPOS_PARTIDA = ("Description", "Quantity", "UnitPrice", "ProductCode", "UnitCode")
+CAMPOS_FACTURA = ("CfdiType", "PaymentForm", "PaymentMethod")
+_CAMPOS_PARTIDA_EDITABLES = set(CAMPOS_PARTIDA) | {"Discount", "TaxObject", "Unit"}
+_CAMPOS_FACTURA_EDITABLES = set(CAMPOS_FACTURA) | {"Currency", "Serie", "Observations"}
+
+# Sólo cuenta como confirmación si el mensaje completo son palabras de confirmación:
+# "sí, pero cambia la cantidad" es una corrección y va por extraer_delta_borrador
+_PALABRAS_CONFIRMACION = (
+    r"(si|sip|simon|ok|okay|va|dale|adelante|confirmo|correcto|de acuerdo|esta bien|todo bien"
+    r"|emitela|timbrala|hazla|por favor|porfa|gracias)"
+)
+_RE_CONFIRMACION = re.compile(rf"^{_PALABRAS_CONFIRMACION}(\W+{_PALABRAS_CONFIRMACION})*\W*$")
+_RE_CANCELACION = re.compile(r"^(cancela\w*|olvidalo|ya no|no la hagas|mejor no)\b|^no\W*$")
+
+
+def nuevo_borrador() -> Dict[str, Any]:
+    return {
+        "estado": "recolectando",
+        "datos": {
+            "CfdiType": "I",
+            "ExpeditionPlace": EMISOR_CODIGO_POSTAL,
+            "Receiver": {},
+            "Items": [],
+        },
+        "actualizado": time.time(),
+    }
+
+
+def faltantes(datos: Dict[str, Any]) -> List[str]:
+    """Rutas de los campos obligatorios que aún no tienen valor."""
+    vacio = lambda v: v in (None, "", [])
+    resultado = [c for c in CAMPOS_FACTURA if vacio(datos.get(c))]
+    receptor = datos.get("Receiver") or {}
+    resultado += [f"Receiver.{c}" for c in CAMPOS_RECEPTOR if vacio(receptor.get(c))]
+    items = datos.get("Items") or []
+    if not items:
+        resultado.append("Items")
+    for n, item in enumerate(items):
+        resultado += [f"Items.{n}.{c}" for c in CAMPOS_PARTIDA if vacio(item.get(c))]
+    return resultado
+
+
+def aplicar_delta(datos: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Aplica el delta del LLM sobre una copia de los datos. Sólo se aceptan las
+    rutas conocidas: lo demás se ignora en lugar de ensuciar el payload.
+    """
+    datos = copy.deepcopy(datos)
+    items = datos.setdefault("Items", [])
+    for n in sorted({i for i in delta.get("quitar_items", []) if 0 <= i < len(items)}, reverse=True):
+        items.pop(n)
+    for item in delta.get("agregar_items", []):
+        if isinstance(item, dict):
+            items.append({k: v for k, v in item.items() if k in _CAMPOS_PARTIDA_EDITABLES})
+
+    for ruta, valor in (delta.get("set") or {}).items():
+        partes = str(ruta).split(".")
+        if len(partes) == 1 and partes[0] in _CAMPOS_FACTURA_EDITABLES:
+            datos[partes[0]] = valor
+        elif len(partes) == 2 and partes[0] == "Receiver" and partes[1] in CAMPOS_RECEPTOR:
+            datos.setdefault("Receiver", {})[partes[1]] = valor
+        elif len(partes) == 3 and partes[0] == "Items" and partes[1].isdigit() and partes[2] in _CAMPOS_PARTIDA_EDITABLES:
+            n = int(partes[1])
+            while len(items) <= n:
+                items.append({})
+            items[n][partes[2]] = valor
+        else:
+            print(f"⚠️ Borrador: ruta ignorada {ruta}")
+    return datos
+
+
+def completar_automatico(datos: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Llena lo que se deduce sin preguntar: receptor público en general y
+    claves del SAT cuando la descripción tiene un candidato claro en el catálogo.
+    """
+    receptor = datos.setdefault("Receiver", {})
+    if str(receptor.get("Rfc", "")).strip().upper() == RFC_PUBLICO_GENERAL:
+        receptor.setdefault("Name", "PUBLICO EN GENERAL")
+        receptor.setdefault("CfdiUse", "S01")
+        receptor.setdefault("FiscalRegime", "616")
+        receptor.setdefault("TaxZipCode", datos.get("ExpeditionPlace") or EMISOR_CODIGO_POSTAL)
+    if receptor.get("Rfc"):
+        receptor["Rfc"] = str(receptor["Rfc"]).strip().upper()
+
+    catalogo = obtener_catalogo("c_ClaveProdServ")
+    for item in datos.get("Items") or []:
+        if item.get("ProductCode") or not item.get("Description") or catalogo is None:
+            continue
+        candidatos = catalogo.buscar(item["Description"], limite=2)
+        # Sólo si hay un candidato claro; si no, se le pregunta al usuario
+        if candidatos and candidatos[0]["puntaje"] >= BORRADOR_PUNTAJE_CLAVE and (
+            len(candidatos) == 1 or candidatos[1]["puntaje"] < candidatos[0]["puntaje"]
+        ):
+            item["ProductCode"] = candidatos[0]["clave"]
+    return datos
+
+
+def validar_factura(datos: Dict[str, Any]) -> List[str]:
+    try:
+        ParamsCrearFactura.model_validate(datos)
+    except ValidationError as e:
+        return [f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}".lstrip(": ") for err in e.errors()[:5]]
+    return []
+
+# ==========================================================
+#                    MENSAJES AL USUARIO
+# ==========================================================
+
+_PREGUNTAS = {
+    "CfdiType": "tipo de comprobante (I ingreso, E egreso)",
+    "PaymentForm": "forma de pago (01 efectivo, 03 transferencia, 04 tarjeta de crédito, 28 tarjeta de débito, 99 por definir)",
+    "PaymentMethod": "método de pago (PUE una sola exhibición, PPD parcialidades)",
+    "Receiver.Rfc": "RFC del cliente",
+    "Receiver.Name": "razón social del cliente (como aparece en su constancia)",
+    "Receiver.CfdiUse": "uso del CFDI (p. ej. G03 gastos en general)",
+    "Receiver.FiscalRegime": "régimen fiscal del cliente (p. ej. 601, 612, 626)",
+    "Receiver.TaxZipCode": "código postal fiscal del cliente",
+    "Items": "qué vas a facturar (descripción, cantidad y precio unitario)",
+    "Description": "descripción",
+    "Quantity": "cantidad",
+    "UnitPrice": "precio unitario",
+    "ProductCode": "clave de producto/servicio del SAT",
+    "UnitCode": "clave de unidad (p. ej. E48 servicio, H87 pieza)",
+}
+
+
+def _pregunta(campo: str, datos: Dict[str, Any]) -> str:
+    partes = campo.split(".")
+    if partes[0] != "Items" or len(partes) < 3:
+        return _PREGUNTAS.get(campo, campo)
+    item = datos["Items"][int(partes[1])]
+    texto = f"{_PREGUNTAS.get(partes[2], partes[2])} de \"{item.get('Description') or f'partida {int(partes[1]) + 1}'}\""
+    if partes[2] == "ProductCode" and item.get("Description"):
+        catalogo = obtener_catalogo("c_ClaveProdServ")
+        candidatos = catalogo.buscar(item["Description"], limite=3) if catalogo else []
+        if candidatos:
+            texto += " (opciones: " + ", ".join(f"{c['clave']} {c['descripcion']}" for c in candidatos) + ")"
+    return texto
+
+
+def mensaje_faltantes(datos: Dict[str, Any], pendientes: List[str]) -> str:
+    lineas = ["Para la factura me falta:"]
+    lineas += [f"• {_pregunta(c, datos)}" for c in pendientes[:5]]
+    if len(pendientes) > 5:
+        lineas.append(f"…y {len(pendientes) - 5} dato(s) más.")
+    return "\n".join(lineas)
+
+
+def mensaje_confirmacion(datos: Dict[str, Any]) -> str:
+    calculada, _ = calcular_factura(datos)
+    totales = resumen_totales(calculada)
+    receptor = datos["Receiver"]
+    lineas = [f"Factura para {receptor['Name']} ({receptor['Rfc']}), uso {receptor['CfdiUse']}:"]
+    for item in calculada["Items"]:
+        lineas.append(f"• {item['Quantity']} x {item['Description']} @ {formatear_monto(item['UnitPrice'])} = {formatear_monto(item['Subtotal'])}")
+    lineas.append(f"Subtotal {formatear_monto(totales['Subtotal'])}, impuestos {formatear_monto(totales['Trasladados'])}"
+                  + (f", retenciones {formatear_monto(totales['Retenidos'])}" if totales["Retenidos"] else "")
+                  + f", total {formatear_monto(totales['Total'])}.")
+    lineas.append(f"Forma de pago {datos['PaymentForm']}, método {datos['PaymentMethod']}. ¿La emito? (sí / no o dime qué corregir)")
+    return "\n".join(lineas)
+
+# ==========================================================
+#                       TURNO
+# ==========================================================
+
+def _detalle_error(e: Exception) -> str:
+    """Mensaje de Facturama si el error trae respuesta HTTP (Message / ModelState), si no el texto del error."""
+    respuesta = getattr(e, "response", None)
+    if respuesta is not None:
+        try:
+            cuerpo = respuesta.json()
+        except ValueError:
+            cuerpo = None
+        if isinstance(cuerpo, dict):
+            detalles = [str(cuerpo["Message"])] if cuerpo.get("Message") else []
+            for mensajes in (cuerpo.get("ModelState") or {}).values():
+                detalles += [str(m) for m in (mensajes if isinstance(mensajes, list) else [mensajes])]
+            if detalles:
+                return " ".join(detalles)
+    return str(e)
+
+
+def hay_borrador(user_id: str) -> bool:
+    return obtener_borrador(user_id) is not None
+
+
+async def atender_borrador(
+    user_id: str,
+    texto_usuario: str,
+    emitir: Callable[[Dict[str, Any]], Any],
+    nuevo: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """
+    Procesa un mensaje sobre el borrador del usuario. `emitir(datos)` es la
+    corrutina que timbra (crear_factura) cuando el usuario confirma.
+    Devuelve {"respuesta", "funcion", "resultado"} o None si el mensaje es de
+    otro tema y debe seguir el flujo normal.
+    """
+    borrador = nuevo_borrador() if nuevo else obtener_borrador(user_id)
+    if borrador is None:
+        return None
+    datos = borrador["datos"]
+    norm = normalizar(texto_usuario)
+
+    if _RE_CANCELACION.match(norm):
+        eliminar_borrador(user_id)
+        return {"respuesta": "Listo, descarté la factura en curso.", "funcion": None, "resultado": None}
+
+    if borrador["estado"] == "confirmando" and _RE_CONFIRMACION.match(norm):
+        errores = validar_factura(datos)
+        if not errores:
+            try:
+                resultado = await emitir(datos)
+            except Exception as e:
+                # El borrador se conserva: el usuario corrige el dato o vuelve a confirmar
+                print(f"❌ Error emitiendo la factura del borrador de {user_id}: {e}")
+                borrador["actualizado"] = time.time()
+                guardar_borrador(user_id, borrador, BORRADOR_TTL_SEGUNDOS)
+                return {
+                    "respuesta": f"No se pudo emitir la factura: {_detalle_error(e)}\n"
+                                 "Dime qué corregir o responde \"sí\" para intentarlo de nuevo.",
+                    "funcion": None,
+                    "resultado": None,
+                }
+            eliminar_borrador(user_id)
+            return {"respuesta": None, "funcion": "crear_factura", "resultado": resultado}
+        borrador["estado"] = "recolectando"
+        guardar_borrador(user_id, borrador, BORRADOR_TTL_SEGUNDOS)
+        return {"respuesta": "Antes de emitir hay que corregir:\n• " + "\n• ".join(errores), "funcion": None, "resultado": None}
+
+    delta = await extraer_delta_borrador(datos, faltantes(datos), texto_usuario, user_id=user_id)
+    if delta is None:
+        return {"respuesta": "No entendí ese dato, ¿me lo repites?", "funcion": None, "resultado": None}
+    if delta.get("cancelar"):
+        eliminar_borrador(user_id)
+        return {"respuesta": "Listo, descarté la factura en curso.", "funcion": None, "resultado": None}
+    if delta.get("otro_tema") and not nuevo:
+        return None
+
+    datos = completar_automatico(aplicar_delta(datos, delta))
+    pendientes = faltantes(datos)
+    borrador.update({"datos": datos, "actualizado": time.time()})
+    if pendientes:
+        borrador["estado"] = "recolectando"
+        respuesta = mensaje_faltantes(datos, pendientes)
+    else:
+        errores = validar_factura(datos)
+        if errores:
+            borrador["estado"] = "recolectando"
+            respuesta = "Revisa estos datos de la factura:\n• " + "\n• ".join(errores)
+        else:
+            borrador["estado"] = "confirmando"
+            respuesta = mensaje_confirmacion(datos)
+    guardar_borrador(user_id, borrador, BORRADOR_TTL_SEGUNDOS)
+    return {"respuesta": respuesta, "funcion": None, "resultado": None}
@@ -0,0 +1,178 @@
+import os
+import json
+import uuid
+import base64
+import mimetypes
+import threading
+import requests
+from typing import Optional, Dict, Any, Iterator, Iterable
+from dotenv import load_dotenv
+from app.utils.cache import CacheTTL
+from app.utils.cfdi_xml import es_cfdi_xml, extraer_cfdi
+from app.utils.almacen_archivos import leer_trozos, leer_inicio, sha256_archivo, TAMANO_TROZO
+from app.utils.redis_client import obtener_documento_procesado, guardar_documento_procesado
+
+load_dotenv()
+
+# ==========================================================
+#          PROCESAMIENTO DE DOCUMENTOS RECIBIDOS
+# ==========================================================
+# Extrae los datos de un archivo recibido: los CFDI en XML se leen localmente
+# (app/utils/cfdi_xml.py) y lo demás va al servicio de documentos.
+#
+# El resultado se guarda por SHA-256 del contenido: el mismo PDF reenviado,
+# o la misma factura de proveedor que mandan varios usuarios, se procesa una
+# sola vez. Dentro del proceso las peticiones simultáneas del mismo archivo se
+# combinan (CacheTTL); entre procesos se comparte por Redis.
+#
+# El archivo se manda en streaming desde disco, sin armar el contenido completo
+# en memoria. DOCUMENTOS_API_PROTOCOLO elige el formato del cuerpo:
+#   base64     {"base64": "..."} (contrato original del servicio)
+#   multipart  multipart/form-data con el campo "file"
+#   raw        bytes tal cual; nombre y hash en X-Filename / X-Content-Sha256
+
+DOCUMENTS_API_URL = os.getenv("DOCUMENTS_API_URL", "https://api-documentos-577166035685.us-central1.run.app/process-file")
+DOCUMENTOS_API_PROTOCOLO = os.getenv("DOCUMENTOS_API_PROTOCOLO", "base64").lower()
+DOCUMENTOS_API_CONCURRENCIA = int(os.getenv("DOCUMENTOS_API_CONCURRENCIA", "4"))
+DOCUMENTOS_API_TIMEOUT_SEGUNDOS = float(os.getenv("DOCUMENTOS_API_TIMEOUT_SEGUNDOS", "120"))
+DOCUMENTOS_RESULTADO_TTL_SEGUNDOS = int(os.getenv("DOCUMENTOS_RESULTADO_TTL_SEGUNDOS", str(7 * 24 * 3600)))
+DOCUMENTOS_CACHE_MAX = int(os.getenv("DOCUMENTOS_CACHE_MAX", "128"))
+
+PROTOCOLOS = ("base64", "multipart", "raw")
+
+_cache_resultados = CacheTTL(DOCUMENTOS_RESULTADO_TTL_SEGUNDOS, DOCUMENTOS_CACHE_MAX)
+# Llamadas simultáneas al servicio de documentos desde este proceso
+_cupo_api = threading.BoundedSemaphore(max(1, DOCUMENTOS_API_CONCURRENCIA))
+
+# ==========================================================
+#                 CUERPOS EN STREAMING
+# ==========================================================
+
+class CuerpoEnStreaming:
+    """
+    Cuerpo de longitud conocida que se genera por trozos. requests lo envía
+    leyendo bloques con read() y pone Content-Length con len().
+    """
+
+    def __init__(self, trozos: Iterable[bytes], longitud: int):
+        self._trozos: Iterator[bytes] = iter(trozos)
+        self._longitud = longitud
+        self._pendiente = b""
+
+    def __len__(self) -> int:
+        return self._longitud
+
+    def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self._pendiente) < n:
+            trozo = next(self._trozos, None)
+            if trozo is None:
+                break
+            self._pendiente += trozo
+        if n < 0:
+            n = len(self._pendiente)
+        salida, self._pendiente = self._pendiente[:n], self._pendiente[n:]
+        return salida
+
+
+def _tipo_mime(filename: str) -> str:
+    return mimetypes.guess_type(filename or "")[0] or "application/octet-stream"
+
+
+def cuerpo_base64(ruta: str) -> CuerpoEnStreaming:
+    """{"base64": "..."} codificado por trozos (múltiplos de 3 bytes: sin relleno intermedio)."""
+    tamano = os.path.getsize(ruta)
+    inicio, fin = b'{"base64": "', b'"}'
+
+    def trozos():
+        yield inicio
+        for trozo in leer_trozos(ruta, max(3, TAMANO_TROZO - TAMANO_TROZO % 3)):
+            yield base64.b64encode(trozo)
+        yield fin
+
+    return CuerpoEnStreaming(trozos(), len(inicio) + 4 * ((tamano + 2) // 3) + len(fin))
+
+
+def cuerpo_multipart(ruta: str, filename: str) -> tuple:
+    """(cuerpo, Content-Type) de un multipart/form-data con el archivo en el campo "file"."""
+    frontera = uuid.uuid4().hex
+    nombre = json.dumps(os.path.basename(filename or "archivo"), ensure_ascii=False)
+    cabecera = (
+        f"--{frontera}\r\n"
+        f"Content-Disposition: form-data; name=\"file\"; filename={nombre}\r\n"
+        f"Content-Type: {_tipo_mime(filename)}\r\n\r\n"
+    ).encode("utf-8")
+    cierre = f"\r\n--{frontera}--\r\n".encode("utf-8")
+
+    def trozos():
+        yield cabecera
+        yield from leer_trozos(ruta)
+        yield cierre
+
+    longitud = len(cabecera) + os.path.getsize(ruta) + len(cierre)
+    return CuerpoEnStreaming(trozos(), longitud), f"multipart/form-data; boundary={frontera}"
+
+# ==========================================================
+#                       PROCESAMIENTO
+# ==========================================================
+
+def _procesar_remoto(ruta: str, filename: str, sha256: str) -> Dict[str, Any]:
+    if DOCUMENTOS_API_PROTOCOLO == "multipart":
+        cuerpo, tipo = cuerpo_multipart(ruta, filename)
+        headers = {"Content-Type": tipo}
+    elif DOCUMENTOS_API_PROTOCOLO == "raw":
+        cuerpo = None
+        headers = {
+            "Content-Type": _tipo_mime(filename),
+            "X-Filename": os.path.basename(filename or "archivo"),
+            "X-Content-Sha256": sha256,
+        }
+    else:
+        cuerpo = cuerpo_base64(ruta)
+        headers = {"Content-Type": "application/json"}
+
+    with _cupo_api:
+        if cuerpo is None:
+            with open(ruta, "rb") as f:
+                response = requests.post(DOCUMENTS_API_URL, data=f, headers=headers,
+                                         timeout=DOCUMENTOS_API_TIMEOUT_SEGUNDOS)
+        else:
+            response = requests.post(DOCUMENTS_API_URL, data=cuerpo, headers=headers,
+                                     timeout=DOCUMENTOS_API_TIMEOUT_SEGUNDOS)
+    response.raise_for_status()
+    return response.json()
+
+
+def _extraer(sha256: str, ruta: str, filename: str) -> Dict[str, Any]:
+    guardado = obtener_documento_procesado(sha256)
+    if guardado is not None:
+        print(f"📄 Documento {sha256[:12]} ya procesado (Redis)")
+        return guardado
+
+    data = None
+    if es_cfdi_xml(leer_inicio(ruta)):
+        try:
+            with open(ruta, "rb") as f:
+                data = extraer_cfdi(f)
+            print(f"📄 CFDI leído localmente: {data.get('uuid')}")
+        except ValueError as e:
+            print(f"⚠️ No se pudo leer el CFDI localmente ({e}); se envía al servicio de documentos")
+    if data is None:
+        data = _procesar_remoto(ruta, filename, sha256)
+        print("📄 Respuesta del servicio Node.js:")
+        print(data)
+    guardar_documento_procesado(sha256, data, DOCUMENTOS_RESULTADO_TTL_SEGUNDOS)
+    return data
+
+
+def procesar_documento(ruta: str, filename: str = "archivo", sha256: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Datos extraídos del archivo en `ruta` (bloqueante: llamar con asyncio.to_thread).
+    `sha256` evita volver a leer el archivo si ya se calculó al recibirlo.
+    Los errores del servicio remoto se propagan y no se guardan.
+    """
+    sha256 = sha256 or sha256_archivo(ruta)
+    return _cache_resultados.obtener_o_calcular(sha256, lambda: _extraer(sha256, ruta, filename))
+
+
+def estadisticas_documentos() -> Dict[str, int]:
+    return _cache_resultados.estadisticas()
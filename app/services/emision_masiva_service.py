@@ -0,0 +1,490 @@
+import io
+import os
+import csv
+import time
+import uuid
+import asyncio
+import requests
+from typing import Optional, Dict, Any, List, Tuple, Callable
+from dotenv import load_dotenv
+from app.services.borrador_factura_service import nuevo_borrador, completar_automatico, validar_factura
+from app.services.enrutador_service import normalizar
+from app.services.facturacion_service import crear_factura, buscar_facturas_emitidas
+from app.services.impuestos_service import calcular_factura, resumen_totales
+from app.services.plantillas_service import formatear_monto
+from app.utils.redis_client import (
+    crear_lote,
+    obtener_lote,
+    actualizar_lote,
+    obtener_facturas_lote,
+    obtener_resultados_lote,
+    guardar_resultado_lote,
+    cerrar_lote,
+    obtener_lotes_pendientes,
+    acquire_task_lock,
+    release_task_lock,
+    refresh_task_lock,
+)
+
+load_dotenv()
+
+# ==========================================================
+#              EMISIÓN MASIVA DESDE CSV / XLSX
+# ==========================================================
+# El usuario manda una hoja con una fila por partida; las filas con el mismo
+# valor en la columna "factura" forman una sola factura (sin esa columna cada
+# fila es una factura). Todo el archivo se valida localmente antes de emitir
+# nada; luego las facturas se timbran en segundo plano con a lo más
+# EMISION_MASIVA_CONCURRENCIA envíos simultáneos a Facturama.
+#
+# El avance vive en Redis (lote:<id>:*): si el proceso se reinicia, el lote se
+# retoma con lo que falta. Una factura que quedó "enviando" cuando se cayó el
+# proceso pudo haberse timbrado: antes de reintentarla se busca en Facturama
+# por la referencia del lote (va en Observations) o por RFC y total; sólo si
+# no se puede saber se reporta para revisarla a mano.
+
+EMISION_MASIVA_CONCURRENCIA = int(os.getenv("EMISION_MASIVA_CONCURRENCIA", "4"))
+EMISION_MASIVA_MAX_FACTURAS = int(os.getenv("EMISION_MASIVA_MAX_FACTURAS", "500"))
+EMISION_MASIVA_AVISO_SEGUNDOS = float(os.getenv("EMISION_MASIVA_AVISO_SEGUNDOS", "30"))
+EMISION_MASIVA_LOCK_SEGUNDOS = int(os.getenv("EMISION_MASIVA_LOCK_SEGUNDOS", "300"))
+EMISION_MASIVA_FORMA_PAGO = os.getenv("EMISION_MASIVA_FORMA_PAGO", "")
+EMISION_MASIVA_METODO_PAGO = os.getenv("EMISION_MASIVA_METODO_PAGO", "PUE")
+
+EXTENSIONES_LOTE = (".csv", ".xlsx")
+
+# Ruta del payload → encabezados aceptados (normalizados: minúsculas, sin acentos, "_")
+_COLUMNAS = {
+    "factura": ("factura", "grupo", "referencia"),
+    "CfdiType": ("tipo", "tipo_comprobante"),
+    "PaymentForm": ("forma_pago", "forma_de_pago"),
+    "PaymentMethod": ("metodo_pago", "metodo_de_pago"),
+    "Currency": ("moneda",),
+    "Serie": ("serie",),
+    "Observations": ("observaciones", "notas"),
+    "Receiver.Rfc": ("rfc", "rfc_receptor", "rfc_cliente"),
+    "Receiver.Name": ("nombre", "razon_social", "cliente"),
+    "Receiver.CfdiUse": ("uso_cfdi", "uso"),
+    "Receiver.FiscalRegime": ("regimen_fiscal", "regimen"),
+    "Receiver.TaxZipCode": ("cp", "codigo_postal", "cp_receptor"),
+    "Items.Description": ("descripcion", "concepto"),
+    "Items.Quantity": ("cantidad",),
+    "Items.UnitPrice": ("precio_unitario", "precio", "valor_unitario"),
+    "Items.Discount": ("descuento",),
+    "Items.ProductCode": ("clave_producto", "clave_prod_serv", "clave_sat"),
+    "Items.UnitCode": ("clave_unidad",),
+    "Items.Unit": ("unidad",),
+    "Items.TaxObject": ("objeto_impuesto",),
+}
+_ENCABEZADOS = {alias: ruta for ruta, alias_ in _COLUMNAS.items() for alias in alias_}
+# Sin estas columnas el archivo no es un lote de facturas (se procesa como documento)
+_COLUMNAS_MINIMAS = {"Receiver.Rfc", "Items.Description", "Items.UnitPrice"}
+_CAMPOS_NUMERICOS = {"Quantity", "UnitPrice", "Discount"}
+# Claves que Excel convierte en número y pierden los ceros a la izquierda
+_ANCHO_CLAVE = {"TaxZipCode": 5, "ProductCode": 8, "PaymentForm": 2, "TaxObject": 2}
+
+# ==========================================================
+#                     LECTURA DEL ARCHIVO
+# ==========================================================
+
+def es_archivo_lote(filename: str) -> bool:
+    return os.path.splitext(filename or "")[1].lower() in EXTENSIONES_LOTE
+
+
+def _encabezado(valor: Any) -> str:
+    return "_".join(normalizar(str(valor or "")).replace("-", " ").split())
+
+
+def _leer_csv(file_bytes: bytes) -> List[List[Any]]:
+    try:
+        texto = file_bytes.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Excel en español guarda los CSV en Windows-1252
+        texto = file_bytes.decode("cp1252", errors="replace")
+    try:
+        dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=",;\t|")
+    except csv.Error:
+        dialecto = csv.excel
+    return list(csv.reader(io.StringIO(texto), dialecto))
+
+
+def _leer_xlsx(file_bytes: bytes) -> List[List[Any]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError as e:
+        raise ValueError("Para leer archivos XLSX instala openpyxl (o envía el archivo como CSV).") from e
+    libro = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        return [list(fila) for fila in libro.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        libro.close()
+
+
+def leer_filas(filename: str, file_bytes: bytes) -> Optional[Tuple[Dict[int, str], List[Tuple[int, List[Any]]]]]:
+    """
+    Devuelve ({columna: ruta del payload}, [(número de fila, valores)]) o
+    None si el archivo no trae las columnas de un lote de facturas.
+    Los números de fila son los de la hoja (el encabezado es la fila 1).
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    filas = _leer_xlsx(file_bytes) if ext == ".xlsx" else _leer_csv(file_bytes)
+    if not filas:
+        return None
+    columnas = {}
+    for i, valor in enumerate(filas[0]):
+        ruta = _ENCABEZADOS.get(_encabezado(valor))
+        if ruta and ruta not in columnas.values():
+            columnas[i] = ruta
+    if not _COLUMNAS_MINIMAS <= set(columnas.values()):
+        return None
+    datos = [
+        (n, fila) for n, fila in enumerate(filas[1:], start=2)
+        if any(v not in (None, "") and str(v).strip() for v in fila)
+    ]
+    return columnas, datos
+
+# ==========================================================
+#                  ARMADO Y VALIDACIÓN LOCAL
+# ==========================================================
+
+def _texto(campo: str, valor: Any) -> str:
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = str(valor).strip()
+    if campo in _ANCHO_CLAVE and texto.isdigit():
+        texto = texto.zfill(_ANCHO_CLAVE[campo])
+    return texto
+
+
+def _numero(valor: Any) -> float:
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    return float(str(valor).replace("$", "").replace(",", "").strip())
+
+
+def armar_facturas(columnas: Dict[int, str], filas: List[Tuple[int, List[Any]]]
+                   ) -> Tuple[List[Dict[str, Any]], List[List[int]], List[str]]:
+    """
+    Agrupa las filas en payloads de crear_factura y los valida con el mismo
+    esquema que el planificador. Devuelve (facturas, filas de cada factura, errores).
+    """
+    grupos: Dict[str, Dict[str, Any]] = {}
+    errores: List[str] = []
+    for numero, fila in filas:
+        valores = {}
+        for i, ruta in columnas.items():
+            valor = fila[i] if i < len(fila) else None
+            if valor is not None and str(valor).strip() != "":
+                valores[ruta] = valor
+        llave = _texto("factura", valores.pop("factura", f"fila-{numero}"))
+        grupo = grupos.get(llave)
+        if grupo is None:
+            datos = nuevo_borrador()["datos"]
+            if EMISION_MASIVA_FORMA_PAGO:
+                datos["PaymentForm"] = EMISION_MASIVA_FORMA_PAGO
+            datos["PaymentMethod"] = EMISION_MASIVA_METODO_PAGO
+            grupo = grupos[llave] = {"datos": datos, "filas": []}
+        grupo["filas"].append(numero)
+        datos = grupo["datos"]
+
+        item: Dict[str, Any] = {"Quantity": 1}
+        for ruta, valor in valores.items():
+            partes = ruta.split(".")
+            campo = partes[-1]
+            if campo in _CAMPOS_NUMERICOS:
+                try:
+                    valor = _numero(valor)
+                except ValueError:
+                    errores.append(f"Fila {numero}: {_COLUMNAS[ruta][0]} \"{valor}\" no es un número")
+                    continue
+            else:
+                valor = _texto(campo, valor)
+            if partes[0] == "Items":
+                item[campo] = valor
+            elif partes[0] == "Receiver":
+                # Los datos de la factura se toman de la primera fila del grupo
+                datos["Receiver"].setdefault(campo, valor)
+            elif campo not in datos or len(grupo["filas"]) == 1:
+                datos[campo] = valor
+        datos["Items"].append(item)
+
+    facturas, filas_por_factura = [], []
+    for grupo in grupos.values():
+        datos = completar_automatico(grupo["datos"])
+        primera = grupo["filas"][0]
+        for error in validar_factura(datos):
+            errores.append(f"Fila {primera}: {error}")
+        facturas.append(datos)
+        filas_por_factura.append(grupo["filas"])
+    return facturas, filas_por_factura, errores
+
+# ==========================================================
+#                    EJECUCIÓN DEL LOTE
+# ==========================================================
+
+Notificar = Callable[[str, str], Any]
+
+# Referencias a las tareas de fondo para que el recolector no las cancele
+_tareas: set = set()
+
+
+def _en_segundo_plano(corrutina) -> None:
+    tarea = asyncio.create_task(corrutina)
+    _tareas.add(tarea)
+    tarea.add_done_callback(_tareas.discard)
+
+
+def _describir_error(e: Exception) -> str:
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        detalle = e.response.text or str(e)
+    else:
+        detalle = str(e)
+    return " ".join(detalle.split())[:200]
+
+
+def _conteos(resultados: Dict[int, Dict[str, Any]]) -> Dict[str, int]:
+    conteos = {"emitida": 0, "error": 0, "enviando": 0}
+    for resultado in resultados.values():
+        conteos[resultado.get("estado", "error")] = conteos.get(resultado.get("estado", "error"), 0) + 1
+    return conteos
+
+
+def _referencia(lote_id: str, n: int) -> str:
+    return f"Lote {lote_id}-{n + 1}"
+
+
+def _con_referencia(factura: Dict[str, Any], referencia: str) -> Dict[str, Any]:
+    datos = dict(factura)
+    observaciones = str(datos.get("Observations") or "").strip()
+    datos["Observations"] = f"{observaciones} [{referencia}]".strip()
+    return datos
+
+
+def _mismo_total(candidata: Dict[str, Any], total: float) -> bool:
+    try:
+        return abs(float(candidata.get("Total")) - total) < 0.01
+    except (TypeError, ValueError):
+        return False
+
+
+def conciliar_envio(factura: Dict[str, Any], enviando: Dict[str, Any],
+                    ya_emitidas: set) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Busca en Facturama una factura que quedó "enviando" al caerse el proceso.
+    Devuelve ("emitida", factura de Facturama), ("pendiente", None) si no se
+    timbró y puede reintentarse, o ("en_duda", None) si no se puede saber.
+    """
+    referencia = enviando.get("referencia")
+    desde = enviando.get("desde")
+    if not referencia or not desde:
+        # Marca de una versión anterior: no hay con qué buscarla
+        return "en_duda", None
+    try:
+        candidatas = [
+            f for f in buscar_facturas_emitidas(factura["Receiver"]["Rfc"], desde)
+            if isinstance(f, dict) and f.get("Id") not in ya_emitidas
+        ]
+    except Exception as e:
+        print(f"⚠️ No se pudo consultar Facturama para conciliar {referencia}: {e}")
+        return "en_duda", None
+
+    if any("Observations" in f for f in candidatas):
+        coincidencias = [f for f in candidatas if referencia in str(f.get("Observations") or "")]
+    else:
+        # El listado no trae Observations: RFC + total (+ serie) desde el envío
+        total = resumen_totales(calcular_factura(factura)[0])["Total"]
+        coincidencias = [
+            f for f in candidatas
+            if _mismo_total(f, total) and (not factura.get("Serie") or f.get("Serie") == factura["Serie"])
+        ]
+    if len(coincidencias) == 1:
+        return "emitida", coincidencias[0]
+    if not coincidencias:
+        return "pendiente", None
+    return "en_duda", None
+
+
+def mensaje_avance(lote_id: str, meta: Dict[str, Any], resultados: Dict[int, Dict[str, Any]]) -> str:
+    conteos = _conteos(resultados)
+    texto = f"📦 Lote {lote_id}: {conteos['emitida']}/{meta['total']} facturas emitidas"
+    if conteos["error"]:
+        texto += f", {conteos['error']} con error"
+    return texto + "."
+
+
+def mensaje_final(lote_id: str, meta: Dict[str, Any], resultados: Dict[int, Dict[str, Any]],
+                  en_duda: List[int]) -> str:
+    conteos = _conteos(resultados)
+    emitidas = [r for r in resultados.values() if r.get("estado") == "emitida"]
+    lineas = [f"✅ Lote {lote_id} terminado: {conteos['emitida']} de {meta['total']} facturas emitidas"
+              + (f" por {formatear_monto(sum(r.get('total') or 0 for r in emitidas))}." if emitidas else ".")]
+    fallidas = sorted(n for n, r in resultados.items() if r.get("estado") == "error")
+    if fallidas:
+        lineas.append(f"❌ {len(fallidas)} con error:")
+        for n in fallidas[:10]:
+            lineas.append(f"• Fila {meta['filas'][n][0]}: {resultados[n].get('error')}")
+        if len(fallidas) > 10:
+            lineas.append(f"…y {len(fallidas) - 10} más.")
+    if en_duda:
+        filas = ", ".join(str(meta["filas"][n][0]) for n in en_duda[:20])
+        lineas.append(f"⚠️ {len(en_duda)} quedaron sin confirmar por un reinicio y no pude verificarlas "
+                      f"en Facturama (filas {filas}); revísalas antes de volver a enviarlas.")
+    return "\n".join(lineas)
+
+
+async def _avisar(notificar: Notificar, user_id: str, texto: str) -> None:
+    try:
+        await asyncio.to_thread(notificar, user_id, texto)
+    except Exception as e:
+        print(f"⚠️ No se pudo avisar el avance del lote a {user_id}: {e}")
+
+
+async def ejecutar_lote(lote_id: str, notificar: Notificar) -> Optional[Dict[str, Any]]:
+    """
+    Timbra las facturas pendientes del lote con concurrencia acotada y avisa el
+    avance cada EMISION_MASIVA_AVISO_SEGUNDOS. Con varios workers sólo uno
+    ejecuta cada lote (lock en Redis). Devuelve los conteos finales.
+    """
+    nombre_lock = f"lote:{lote_id}"
+    token = acquire_task_lock(nombre_lock, EMISION_MASIVA_LOCK_SEGUNDOS)
+    if not token:
+        print(f"🔒 El lote {lote_id} ya se está ejecutando en otro worker")
+        return None
+    try:
+        meta = obtener_lote(lote_id)
+        if not meta:
+            cerrar_lote(lote_id)
+            return None
+        user_id = meta["user_id"]
+        facturas = obtener_facturas_lote(lote_id)
+        resultados = obtener_resultados_lote(lote_id)
+        # "enviando" al arrancar = el proceso anterior murió a media llamada
+        en_duda = []
+        ya_emitidas = {r.get("id") for r in resultados.values() if r.get("estado") == "emitida"}
+        enviando = sorted(n for n, r in resultados.items() if r.get("estado") == "enviando")
+        for n in enviando:
+            estado, factura = await asyncio.to_thread(conciliar_envio, facturas[n], resultados[n], ya_emitidas)
+            if estado == "emitida":
+                ya_emitidas.add(factura.get("Id"))
+                resultados[n] = {
+                    "estado": "emitida",
+                    "id": factura.get("Id"),
+                    "folio": factura.get("Folio"),
+                    "total": factura.get("Total"),
+                    "conciliada": True,
+                }
+                guardar_resultado_lote(lote_id, n, resultados[n])
+            elif estado == "pendiente":
+                del resultados[n]
+            else:
+                en_duda.append(n)
+        if enviando:
+            print(f"📦 Lote {lote_id}: {len(enviando) - len(en_duda)} de {len(enviando)} envíos interrumpidos conciliados con Facturama")
+        pendientes = sorted(n for n in facturas if n not in resultados)
+        semaforo = asyncio.Semaphore(max(1, EMISION_MASIVA_CONCURRENCIA))
+
+        async def emitir(n: int) -> None:
+            async with semaforo:
+                referencia = _referencia(lote_id, n)
+                guardar_resultado_lote(lote_id, n, {"estado": "enviando", "referencia": referencia, "desde": time.time()})
+                try:
+                    factura = await asyncio.to_thread(crear_factura, _con_referencia(facturas[n], referencia))
+                    factura = factura if isinstance(factura, dict) else {}
+                    resultado = {
+                        "estado": "emitida",
+                        "id": factura.get("Id"),
+                        "folio": factura.get("Folio"),
+                        "total": factura.get("Total"),
+                    }
+                except Exception as e:
+                    resultado = {"estado": "error", "error": _describir_error(e)}
+                guardar_resultado_lote(lote_id, n, resultado)
+                resultados[n] = resultado
+
+        async def avisar_avance() -> None:
+            ultimo = None
+            while True:
+                await asyncio.sleep(EMISION_MASIVA_AVISO_SEGUNDOS)
+                refresh_task_lock(nombre_lock, EMISION_MASIVA_LOCK_SEGUNDOS)
+                texto = mensaje_avance(lote_id, meta, resultados)
+                if texto != ultimo:
+                    ultimo = texto
+                    await _avisar(notificar, user_id, texto)
+
+        print(f"📦 Lote {lote_id}: {len(pendientes)} facturas por emitir ({len(resultados)} ya procesadas)")
+        avance = asyncio.create_task(avisar_avance())
+        try:
+            await asyncio.gather(*(emitir(n) for n in pendientes))
+        finally:
+            avance.cancel()
+
+        meta.update({"estado": "terminado", "terminado": time.time()})
+        actualizar_lote(lote_id, meta)
+        cerrar_lote(lote_id)
+        await _avisar(notificar, user_id, mensaje_final(lote_id, meta, resultados, en_duda))
+        return _conteos(resultados)
+    finally:
+        release_task_lock(nombre_lock, token)
+
+
+async def iniciar_lote(user_id: str, filename: str, file_bytes: bytes,
+                       notificar: Notificar) -> Optional[Dict[str, Any]]:
+    """
+    Lee y valida el archivo; si es un lote válido lo guarda en Redis y lo
+    ejecuta en segundo plano. Devuelve None si el archivo no es un lote de
+    facturas (sigue al servicio de documentos).
+    """
+    try:
+        leido = await asyncio.to_thread(leer_filas, filename, file_bytes)
+    except Exception as e:
+        respuesta = f"No pude leer {filename}: {e}"
+        await _avisar(notificar, user_id, respuesta)
+        return {"status": "rechazado", "errores": [str(e)]}
+    if leido is None:
+        return None
+
+    facturas, filas, errores = armar_facturas(*leido)
+    if not facturas:
+        errores = errores or ["El archivo no tiene filas con facturas."]
+    elif len(facturas) > EMISION_MASIVA_MAX_FACTURAS:
+        errores.append(f"El archivo trae {len(facturas)} facturas; el máximo por lote es {EMISION_MASIVA_MAX_FACTURAS}.")
+    if errores:
+        # Se valida todo antes de timbrar: un lote a medias es más difícil de corregir
+        respuesta = "\n".join(
+            [f"No emití ninguna factura de {filename}; corrige esto y vuelve a enviarlo:"]
+            + [f"• {e}" for e in errores[:15]]
+            + ([f"…y {len(errores) - 15} error(es) más."] if len(errores) > 15 else [])
+        )
+        await _avisar(notificar, user_id, respuesta)
+        return {"status": "rechazado", "errores": errores}
+
+    lote_id = uuid.uuid4().hex[:8]
+    meta = {
+        "user_id": user_id,
+        "archivo": filename,
+        "total": len(facturas),
+        "filas": filas,
+        "estado": "en_proceso",
+        "creado": time.time(),
+    }
+    crear_lote(lote_id, meta, facturas)
+    await _avisar(notificar, user_id,
+                  f"📦 Recibí {len(facturas)} facturas en {filename} (lote {lote_id}). "
+                  "Las estoy emitiendo y te aviso el avance.")
+    _en_segundo_plano(ejecutar_lote(lote_id, notificar))
+    return {"status": "en_proceso", "lote": lote_id, "facturas": len(facturas)}
+
+
+async def reanudar_lotes(notificar: Notificar) -> List[str]:
+    """
+    Al arrancar: retoma los lotes que quedaron a medias en un reinicio.
+    """
+    reanudados = []
+    for lote_id in obtener_lotes_pendientes():
+        meta = obtener_lote(lote_id)
+        if not meta:
+            cerrar_lote(lote_id)
+            continue
+        print(f"📦 Reanudando lote {lote_id} de {meta.get('user_id')}")
+        _en_segundo_plano(ejecutar_lote(lote_id, notificar))
+        reanudados.append(lote_id)
+    return reanudados
@@ -0,0 +1,436 @@
+import os
+import re
+import sys
+import json
+import time
+import unicodedata
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, List, Callable, Iterable
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Confianza mínima para saltarse al planificador LLM
+UMBRAL_CONFIANZA = float(os.getenv("ENRUTADOR_UMBRAL_CONFIANZA", "0.85"))
+# Formato de fecha que espera FACTURACION_API_URL en dateStart/dateEnd
+FORMATO_FECHA = os.getenv("ENRUTADOR_FORMATO_FECHA", "%Y-%m-%d")
+ENRUTADOR_ACTIVO = os.getenv("ENRUTADOR_ACTIVO", "true").lower() == "true"
+
+# ==========================================================
+#                 NORMALIZACIÓN Y TOKENS
+# ==========================================================
+
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
+    "julio": 7, "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10,
+    "noviembre": 11, "diciembre": 12,
+}
+
+# Palabras que no aportan significado a la intención; si tras reconocer
+# parámetros queda algo fuera de esta lista, bajamos la confianza.
+PALABRAS_VACIAS = {
+    "a", "al", "de", "del", "el", "la", "las", "los", "lo", "en", "y", "o", "por", "para",
+    "con", "me", "mi", "mis", "su", "sus", "un", "una", "que", "favor", "porfa", "porfavor",
+    "quiero", "necesito", "ocupo", "puedes", "podrias", "quisiera", "hola", "buenas", "buen",
+    "dia", "dias", "tardes", "noches", "gracias", "dame", "pasame", "mandame", "enviame",
+    "manda", "envia", "enviar", "mandar", "descarga", "descargar", "descargame", "bajar",
+    "consulta", "consultar", "consultame", "busca", "buscar", "buscame", "muestra",
+    "muestrame", "ver", "lista", "listar", "factura", "facturas", "cfdi", "cfdis",
+    "documento", "archivo", "formato", "id", "rfc", "fecha", "mes", "ano", "todas", "todos",
+    "emitidas", "emitida", "recibidas", "recibida", "nomina", "nominas", "pdf", "xml",
+    "canceladas", "cancelada", "activas", "activa", "vigentes", "vigente", "pendientes",
+    "pendiente", "este", "esta", "pasado", "anterior", "hoy", "ayer", "folio", "folios",
+    "desde", "hasta", "entre", "cliente", "receptor",
+}
+
+_RE_RFC = re.compile(r"\b([A-ZÑ&]{3,4})(\d{2})(\d{2})(\d{2})([A-Z\d]{3})\b")
+_RE_ID_FACTURA = re.compile(
+    r"\b(?:factura|cfdi|documento)\s+(?:con\s+)?(?:el\s+)?(?:id\s*:?\s*)?([A-Za-z0-9_-]{16,40})\b",
+    re.IGNORECASE,
+)
+_RE_FECHA_ISO = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+_RE_FECHA_DMY = re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b")
+_RE_ANIO = re.compile(r"\b(20\d{2})\b")
+_RE_FOLIOS = re.compile(r"\bfolios?\s+(?:del\s+)?(\d+)\s*(?:al|a|-)\s*(\d+)\b", re.IGNORECASE)
+# Preguntas de agregados (se comparan contra el texto normalizado)
+_RE_CUANTO = re.compile(r"\b(cuanto|total)\s+(he\s+)?(factur\w*|vend\w*|cobr\w*|gast\w*)\b")
+_RE_TOP = re.compile(r"\btop\s+(\d+)\b|\b(\d+)\s+(?:mejores|principales)\b")
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas y sin acentos, para comparar palabras clave."""
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return texto.lower().strip()
+
+
+def _tokens(texto: str) -> List[str]:
+    return re.findall(r"[a-z0-9_&ñ-]+", normalizar(texto))
+
+# ==========================================================
+#               EXTRACCIÓN DE PARÁMETROS
+# ==========================================================
+
+def extraer_rfc(texto: str) -> Optional[str]:
+    """Devuelve el primer RFC (persona física o moral) con fecha válida."""
+    for match in _RE_RFC.finditer((texto or "").upper()):
+        _, yy, mm, dd, _ = match.groups()
+        try:
+            datetime.strptime(f"{yy}{mm}{dd}", "%y%m%d")
+        except ValueError:
+            continue
+        return match.group(0)
+    return None
+
+
+def extraer_id_factura(texto: str) -> Optional[str]:
+    """Id de Facturama: token alfanumérico largo que sigue a 'factura'/'cfdi'."""
+    match = _RE_ID_FACTURA.search(texto or "")
+    if not match:
+        return None
+    candidato = match.group(1)
+    # Un id real mezcla letras y dígitos; evita confundir palabras largas
+    if not (re.search(r"\d", candidato) and re.search(r"[A-Za-z]", candidato)):
+        return None
+    if extraer_rfc(candidato) == candidato.upper():
+        return None
+    return candidato
+
+
+def extraer_formato(texto: str) -> Optional[str]:
+    tokens = _tokens(texto)
+    if "xml" in tokens:
+        return "xml"
+    if "pdf" in tokens:
+        return "pdf"
+    return None
+
+
+def extraer_tipo(texto: str) -> str:
+    tokens = set(_tokens(texto))
+    if tokens & {"recibidas", "recibida"}:
+        return "received"
+    if tokens & {"nomina", "nominas"}:
+        return "payroll"
+    return "issued"
+
+
+def extraer_status(texto: str) -> Optional[str]:
+    tokens = set(_tokens(texto))
+    if tokens & {"canceladas", "cancelada"}:
+        return "canceled"
+    if tokens & {"pendientes", "pendiente"}:
+        return "pending"
+    if tokens & {"activas", "activa", "vigentes", "vigente"}:
+        return "active"
+    return None
+
+
+def _fin_de_mes(anio: int, mes: int) -> date:
+    siguiente = date(anio + (mes == 12), mes % 12 + 1, 1)
+    return siguiente - timedelta(days=1)
+
+
+def extraer_rango_fechas(texto: str, hoy: Optional[date] = None) -> Optional[Dict[str, date]]:
+    """
+    Reconoce fechas explícitas (ISO o dd/mm/aaaa), meses por nombre
+    ('julio', 'julio de 2025') y expresiones relativas ('este mes', 'mes pasado', 'hoy').
+    Si el mes nombrado aún no llega este año, se asume el año anterior.
+    """
+    hoy = hoy or datetime.now().date()
+    norm = normalizar(texto)
+
+    fechas = []
+    for y, m, d in _RE_FECHA_ISO.findall(norm):
+        fechas.append(date(int(y), int(m), int(d)))
+    for d, m, y in _RE_FECHA_DMY.findall(norm):
+        fechas.append(date(int(y), int(m), int(d)))
+    if fechas:
+        return {"inicio": min(fechas), "fin": max(fechas)}
+
+    if re.search(r"\bhoy\b", norm):
+        return {"inicio": hoy, "fin": hoy}
+    if re.search(r"\bayer\b", norm):
+        ayer = hoy - timedelta(days=1)
+        return {"inicio": ayer, "fin": ayer}
+    if re.search(r"\beste mes\b", norm):
+        return {"inicio": hoy.replace(day=1), "fin": hoy}
+    if re.search(r"\bmes (pasado|anterior)\b", norm):
+        fin = hoy.replace(day=1) - timedelta(days=1)
+        return {"inicio": fin.replace(day=1), "fin": fin}
+
+    meses = [MESES[t] for t in re.findall(r"[a-z]+", norm) if t in MESES]
+    if meses:
+        anio_match = _RE_ANIO.search(norm)
+        if anio_match:
+            anio = int(anio_match.group(1))
+        else:
+            anio = hoy.year if max(meses) <= hoy.month else hoy.year - 1
+        return {"inicio": date(anio, min(meses), 1), "fin": _fin_de_mes(anio, max(meses))}
+
+    anio_match = _RE_ANIO.search(norm)
+    if anio_match:
+        anio = int(anio_match.group(1))
+        return {"inicio": date(anio, 1, 1), "fin": date(anio, 12, 31)}
+    return None
+
+
+def _residuo(texto: str, reconocidos: Iterable[str]) -> List[str]:
+    """Tokens que ninguna regla explica: si existen, la intención no es tan clara."""
+    ignorar = {normalizar(r) for r in reconocidos if r}
+    residuo = []
+    for token in _tokens(texto):
+        if token in PALABRAS_VACIAS or token in MESES or token in ignorar:
+            continue
+        if re.fullmatch(r"\d+|\d{4}-\d{2}-\d{2}", token):
+            continue
+        residuo.append(token)
+    return residuo
+
+# ==========================================================
+#                    REGLAS (PLUGGABLE)
+# ==========================================================
+
+Regla = Callable[[str], Optional[Dict[str, Any]]]
+REGLAS: List[Regla] = []
+
+
+def registrar_regla(regla: Regla) -> Regla:
+    """
+    Registra una regla. Una regla recibe el texto del usuario y devuelve
+    None o {"servicio", "funcion", "params", "confianza"}. Usable como decorador.
+    """
+    REGLAS.append(regla)
+    return regla
+
+
+@registrar_regla
+def regla_descargar_documento(texto: str) -> Optional[Dict[str, Any]]:
+    norm = normalizar(texto)
+    if not re.search(r"\b(descarg\w*|manda\w*|envia\w*|pasa\w*|dame|bajar?)\b", norm):
+        return None
+    id_factura = extraer_id_factura(texto)
+    if not id_factura:
+        return None
+
+    formato = extraer_formato(texto)
+    params = {"id": id_factura, "format": formato or "pdf", "type": extraer_tipo(texto)}
+
+    confianza = 0.95 if formato else 0.9
+    if _residuo(texto, [id_factura]):
+        confianza -= 0.3
+    return {
+        "servicio": "FACTURACION",
+        "funcion": "descargar_documento",
+        "params": params,
+        "confianza": confianza,
+    }
+
+
+def _extraer_filtro(texto: str) -> Dict[str, Any]:
+    """
+    Filtro de consultar_facturas a partir del texto.
+    Devuelve {"params", "reconocidos", "tiene_filtro"}.
+    """
+    params: Dict[str, Any] = {"type": extraer_tipo(texto)}
+    reconocidos = []
+
+    rfc = extraer_rfc(texto)
+    if rfc:
+        params["rfc"] = rfc
+        reconocidos.append(rfc)
+
+    rango = extraer_rango_fechas(texto)
+    if rango:
+        params["dateStart"] = rango["inicio"].strftime(FORMATO_FECHA)
+        params["dateEnd"] = rango["fin"].strftime(FORMATO_FECHA)
+
+    folios = _RE_FOLIOS.search(texto)
+    if folios:
+        params["folioStart"], params["folioEnd"] = folios.group(1), folios.group(2)
+
+    status = extraer_status(texto)
+    if status:
+        params["status"] = status
+
+    return {"params": params, "reconocidos": reconocidos, "tiene_filtro": bool(rfc or rango or folios)}
+
+
+@registrar_regla
+def regla_consultar_facturas(texto: str) -> Optional[Dict[str, Any]]:
+    norm = normalizar(texto)
+    if not re.search(r"\b(facturas|cfdis)\b", norm) and not re.search(r"\b(consult\w*|busc\w*)\b.*\bfactura\b", norm):
+        return None
+    if re.search(r"\b(descarg\w*|crea\w*|emit[ei]r?|genera\w*|timbra\w*)\b", norm) or extraer_formato(texto):
+        return None
+    # Totales y agrupaciones los resuelve analizar_facturas
+    if _RE_CUANTO.search(norm) or _RE_TOP.search(norm) or re.search(r"\bpor (mes|clientes?)\b", norm):
+        return None
+
+    filtro = _extraer_filtro(texto)
+    if not filtro["tiene_filtro"]:
+        # Sin filtros la consulta es demasiado abierta para no preguntar al LLM
+        return None
+
+    confianza = 0.9
+    if _residuo(texto, filtro["reconocidos"]):
+        confianza -= 0.3
+    return {
+        "servicio": "FACTURACION",
+        "funcion": "consultar_facturas",
+        "params": filtro["params"],
+        "confianza": confianza,
+    }
+
+
+@registrar_regla
+def regla_descargar_documentos_zip(texto: str) -> Optional[Dict[str, Any]]:
+    norm = normalizar(texto)
+    if not re.search(r"\b(descarg\w*|manda\w*|envia\w*|pasa\w*|dame|bajar?)\b", norm):
+        return None
+    if not re.search(r"\b(facturas|cfdis|todas)\b", norm) or extraer_id_factura(texto):
+        return None
+
+    filtro = _extraer_filtro(texto)
+    if not filtro["tiene_filtro"]:
+        return None
+
+    formato = extraer_formato(texto)
+    # "mándame las facturas de julio" puede ser la lista en el chat: sin verbo de
+    # descarga ni formato explícito no hay certeza de que quiera los archivos
+    explicito = formato or re.search(r"\b(descarg\w*|bajar?)\b", norm)
+    confianza = 0.9 if explicito else 0.7
+    if _residuo(texto, filtro["reconocidos"]):
+        confianza -= 0.3
+    return {
+        "servicio": "FACTURACION",
+        "funcion": "descargar_documentos_zip",
+        "params": {"filtro": filtro["params"], "format": formato or "pdf", "type": filtro["params"]["type"]},
+        "confianza": confianza,
+    }
+
+@registrar_regla
+def regla_analizar_facturas(texto: str) -> Optional[Dict[str, Any]]:
+    norm = normalizar(texto)
+    cuanto = _RE_CUANTO.search(norm)
+    top = _RE_TOP.search(norm)
+    por_cliente = re.search(r"\b(por|top|mejores|principales)\s+(\d+\s+)?(clientes?|receptores?|proveedores?)\b", norm)
+    por_mes = re.search(r"\bpor mes\b", norm)
+    if not (cuanto or por_cliente or por_mes):
+        return None
+
+    filtro = _extraer_filtro(texto)
+    if not filtro["tiene_filtro"]:
+        return None
+    if re.search(r"\b(gast\w*|proveedores?)\b", norm):
+        filtro["params"]["type"] = "received"
+
+    params: Dict[str, Any] = {"filtro": filtro["params"], "type": filtro["params"]["type"]}
+    if por_cliente:
+        params["agrupar_por"] = "rfc"
+    elif por_mes:
+        params["agrupar_por"] = "mes"
+    if top:
+        params["top"] = int(top.group(1) or top.group(2))
+
+    reconocidos = filtro["reconocidos"] + re.findall(
+        r"\b(?:cuanto|total|he|factur\w*|vend\w*|cobr\w*|gast\w*|top|mejores|principales|clientes?|receptores?|proveedores?)\b",
+        norm
+    )
+    confianza = 0.9
+    if _residuo(texto, reconocidos):
+        confianza -= 0.3
+    return {
+        "servicio": "FACTURACION",
+        "funcion": "analizar_facturas",
+        "params": params,
+        "confianza": confianza,
+    }
+
+# ==========================================================
+#                      ENRUTADOR
+# ==========================================================
+
+def enrutar_mensaje(texto: str, umbral: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Evalúa las reglas sobre el mensaje del usuario y devuelve el paso
+    {"servicio", "funcion", "params"} de mayor confianza si supera el umbral.
+    Devuelve None cuando hay duda, para que decida el planificador LLM.
+    """
+    if not ENRUTADOR_ACTIVO or not texto:
+        return None
+    umbral = UMBRAL_CONFIANZA if umbral is None else umbral
+
+    mejor = None
+    for regla in REGLAS:
+        try:
+            candidato = regla(texto)
+        except Exception as e:
+            print(f"⚠️ Regla {getattr(regla, '__name__', regla)} falló: {e}")
+            continue
+        if candidato and (mejor is None or candidato["confianza"] > mejor["confianza"]):
+            mejor = candidato
+
+    if not mejor or mejor["confianza"] < umbral:
+        return None
+    return {
+        "servicio": mejor["servicio"],
+        "funcion": mejor["funcion"],
+        "params": mejor["params"],
+        "confianza": mejor["confianza"],
+        "origen": "enrutador",
+    }
+
+# ==========================================================
+#                 REPLAY (MEDIR PRECISIÓN)
+# ==========================================================
+
+def medir_precision(casos: Iterable[Dict[str, Any]], umbral: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Reproduce casos etiquetados y mide el enrutador.
+    Cada caso: {"texto": "...", "esperado": {"funcion": "...", "params": {...}} | null}.
+    - precision: aciertos / casos enrutados (lo que importa: no equivocarse)
+    - cobertura: casos enrutados / casos con intención esperada
+    """
+    total = enrutados = aciertos = esperados = 0
+    errores = []
+    inicio = time.perf_counter()
+
+    for caso in casos:
+        total += 1
+        esperado = caso.get("esperado")
+        if esperado:
+            esperados += 1
+        obtenido = enrutar_mensaje(caso.get("texto", ""), umbral=umbral)
+        if not obtenido:
+            continue
+        enrutados += 1
+        correcto = bool(esperado) and obtenido["funcion"] == esperado.get("funcion") and all(
+            obtenido["params"].get(k) == v for k, v in (esperado.get("params") or {}).items()
+        )
+        if correcto:
+            aciertos += 1
+        else:
+            errores.append({"texto": caso.get("texto"), "esperado": esperado, "obtenido": obtenido})
+
+    duracion_ms = (time.perf_counter() - inicio) * 1000
+    return {
+        "casos": total,
+        "enrutados": enrutados,
+        "aciertos": aciertos,
+        "precision": aciertos / enrutados if enrutados else None,
+        "cobertura": enrutados / esperados if esperados else None,
+        "latencia_media_ms": duracion_ms / total if total else 0.0,
+        "errores": errores,
+    }
+
+
+if __name__ == "__main__":
+    # Uso: python -m app.services.enrutador_service casos.jsonl [umbral]
+    if len(sys.argv) < 2:
+        print("Uso: python -m app.services.enrutador_service casos.jsonl [umbral]")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        casos = [json.loads(linea) for linea in f if linea.strip()]
+    umbral = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    print(json.dumps(medir_precision(casos, umbral), ensure_ascii=False, indent=2, default=str))
@@ -0,0 +1,317 @@
+import json
+from typing import Any, Dict, List, Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+from app.utils.catalogos_sat import CATALOGOS_INCLUIDOS, validar_claves_factura
+
+# ==========================================================
+#            ESQUEMAS DE LA SALIDA DEL PLANIFICADOR
+# ==========================================================
+# Cada paso que devuelve el LLM se valida aquí antes de despachar cualquier
+# llamada a Facturama o WhatsApp.
+
+FUNCIONES_POR_SERVICIO = {
+    "FACTURACION": {"consultar_facturas", "descargar_documento", "descargar_documentos_zip", "analizar_facturas", "buscar_catalogo_sat", "crear_factura"},
+    "WHATSAPP": {"respuesta_final"},
+}
+
+
+class PasoInvalido(ValueError):
+    """La salida del LLM no es JSON o no cumple el esquema de la función."""
+
+
+def _normalizar_tipo(valor: Optional[str]) -> Optional[str]:
+    # El prompt histórico usa 'recived'; Facturama espera 'received'
+    if valor and valor.lower() in ("recived", "recibidas", "recibida"):
+        return "received"
+    return valor.lower() if isinstance(valor, str) else valor
+
+
+class Clasificacion(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    servicio: Literal["FACTURACION", "WHATSAPP"]
+    funcion: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+
+    @field_validator("servicio", mode="before")
+    @classmethod
+    def _servicio(cls, v):
+        return (v or "").upper().replace("Ó", "O")
+
+    @field_validator("funcion")
+    @classmethod
+    def _funcion(cls, v, info):
+        servicio = info.data.get("servicio")
+        if servicio and v not in FUNCIONES_POR_SERVICIO[servicio]:
+            raise ValueError(f"funcion '{v}' no existe en {servicio}")
+        return v
+
+    @field_validator("params", mode="before")
+    @classmethod
+    def _params(cls, v):
+        return v or {}
+
+
+class ParamsConsultarFacturas(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    type: Literal["issued", "received", "payroll"] = "issued"
+    folioStart: Optional[str] = None
+    folioEnd: Optional[str] = None
+    rfc: Optional[str] = None
+    dateStart: Optional[str] = None
+    dateEnd: Optional[str] = None
+    status: Optional[Literal["all", "active", "canceled", "pending"]] = None
+    pagina: Optional[int] = Field(default=None, ge=1)
+    por_pagina: Optional[int] = Field(default=None, ge=1, le=100)
+    handle: Optional[str] = None
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def _tipo(cls, v):
+        return _normalizar_tipo(v) or "issued"
+
+    @field_validator("folioStart", "folioEnd", mode="before")
+    @classmethod
+    def _folio(cls, v):
+        return str(v) if v is not None else None
+
+    @field_validator("rfc")
+    @classmethod
+    def _rfc(cls, v):
+        return v.strip().upper() if v else v
+
+
+class ParamsDescargarDocumento(BaseModel):
+    # Se pasa como **params: cualquier campo extra rompería la llamada
+    model_config = ConfigDict(extra="ignore")
+
+    id: str = Field(min_length=1)
+    format: Literal["pdf", "xml"] = "pdf"
+    type: Literal["issued", "received", "payroll"] = "issued"
+
+    @field_validator("format", mode="before")
+    @classmethod
+    def _formato(cls, v):
+        return (v or "pdf").lower()
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def _tipo(cls, v):
+        return _normalizar_tipo(v) or "issued"
+
+
+class ParamsDescargarDocumentosZip(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    ids: Optional[List[str]] = None
+    filtro: Optional[ParamsConsultarFacturas] = None
+    handle: Optional[str] = None
+    format: Literal["pdf", "xml"] = "pdf"
+    type: Literal["issued", "received", "payroll"] = "issued"
+
+    @field_validator("format", mode="before")
+    @classmethod
+    def _formato(cls, v):
+        return (v or "pdf").lower()
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def _tipo(cls, v):
+        return _normalizar_tipo(v) or "issued"
+
+    @model_validator(mode="after")
+    def _ids_o_filtro(self):
+        if not self.ids and not self.filtro and not self.handle:
+            raise ValueError("se requiere 'ids', 'filtro' o 'handle'")
+        return self
+
+
+class ParamsAnalizarFacturas(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    filtro: Optional[ParamsConsultarFacturas] = None
+    handle: Optional[str] = None
+    agrupar_por: Literal["ninguno", "rfc", "mes", "dia", "status"] = "ninguno"
+    top: Optional[int] = Field(default=None, ge=1, le=50)
+    orden: Optional[Literal["asc", "desc"]] = None
+    incluir_canceladas: bool = False
+    type: Literal["issued", "received", "payroll"] = "issued"
+
+    @field_validator("agrupar_por", mode="before")
+    @classmethod
+    def _agrupar(cls, v):
+        v = (v or "ninguno").lower()
+        return {"cliente": "rfc", "clientes": "rfc", "receptor": "rfc", "estado": "status"}.get(v, v)
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def _tipo(cls, v):
+        return _normalizar_tipo(v) or "issued"
+
+
+class ParamsBuscarCatalogoSat(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    catalogo: str
+    texto: str = Field(min_length=1)
+    limite: int = Field(default=5, ge=1, le=20)
+
+    @field_validator("catalogo", mode="before")
+    @classmethod
+    def _catalogo(cls, v):
+        # Acepta "ClaveProdServ", "c_claveprodserv", etc.
+        nombres = {n.lower(): n for n in CATALOGOS_INCLUIDOS}
+        v = str(v or "").strip()
+        nombre = nombres.get(v.lower()) or nombres.get(f"c_{v}".lower())
+        if not nombre:
+            raise ValueError(f"catálogo desconocido; usa uno de {', '.join(CATALOGOS_INCLUIDOS)}")
+        return nombre
+
+
+class Impuesto(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    Name: str
+    Rate: float
+    Base: Optional[float] = None
+    Total: Optional[float] = None
+    IsRetention: bool = False
+
+
+class Concepto(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    ProductCode: str = Field(min_length=1)
+    Description: str = Field(min_length=1)
+    UnitCode: str = Field(min_length=1)
+    Quantity: float = Field(gt=0)
+    UnitPrice: float = Field(ge=0)
+    Taxes: List[Impuesto] = Field(default_factory=list)
+
+
+class Receptor(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    Rfc: str = Field(min_length=12, max_length=13)
+    Name: str = Field(min_length=1)
+    CfdiUse: str = Field(min_length=1)
+    FiscalRegime: str = Field(min_length=1)
+    TaxZipCode: str = Field(min_length=5, max_length=5)
+
+
+class ParamsCrearFactura(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    CfdiType: str = Field(min_length=1)
+    ExpeditionPlace: str = Field(min_length=5, max_length=5)
+    PaymentForm: str = Field(min_length=1)
+    PaymentMethod: Literal["PUE", "PPD"]
+    Receiver: Receptor
+    Items: List[Concepto] = Field(min_length=1)
+
+    @model_validator(mode="after")
+    def _claves_sat(self):
+        errores = validar_claves_factura(self.model_dump())
+        if errores:
+            raise ValueError("; ".join(errores))
+        return self
+
+
+class ParamsRespuestaFinal(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    mensaje: Optional[str] = None
+
+
+ESQUEMAS_PARAMS = {
+    "consultar_facturas": ParamsConsultarFacturas,
+    "descargar_documento": ParamsDescargarDocumento,
+    "descargar_documentos_zip": ParamsDescargarDocumentosZip,
+    "analizar_facturas": ParamsAnalizarFacturas,
+    "buscar_catalogo_sat": ParamsBuscarCatalogoSat,
+    "crear_factura": ParamsCrearFactura,
+    "respuesta_final": ParamsRespuestaFinal,
+}
+
+class DeltaBorrador(BaseModel):
+    """Cambio que trae un mensaje sobre el borrador de factura (borrador_factura_service)."""
+    model_config = ConfigDict(extra="ignore")
+
+    set: Dict[str, Any] = Field(default_factory=dict)
+    agregar_items: List[Dict[str, Any]] = Field(default_factory=list)
+    quitar_items: List[int] = Field(default_factory=list)
+    cancelar: bool = False
+    otro_tema: bool = False
+
+    @field_validator("set", mode="before")
+    @classmethod
+    def _set(cls, v):
+        return v or {}
+
+    @field_validator("agregar_items", "quitar_items", mode="before")
+    @classmethod
+    def _listas(cls, v):
+        return v or []
+
+# ==========================================================
+#                   PARSEO Y VALIDACIÓN
+# ==========================================================
+
+def extraer_json(texto: Optional[str]) -> Dict[str, Any]:
+    """
+    Obtiene el primer objeto JSON de la respuesta. Con JSON mode la respuesta ya
+    es el objeto; si no, se toleran bloques ```json y texto antes del objeto.
+    """
+    if not texto:
+        raise PasoInvalido("respuesta vacía")
+    texto = texto.strip()
+    if texto.startswith("```"):
+        texto = texto.strip("`")
+        texto = texto[4:] if texto.lower().startswith("json") else texto
+    inicio = texto.find("{")
+    if inicio < 0:
+        raise PasoInvalido("la respuesta no contiene un objeto JSON")
+    try:
+        datos, _ = json.JSONDecoder().raw_decode(texto[inicio:])
+    except json.JSONDecodeError as e:
+        raise PasoInvalido(f"JSON malformado: {e}")
+    if not isinstance(datos, dict) or not datos:
+        raise PasoInvalido("se esperaba un objeto JSON no vacío")
+    return datos
+
+
+def _mensaje_error(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()[:10])
+
+
+def validar_clasificacion(texto: Optional[str]) -> Dict[str, Any]:
+    """Valida {"servicio", "funcion"} del primer paso del planificador."""
+    try:
+        paso = Clasificacion.model_validate(extraer_json(texto))
+    except ValidationError as e:
+        raise PasoInvalido(_mensaje_error(e))
+    return paso.model_dump()
+
+
+def validar_delta_borrador(texto: Optional[str]) -> Dict[str, Any]:
+    """Valida el delta {"set", "agregar_items", "quitar_items", "cancelar", "otro_tema"}."""
+    try:
+        return DeltaBorrador.model_validate(extraer_json(texto)).model_dump()
+    except ValidationError as e:
+        raise PasoInvalido(_mensaje_error(e))
+
+
+def validar_paso(texto: Optional[str]) -> Dict[str, Any]:
+    """
+    Valida un paso completo {"servicio", "funcion", "params"} contra el esquema
+    de su función y devuelve los params normalizados.
+    """
+    paso = validar_clasificacion(texto)
+    esquema = ESQUEMAS_PARAMS[paso["funcion"]]
+    try:
+        params = esquema.model_validate(paso["params"])
+    except ValidationError as e:
+        raise PasoInvalido(_mensaje_error(e))
+    paso["params"] = params.model_dump(exclude_none=True)
+    return paso
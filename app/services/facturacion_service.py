@@ -1,27 +1,224 @@
 import os
+import uuid
+import zipfile
+import tempfile
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import base64
 from tempfile import gettempdir
 import json
+import time
+import asyncio
+from datetime import datetime, timedelta
+from app.utils.cache import CacheTTL
+from app.utils import indice_facturas
+from app.services.impuestos_service import calcular_factura, resumen_totales
+from app.utils import cache_documentos
+from app.utils import archivos_temp
+from app.utils.redis_client import guardar_resultado, obtener_resultado, acquire_task_lock, release_task_lock
 
 load_dotenv()
 
 FACTURACION_API_URL = os.getenv("FACTURACION_API_URL")  
 FACTURACION_USER = os.getenv("PRODUCTION_FACTURAMA_USER")
 FACTURACION_PASSWORD = os.getenv("PRODUCTION_FACTURAMA_PASSWORD")
+# Las filas del índice local se separan por cuenta de Facturama
+CUENTA_INDICE = FACTURACION_USER or ""
+
+# Cache de consultas: el planificador repite la misma consulta varias veces por turno
+FACTURAS_CACHE_TTL_SEGUNDOS = float(os.getenv("FACTURAS_CACHE_TTL_SEGUNDOS", "120"))
+FACTURAS_CACHE_MAX = int(os.getenv("FACTURAS_CACHE_MAX", "256"))
+_cache_consultas = CacheTTL(FACTURAS_CACHE_TTL_SEGUNDOS, FACTURAS_CACHE_MAX)
+
+# Documentos chicos (hasta ARCHIVOS_TEMP_MEMORIA_MAX_BYTES) se guardan en memoria
+# en vez del cache en disco: descargar y enviar un XML no toca disco
+DOCUMENTOS_MEMORIA_TTL_SEGUNDOS = float(os.getenv("DOCUMENTOS_MEMORIA_TTL_SEGUNDOS", "3600"))
+DOCUMENTOS_MEMORIA_MAX = int(os.getenv("DOCUMENTOS_MEMORIA_MAX", "64"))
+_documentos_en_memoria = CacheTTL(DOCUMENTOS_MEMORIA_TTL_SEGUNDOS, DOCUMENTOS_MEMORIA_MAX)
+
+# Descarga masiva: descargas simultáneas a Facturama y tope de documentos por ZIP
+DESCARGA_MASIVA_CONCURRENCIA = int(os.getenv("DESCARGA_MASIVA_CONCURRENCIA", "6"))
+DESCARGA_MASIVA_MAX = int(os.getenv("DESCARGA_MASIVA_MAX", "200"))
+DESCARGAS_DIR = os.getenv("DESCARGAS_DIR", archivos_temp.ARCHIVOS_TEMP_DIR)
+
+# Paginado/proyección: al historial y a los prompts sólo llega lo que el planificador usa
+CAMPOS_PROYECCION = ("Id", "Serie", "Folio", "Rfc", "TaxName", "Date", "Total", "Status")
+FACTURAS_POR_PAGINA = int(os.getenv("FACTURAS_POR_PAGINA", "20"))
+RESULTADOS_TTL_SEGUNDOS = int(os.getenv("RESULTADOS_TTL_SEGUNDOS", "1800"))
+_PARAMS_PAGINADO = ("pagina", "por_pagina", "handle")
+
+# Índice local (app/utils/indice_facturas.py): se usa si la última sincronización
+# del tipo tiene menos de INDICE_FACTURAS_MAX_EDAD_SEGUNDOS
+INDICE_FACTURAS_MAX_EDAD_SEGUNDOS = float(os.getenv("INDICE_FACTURAS_MAX_EDAD_SEGUNDOS", "900"))
+# Cada sincronización incremental vuelve a pedir los últimos días (cancelaciones recientes);
+# la completa, cada INDICE_FACTURAS_RESYNC_SEGUNDOS, recoge cambios de estado más viejos
+INDICE_FACTURAS_SOLAPE_DIAS = int(os.getenv("INDICE_FACTURAS_SOLAPE_DIAS", "3"))
+INDICE_FACTURAS_RESYNC_SEGUNDOS = float(os.getenv("INDICE_FACTURAS_RESYNC_SEGUNDOS", "86400"))
+INDICE_FACTURAS_TIPOS = ("issued", "received")
+FORMATO_FECHA_FACTURAMA = os.getenv("ENRUTADOR_FORMATO_FECHA", "%Y-%m-%d")
+INDICE_FACTURAS_INTERVALO_SEGUNDOS = float(os.getenv("INDICE_FACTURAS_INTERVALO_SEGUNDOS", "300"))
+
+def _llave_consulta(params: dict) -> tuple:
+    """
+    Llave canónica (cuenta, params): ignora vacíos, orden de las llaves,
+    espacios y mayúsculas del RFC.
+    """
+    canonicos = {}
+    for k, v in (params or {}).items():
+        if v is None or v == "":
+            continue
+        v = str(v).strip()
+        canonicos[k] = v.upper() if k.lower() == "rfc" else v
+    return (FACTURACION_USER, json.dumps(canonicos, sort_keys=True))
+
+def invalidar_cache_consultas() -> int:
+    """
+    Borra las consultas en cache de la cuenta actual (p. ej. tras emitir una factura).
+    """
+    return _cache_consultas.invalidar(lambda llave: llave[0] == FACTURACION_USER)
 
 def crear_factura(datos_factura: dict) -> dict:
     url = f"{FACTURACION_API_URL}"
     auth = (FACTURACION_USER, FACTURACION_PASSWORD)
     headers = {"Content-Type": "application/json"}
+
+    # Los importes se calculan localmente: el modelo sólo aporta cantidades, precios e impuestos
+    datos_factura, correcciones = calcular_factura(datos_factura)
+    if correcciones:
+        print(f"🧮 Importes corregidos antes de timbrar: {correcciones}")
+    esperado = resumen_totales(datos_factura)
     print("📤 Enviando a Facturama:", json.dumps(datos_factura, indent=2, ensure_ascii=False))
 
     resp = requests.post(url, json=datos_factura, headers=headers)
     resp.raise_for_status()
-    return resp.json()
+    factura = resp.json()
+    if isinstance(factura, dict) and factura.get("Total") is not None:
+        try:
+            if abs(float(factura["Total"]) - esperado["Total"]) >= 0.01:
+                print(f"⚠️ Total timbrado {factura['Total']} distinto al calculado {esperado['Total']}")
+        except (TypeError, ValueError):
+            pass
+    # La nueva factura cambia el resultado de cualquier consulta previa
+    invalidar_cache_consultas()
+    try:
+        indice_facturas.marcar_desactualizado(CUENTA_INDICE)
+    except Exception as e:
+        print(f"⚠️ No se pudo marcar el índice de facturas como desactualizado: {e}")
+    return factura
 
 def consultar_facturas(params: dict) -> dict:
+    """
+    Consulta facturas. Si el índice local está fresco para el tipo pedido se
+    responde desde ahí; si no, cache de lectura: la misma consulta (params
+    canónicos) dentro del TTL se responde localmente y las concurrentes se
+    combinan en una.
+    """
+    local = _consultar_indice(params)
+    if local is not None:
+        return local
+    return _cache_consultas.obtener_o_calcular(
+        _llave_consulta(params),
+        lambda: _consultar_facturas_remoto(params)
+    )
+
+def _consultar_indice(params: dict):
+    """
+    Resultado desde el índice local, o None si está apagado, no está fresco,
+    el filtro no se puede resolver localmente o la base falla.
+    """
+    if not indice_facturas.INDICE_ACTIVO:
+        return None
+    tipo = (params or {}).get("type") or "issued"
+    try:
+        if not indice_facturas.esta_fresco(CUENTA_INDICE, tipo, INDICE_FACTURAS_MAX_EDAD_SEGUNDOS):
+            return None
+        return indice_facturas.buscar_facturas(CUENTA_INDICE, params)
+    except Exception as e:
+        print(f"⚠️ Índice de facturas no disponible, se consulta Facturama: {e}")
+        return None
+
+def sincronizar_indice_facturas(tipos=INDICE_FACTURAS_TIPOS, completo: bool = False) -> dict:
+    """
+    Copia al índice local los metadatos de las facturas de Facturama.
+    Incremental: sólo pide desde la factura más reciente ya indexada (menos
+    INDICE_FACTURAS_SOLAPE_DIAS); completa la primera vez y cada
+    INDICE_FACTURAS_RESYNC_SEGUNDOS. Devuelve {tipo: facturas guardadas}.
+    """
+    guardadas = {}
+    for tipo in tipos:
+        estado = indice_facturas.obtener_estado_sync(CUENTA_INDICE, tipo)
+        params = {"type": tipo}
+        completa = (
+            completo or not estado or not estado["ultima_fecha"]
+            or time.time() - estado["completo"] > INDICE_FACTURAS_RESYNC_SEGUNDOS
+        )
+        if not completa:
+            try:
+                ultima = datetime.strptime(estado["ultima_fecha"][:10], "%Y-%m-%d")
+                desde = ultima - timedelta(days=INDICE_FACTURAS_SOLAPE_DIAS)
+                params["dateStart"] = desde.strftime(FORMATO_FECHA_FACTURAMA)
+            except ValueError:
+                completa = True
+
+        registros = lista_de_facturas(_consultar_facturas_remoto(params))
+        guardadas[tipo] = indice_facturas.guardar_facturas(CUENTA_INDICE, tipo, registros)
+        indice_facturas.marcar_sincronizado(CUENTA_INDICE, tipo, completo=completa)
+        print(f"🗂️ Índice de facturas {tipo}: {guardadas[tipo]} guardadas ({'completa' if completa else 'incremental'})")
+    return guardadas
+
+async def ciclo_sincronizacion_indice() -> None:
+    """
+    Tarea de fondo: sincroniza el índice cada INDICE_FACTURAS_INTERVALO_SEGUNDOS.
+    Con varios workers sólo uno sincroniza por vuelta (lock en Redis).
+    """
+    while True:
+        token = acquire_task_lock("indice_facturas", int(INDICE_FACTURAS_INTERVALO_SEGUNDOS))
+        if token:
+            try:
+                await asyncio.to_thread(sincronizar_indice_facturas)
+            except Exception as e:
+                print(f"❌ Error sincronizando el índice de facturas: {e}")
+            finally:
+                release_task_lock("indice_facturas", token)
+        await asyncio.sleep(INDICE_FACTURAS_INTERVALO_SEGUNDOS)
+
+def lista_de_facturas(resultado) -> list:
+    if isinstance(resultado, dict):
+        resultado = resultado.get("facturas") or resultado.get("Data") or []
+    return resultado if isinstance(resultado, list) else []
+
+def proyectar_factura(factura: dict) -> dict:
+    return {k: factura.get(k) for k in CAMPOS_PROYECCION if factura.get(k) not in (None, "")}
+
+def consultar_facturas_paginado(params: dict) -> dict:
+    """
+    consultar_facturas para el planificador: guarda el resultado completo fuera
+    de banda (Redis) y devuelve sólo una página con los campos proyectados.
+    Con "handle" pagina un resultado ya guardado sin volver a Facturama.
+    Devuelve {"handle", "total", "pagina", "paginas", "facturas"}.
+    """
+    params = dict(params or {})
+    pagina = max(1, int(params.pop("pagina", None) or 1))
+    por_pagina = max(1, min(100, int(params.pop("por_pagina", None) or FACTURAS_POR_PAGINA)))
+    handle = params.pop("handle", None)
+
+    facturas = obtener_resultado(handle) if handle else None
+    if facturas is None:
+        facturas = lista_de_facturas(consultar_facturas(params))
+        handle = guardar_resultado(facturas, ttl_seconds=RESULTADOS_TTL_SEGUNDOS)
+
+    total = len(facturas)
+    inicio = (pagina - 1) * por_pagina
+    return {
+        "handle": handle,
+        "total": total,
+        "pagina": pagina,
+        "paginas": (total + por_pagina - 1) // por_pagina,
+        "facturas": [proyectar_factura(f) for f in facturas[inicio:inicio + por_pagina] if isinstance(f, dict)],
+    }
+
+def _consultar_facturas_remoto(params: dict) -> dict:
     url = f"{FACTURACION_API_URL}"
     auth = (FACTURACION_USER, FACTURACION_PASSWORD)
 
@@ -29,6 +226,16 @@ def consultar_facturas(params: dict) -> dict:
     resp.raise_for_status()
     return resp.json()
 
+def buscar_facturas_emitidas(rfc: str, desde: float) -> list:
+    """
+    Facturas emitidas a `rfc` desde el timestamp `desde`, directo de Facturama
+    (sin cache ni índice: sirve para confirmar una emisión que quedó en duda).
+    """
+    # Un día de holgura por la zona horaria de Facturama
+    fecha = datetime.fromtimestamp(desde) - timedelta(days=1)
+    params = {"type": "issued", "rfc": rfc, "status": "all", "dateStart": fecha.strftime(FORMATO_FECHA_FACTURAMA)}
+    return lista_de_facturas(_consultar_facturas_remoto(params))
+
 def descargar_documento(id: str, format: str = "pdf", type: str = "issued") -> tuple:
     """
     Descarga el documento de facturación y devuelve (bytes del archivo, nombre del archivo).
@@ -51,4 +258,113 @@ def descargar_documento(id: str, format: str = "pdf", type: str = "issued") -> t
         "ContentType": f"application/{format}",
         "ContentLength": len(resp.content),
         "Content": archivo_base64
-    }
\ No newline at end of file
+    }
+
+def obtener_documento_local(id: str, format: str = "pdf", type: str = "issued") -> tuple:
+    """
+    Devuelve (ruta local, nombre) del documento. Los CFDI son inmutables, así que
+    se sirven del cache en disco y sólo se descargan de Facturama la primera vez.
+    """
+    en_cache = cache_documentos.obtener_documento(id, format, type)
+    if en_cache:
+        print(f"📦 Documento {id}.{format} servido desde cache")
+        return en_cache
+    file_bytes, file_name = descargar_documento(id, format, type)
+    ruta = cache_documentos.guardar_documento(id, format, type, file_bytes, file_name)
+    return ruta, file_name
+
+
+def abrir_documento(id: str, format: str = "pdf", type: str = "issued"):
+    """
+    Devuelve el documento como archivo abierto (con atributo `nombre`) listo
+    para enviarse. Los chicos viven en memoria (ArchivoTemporal) y nunca
+    tocan disco; los grandes se sirven del cache en disco. Quien lo recibe lo cierra.
+    """
+    llave = (id, format.lower(), type.lower())
+    en_memoria = _documentos_en_memoria.obtener(llave)
+    if en_memoria:
+        print(f"📦 Documento {id}.{format} servido desde memoria")
+        file_bytes, file_name = en_memoria
+        return archivos_temp.archivo_temporal(file_name, file_bytes)
+
+    en_cache = cache_documentos.obtener_documento(id, format, type)
+    if en_cache:
+        print(f"📦 Documento {id}.{format} servido desde cache")
+        ruta, file_name = en_cache
+        if os.path.getsize(ruta) <= archivos_temp.ARCHIVOS_TEMP_MEMORIA_MAX_BYTES:
+            # Se lee una vez y las siguientes solicitudes salen de memoria
+            with open(ruta, "rb") as f:
+                file_bytes = f.read()
+            _documentos_en_memoria.guardar(llave, (file_bytes, file_name))
+            return archivos_temp.archivo_temporal(file_name, file_bytes)
+    else:
+        file_bytes, file_name = descargar_documento(id, format, type)
+        if len(file_bytes) <= archivos_temp.ARCHIVOS_TEMP_MEMORIA_MAX_BYTES:
+            _documentos_en_memoria.guardar(llave, (file_bytes, file_name))
+            return archivos_temp.archivo_temporal(file_name, file_bytes)
+        ruta = cache_documentos.guardar_documento(id, format, type, file_bytes, file_name)
+
+    # El descriptor abierto sigue siendo válido aunque el LRU del cache borre el archivo
+    archivo = open(ruta, "rb")
+    archivo.nombre = file_name
+    return archivo
+
+
+def descargar_documentos_zip(ids: list = None, filtro: dict = None, format: str = "pdf", type: str = "issued",
+                             handle: str = None) -> dict:
+    """
+    Descarga varios documentos en paralelo (acotado a DESCARGA_MASIVA_CONCURRENCIA)
+    y los va escribiendo en un solo ZIP en disco conforme terminan.
+    Recibe una lista de ids, un filtro de consultar_facturas o el handle de una consulta previa.
+    Devuelve {"archivo", "nombre", "incluidos", "fallidos"}; si no hay nada que
+    comprimir, "archivo" es None y "mensaje" explica por qué.
+    """
+    ids = list(ids or [])
+    facturas = []
+    if handle:
+        facturas += lista_de_facturas(obtener_resultado(handle))
+    if filtro:
+        filtro = {k: v for k, v in filtro.items() if k not in _PARAMS_PAGINADO}
+        facturas += lista_de_facturas(consultar_facturas({**filtro, "type": filtro.get("type", type)}))
+    ids += [f.get("Id") for f in facturas if isinstance(f, dict) and f.get("Id")]
+    ids = list(dict.fromkeys(ids))[:DESCARGA_MASIVA_MAX]
+    if not ids:
+        return {"archivo": None, "nombre": None, "incluidos": 0, "fallidos": [],
+                "mensaje": "No hay facturas que descargar con esos criterios."}
+
+    os.makedirs(DESCARGAS_DIR, exist_ok=True)
+    nombre = f"facturas_{format}.zip"
+    ruta = os.path.join(DESCARGAS_DIR, f"{uuid.uuid4()}_{nombre}")
+    fd, temporal = tempfile.mkstemp(dir=DESCARGAS_DIR, prefix=".tmp-", suffix=".zip")
+    os.close(fd)
+
+    incluidos, fallidos = [], []
+    try:
+        # zipfile no es thread-safe: las descargas van en hilos, la escritura en este
+        with zipfile.ZipFile(temporal, "w", compression=zipfile.ZIP_DEFLATED) as zf, \
+                ThreadPoolExecutor(max_workers=DESCARGA_MASIVA_CONCURRENCIA) as pool:
+            futuros = {pool.submit(obtener_documento_local, id, format, type): id for id in ids}
+            for futuro in as_completed(futuros):
+                id = futuros[futuro]
+                try:
+                    ruta_doc, nombre_doc = futuro.result()
+                    # El LRU del cache pudo desalojar el archivo entre la descarga y este punto
+                    zf.write(ruta_doc, arcname=nombre_doc)
+                except Exception as e:
+                    print(f"❌ No se pudo descargar {id}: {e}")
+                    fallidos.append(id)
+                    continue
+                incluidos.append(id)
+        if incluidos:
+            os.replace(temporal, ruta)
+            archivos_temp.registrar(ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+    if not incluidos:
+        return {"archivo": None, "nombre": None, "incluidos": 0, "fallidos": fallidos,
+                "mensaje": "No se pudo descargar ninguna de las facturas."}
+
+    print(f"🗂️ ZIP generado {ruta}: {len(incluidos)} documentos, {len(fallidos)} fallidos")
+    return {"archivo": ruta, "nombre": nombre, "incluidos": len(incluidos), "fallidos": fallidos}
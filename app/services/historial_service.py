@@ -0,0 +1,192 @@
+import os
+import json
+from typing import Any, Dict, List, Tuple
+from dotenv import load_dotenv
+from app.services.ia_service import resumir_historial
+from app.utils.bm25 import puntuar
+from app.utils.modelos_llm import MODELO_LIGERO
+from app.utils.tokens import contar_tokens, recortar_tokens
+from app.utils.redis_client import (
+    obtener_indice_historial,
+    obtener_resumen,
+    guardar_resumen,
+    actualizar_historial,
+)
+
+load_dotenv()
+
+# Presupuesto de tokens de entrada para el historial que va en cada llamada
+HISTORIAL_TOKEN_BUDGET = int(os.getenv("HISTORIAL_TOKEN_BUDGET", "3000"))
+# Entradas más recientes que nunca se compactan
+HISTORIAL_TURNOS_RECIENTES = int(os.getenv("HISTORIAL_TURNOS_RECIENTES", "6"))
+# A partir de este tamaño un resultado de función viejo se reemplaza por su digest
+DIGEST_MIN_TOKENS = int(os.getenv("HISTORIAL_DIGEST_MIN_TOKENS", "150"))
+DIGEST_MAX_IDS = 10
+# Entradas viejas relevantes (BM25) que se agregan al contexto
+HISTORIAL_TOP_K = int(os.getenv("HISTORIAL_TOP_K", "4"))
+
+# ==========================================================
+#                     ESTIMACIÓN
+# ==========================================================
+
+def estimar_tokens(texto: str) -> int:
+    """Tokens del texto con el tokenizer local (cacheado)."""
+    return contar_tokens(texto, MODELO_LIGERO)
+
+
+def tokens_mensajes(messages: List[Dict[str, str]]) -> int:
+    # ~4 tokens de overhead por mensaje en el formato de chat
+    return sum(estimar_tokens(m["content"]) + 4 for m in messages)
+
+# ==========================================================
+#                       DIGESTS
+# ==========================================================
+
+def _a_texto(content: Any) -> str:
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+
+def _parsear(content: Any) -> Any:
+    if not isinstance(content, str):
+        return content
+    try:
+        return json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        return content
+
+
+def digerir_resultado(content: Any) -> str:
+    """
+    Versión compacta de un resultado de función para turnos ya respondidos:
+    listas de facturas → conteo + ids/folios/totales; resultados de la API de
+    documentos → campos de primer nivel; texto largo → recortado.
+    """
+    texto = _a_texto(content)
+    if estimar_tokens(texto) < DIGEST_MIN_TOKENS:
+        return texto
+
+    datos = _parsear(content)
+    if isinstance(datos, list) and all(isinstance(d, dict) for d in datos):
+        resumen = []
+        for d in datos[:DIGEST_MAX_IDS]:
+            partes = [str(d.get(k)) for k in ("Id", "Serie", "Folio", "Rfc", "Total") if d.get(k) not in (None, "")]
+            resumen.append("/".join(partes))
+        extra = f" (+{len(datos) - DIGEST_MAX_IDS} más)" if len(datos) > DIGEST_MAX_IDS else ""
+        return f"[resultado resumido: {len(datos)} registros; Id/Serie/Folio/Rfc/Total: {'; '.join(resumen)}{extra}]"
+
+    if isinstance(datos, dict):
+        if "archivo_procesado" in datos:
+            resultado = datos.get("resultado")
+            claves = list(resultado.keys())[:15] if isinstance(resultado, dict) else []
+            return f"[archivo procesado: {datos['archivo_procesado']}; campos: {', '.join(claves)}]"
+        compacto = {k: v for k, v in datos.items() if not isinstance(v, (dict, list))}
+        return f"[resultado resumido: {json.dumps(compacto, ensure_ascii=False)[:600]}]"
+
+    return texto[:DIGEST_MIN_TOKENS * 4] + "…(recortado)"
+
+# ==========================================================
+#                 CONSTRUCCIÓN DEL CONTEXTO
+# ==========================================================
+
+def _tiene_archivo_pendiente(msg: Dict[str, Any]) -> bool:
+    contenido = _parsear(msg.get("content"))
+    return isinstance(contenido, dict) and bool(contenido.get("archivo"))
+
+
+def _indice_ultimo_usuario(historial: List[Dict[str, Any]]) -> int:
+    for i in range(len(historial) - 1, -1, -1):
+        if historial[i].get("role") == "user":
+            return i
+    return 0
+
+
+def _a_mensajes(historial: List[Dict[str, Any]], inicio_turno: int) -> List[Dict[str, str]]:
+    """
+    Convierte el historial al formato de OpenAI, siempre como strings.
+    Los resultados de turnos anteriores al actual van como digest.
+    """
+    messages = []
+    for i, msg in enumerate(historial):
+        es_resultado = msg["role"] != "user"
+        content = digerir_resultado(msg["content"]) if es_resultado and i < inicio_turno else _a_texto(msg["content"])
+        messages.append({
+            "role": "assistant" if msg["role"] == "assistant" else "user",
+            "content": content
+        })
+    return messages
+
+
+def _mensaje_resumen(resumen: str) -> List[Dict[str, str]]:
+    if not resumen:
+        return []
+    return [{"role": "assistant", "content": f"Resumen de la conversación anterior: {resumen}"}]
+
+
+def recuperar_relevantes(user_id: str, consulta: str, mensajes_recientes: int) -> List[Dict[str, Any]]:
+    """
+    Top-k documentos del índice BM25 del usuario más relevantes para la consulta,
+    sin contar los últimos 'mensajes_recientes' mensajes (ya van completos).
+    """
+    if HISTORIAL_TOP_K <= 0 or not consulta:
+        return []
+    documentos, df, total_mensajes = obtener_indice_historial(user_id)
+    ultimo_msg_viejo = total_mensajes - mensajes_recientes
+    relevantes, vistos = [], set()
+    for posicion, _score in puntuar(consulta, documentos, df):
+        doc = documentos[posicion]
+        if doc.get("msg", 0) > ultimo_msg_viejo or doc["texto"] in vistos:
+            continue
+        vistos.add(doc["texto"])
+        relevantes.append(doc)
+        if len(relevantes) >= HISTORIAL_TOP_K:
+            break
+    return relevantes
+
+
+def _mensaje_relevantes(relevantes: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    if not relevantes:
+        return []
+    lineas = [f"- ({d.get('rol', 'assistant')}) {d['texto']}" for d in relevantes]
+    return [{"role": "assistant", "content": "Contexto relevante de mensajes anteriores:\n" + "\n".join(lineas)}]
+
+
+async def preparar_contexto(user_id: str, historial: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]]]:
+    """
+    Devuelve (historial, messages) con tamaño acotado:
+    resumen acumulado + top-k entradas viejas relevantes (BM25 contra el último
+    mensaje del usuario) + el historial (resultados viejos como digest).
+    Si la parte vieja del historial excede HISTORIAL_TOKEN_BUDGET, se integra al
+    resumen guardado en Redis y se quita del historial (sigue en el índice):
+    quedan los turnos recientes, el turno actual y los mensajes con archivo
+    pendiente de enviar.
+    """
+    resumen = obtener_resumen(user_id)
+    inicio_turno = _indice_ultimo_usuario(historial)
+    corte = max(0, min(len(historial) - HISTORIAL_TURNOS_RECIENTES, inicio_turno))
+    pendientes = [m for m in historial[:corte] if _tiene_archivo_pendiente(m)]
+    a_compactar = [m for m in historial[:corte] if not _tiene_archivo_pendiente(m)]
+    recientes = historial[corte:]
+
+    viejos = _a_mensajes(a_compactar, len(a_compactar))
+    contexto = historial
+    if a_compactar and tokens_mensajes(viejos) > HISTORIAL_TOKEN_BUDGET:
+        nuevo_resumen = await resumir_historial(resumen, viejos, user_id=user_id)
+        if not nuevo_resumen:
+            # Sin LLM: al menos conservar los digests, acotados al presupuesto
+            nuevo_resumen = " ".join([resumen] + [m["content"] for m in viejos]).strip()
+            nuevo_resumen = recortar_tokens(nuevo_resumen, HISTORIAL_TOKEN_BUDGET, MODELO_LIGERO)
+        resumen = nuevo_resumen
+        historial = contexto = pendientes + recientes
+        guardar_resumen(user_id, resumen)
+        actualizar_historial(user_id, historial)
+        print(f"🗜️ Historial compactado para {user_id}: {len(a_compactar)} mensajes al resumen")
+
+    consulta = _a_texto(recientes[inicio_turno - corte]["content"]) if recientes else ""
+    relevantes = recuperar_relevantes(user_id, consulta, len(contexto))
+
+    messages = (
+        _mensaje_resumen(resumen)
+        + _mensaje_relevantes(relevantes)
+        + _a_mensajes(contexto, len(contexto) - len(recientes) + inicio_turno - corte)
+    )
+    return historial, messages
@@ -1,22 +1,58 @@
 import os
-import json, re
+import json
+import time
 from datetime import datetime
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from app.utils.modelos_llm import obtener_config_etapa
+from app.utils.tokens import contar_tokens_mensajes
+from app.services.esquemas_planner import (
+    PasoInvalido,
+    validar_clasificacion,
+    validar_paso,
+    validar_delta_borrador,
+)
+from app.utils.redis_client import (
+    registrar_metricas_llm,
+    registrar_uso_llm,
+    obtener_tokens_usados_hoy,
+)
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Cliente async: si el turno se cancela (mensaje nuevo del usuario) la petición HTTP se aborta
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-async def preguntar_a_openai(messages, max_tokens, temperature):
-    """Consulta genérica a OpenAI con historial de mensajes"""
+# Tokens (entrada + salida) por usuario por día; 0 = sin límite
+LIMITE_TOKENS_DIARIO_USUARIO = int(os.getenv("LIMITE_TOKENS_DIARIO_USUARIO", "0"))
+# crear_factura se arma turno a turno en un borrador (borrador_factura_service)
+# en lugar de reconstruir el payload completo con el prompt grande
+BORRADOR_FACTURA_ACTIVO = os.getenv("BORRADOR_FACTURA_ACTIVO", "true").lower() == "true"
+
+class PresupuestoTokensExcedido(Exception):
+    """El usuario ya consumió su presupuesto diario de tokens."""
+
+async def preguntar_a_openai(messages, temperature=0.1, etapa="default", max_tokens=None, user_id=None,
+                             formato_json=False, funcion=None):
+    """
+    Consulta genérica a OpenAI con historial de mensajes.
+    El modelo, max_tokens y timeout salen de la tabla de ruteo por etapa;
+    la latencia y los tokens usados se registran por etapa y usuario, y por
+    función cuando se conoce (`funcion`, o la de 'parametrizar:<funcion>').
+    Con formato_json=True se usa JSON mode (la respuesta siempre es un objeto JSON).
+    Lanza PresupuestoTokensExcedido antes de llamar si el usuario ya no tiene presupuesto.
+    """
+    config = obtener_config_etapa(etapa)
+    if funcion is None and etapa.startswith("parametrizar:"):
+        funcion = etapa.split(":", 1)[1]
+    fecha_actual = datetime.now().strftime("%Y-%m-%d")
+    inicio = time.perf_counter()
     try:
-        fecha_actual = datetime.now().strftime("%Y-%m-%d")
         system_prompt = {
             "role": "system",
             "content": (
                 f"Eres un asistente de WhatsApp que puede orquestar múltiples servicios:\n"
-                f"- FACTURACIÓN (consultar_facturas, descargar_documento, crear_factura)\n"
+                f"- FACTURACIÓN (consultar_facturas, descargar_documento, descargar_documentos_zip, analizar_facturas, buscar_catalogo_sat, crear_factura)\n"
                 f"- WHATSAPP (responder al usuario de forma humanizada)\n"
                 f"La fecha actual es {fecha_actual}.\n"
                 "Siempre analiza el historial y los roles (assistant, user, etc) para enteder el contexto y decide el siguiente paso a ejecutar.\n"
@@ -25,25 +61,97 @@ async def preguntar_a_openai(messages, max_tokens, temperature):
             )
         }
         all_messages = [system_prompt] + messages
-        response = client.chat.completions.create(
-            model="gpt-4o",
+
+        # Conteo local antes de llamar: sirve para el presupuesto y para comparar con el real
+        tokens_estimados = contar_tokens_mensajes(all_messages, config["modelo"])
+        if user_id and LIMITE_TOKENS_DIARIO_USUARIO:
+            usados = obtener_tokens_usados_hoy(user_id, fecha_actual)
+            if usados + tokens_estimados > LIMITE_TOKENS_DIARIO_USUARIO:
+                raise PresupuestoTokensExcedido(
+                    f"{user_id}: {usados} usados + {tokens_estimados} estimados > {LIMITE_TOKENS_DIARIO_USUARIO}"
+                )
+
+        response = await client.with_options(timeout=config["timeout"]).chat.completions.create(
+            model=config["modelo"],
             messages=all_messages,
-            max_tokens=max_tokens,
-            temperature=temperature
+            max_tokens=max_tokens or config["max_tokens"],
+            temperature=temperature,
+            **({"response_format": {"type": "json_object"}} if formato_json else {})
+        )
+        usage = response.usage
+        registrar_metricas_llm(
+            etapa,
+            config["modelo"],
+            (time.perf_counter() - inicio) * 1000,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+        )
+        registrar_uso_llm(
+            user_id or "anonimo",
+            etapa,
+            funcion,
+            fecha_actual,
+            prompt_tokens=usage.prompt_tokens if usage else tokens_estimados,
+            completion_tokens=usage.completion_tokens if usage else 0,
         )
         return response.choices[0].message.content.strip()
+    except PresupuestoTokensExcedido:
+        raise
     except Exception as e:
-        print(f"Error en OpenAI: {e}")
+        print(f"Error en OpenAI ({etapa}/{config['modelo']}): {e}")
+        registrar_metricas_llm(etapa, config["modelo"], (time.perf_counter() - inicio) * 1000, error=True)
+        return None
+
+async def _obtener_paso_valido(messages, temperature, etapa, validar, user_id=None, funcion=None):
+    """
+    Pide el paso en JSON mode y lo valida antes de devolverlo.
+    Si no es válido hace UNA llamada barata de reparación (sin historial,
+    sólo la respuesta y el error) en lugar de perder el turno completo.
+    La reparación se cuenta en la misma función que el paso.
+    """
+    if funcion is None and etapa.startswith("parametrizar:"):
+        funcion = etapa.split(":", 1)[1]
+    respuesta = await preguntar_a_openai(messages, temperature, etapa=etapa, user_id=user_id, formato_json=True,
+                                         funcion=funcion)
+    if respuesta is None:
+        return None
+    try:
+        return validar(respuesta)
+    except PasoInvalido as e:
+        print(f"⚠️ Paso inválido ({etapa}): {e}. Intentando reparar...")
+        error = e
+
+    prompt = f"""
+    Esta respuesta debía ser un JSON válido para el paso '{etapa}' pero no lo es.
+    Error: {error}
+    Respuesta: {respuesta}
+
+    Corrige SOLO lo necesario para que cumpla el formato y devuelve SOLO el JSON.
+    No inventes datos: conserva los valores que ya tiene.
+    """
+    reparada = await preguntar_a_openai(
+        [{"role": "user", "content": prompt}],
+        temperature=0,
+        etapa="reparar_json",
+        max_tokens=obtener_config_etapa(etapa)["max_tokens"],
+        user_id=user_id,
+        formato_json=True,
+        funcion=funcion,
+    )
+    try:
+        return validar(reparada)
+    except PasoInvalido as e:
+        print(f"⚠️ Reparación fallida ({etapa}): {e}")
         return None
 
-async def clasificar_siguiente_paso(historial):
+async def clasificar_siguiente_paso(historial, user_id=None):
     """
     Dado el historial completo (usuario + resultados de funciones),
     indica el siguiente servicio y función a ejecutar.
     Formato esperado:
     {
       "servicio": "FACTURACION" | "WHATSAPP",
-      "funcion": "consultar_facturas" | "descargar_documento" | "crear_factura" | "respuesta_final",
+      "funcion": "consultar_facturas" | "descargar_documento" | "descargar_documentos_zip" | "analizar_facturas" | "buscar_catalogo_sat" | "crear_factura" | "respuesta_final",
       "params": { ... }
     }
     """
@@ -53,6 +161,9 @@ async def clasificar_siguiente_paso(historial):
     - FACTURACION:
         consultar_facturas: Obtienes un JSON con los datos de factura/s
         descargar_documento: Obtienes el tipo de archivo (pdf o xml) con el id de la factura
+        descargar_documentos_zip: Obtienes un ZIP con varias facturas (lista de ids o un filtro como en consultar_facturas), en un solo paso
+        analizar_facturas: Obtienes totales ya calculados (sumas, conteos, impuestos, top clientes, por mes) de las facturas de un filtro. Usala para preguntas de cuanto/total/top en lugar de sumar tu
+        buscar_catalogo_sat: Obtienes claves candidatas de un catalogo del SAT (ProductCode, UnitCode, CfdiUse, FiscalRegime, PaymentForm) para una descripcion. Usala antes de crear_factura si no conoces la clave exacta
         crear_factura: Funcion para emitir una factura. IMPORTANTE! solicita toda la informacion al cliente: 1. Partidas de lo que se va a facturar, 2. Datos fiscales del receptor (considera las obligaciones fiscales del receptor para emitir correctamente la factura, impuestos a doc a sus obligaciones), 3. Tipo de factura, 4. Forma de pago, etc. 
     - WHATSAPP:
         respuesta_final: Funcion para mandar mensaje al usuario.
@@ -64,18 +175,12 @@ async def clasificar_siguiente_paso(historial):
     }
     """
     messages = historial + [{"role": "user", "content": prompt}]
-    max_tokens=50
-    temperature=0.1
-    respuesta = await preguntar_a_openai(messages, max_tokens, temperature)
+    etapa = "clasificar"
+    temperature = 0.1
 
-    # Buscar cualquier objeto JSON en la respuesta
-    match = re.search(r'(\{[\s\S]*\})', respuesta)
-    if match:
-        bloque = match.group(1)
+    siguiente = await _obtener_paso_valido(messages, temperature, etapa, validar_clasificacion, user_id)
+    if siguiente:
         try:
-            siguiente = json.loads(bloque)
-            if not siguiente:
-                return None
             servicio = (siguiente.get("servicio") or "").upper()
             funcion = siguiente.get("funcion", "")
 
@@ -97,6 +202,8 @@ async def clasificar_siguiente_paso(historial):
                                 dateStart: fecha de inicio de la factura
                                 dateEnd: fecha final de la factura
                                 status: all/active/canceled/pending estado de la factura del CFDI
+                                pagina: numero de pagina del resultado (default 1)
+                                handle: handle de una consulta anterior del historial, para ver otra pagina sin repetir filtros
 
                     Devuelve SOLO un JSON con:
                     {
@@ -105,7 +212,7 @@ async def clasificar_siguiente_paso(historial):
                     "params": { ... }
                     }
                     """
-                    max_tokens = 150
+                    etapa = "parametrizar:consultar_facturas"
                     temperature = 0.1
                 if funcion == "descargar_documento":
                     """
@@ -128,8 +235,86 @@ async def clasificar_siguiente_paso(historial):
                     "params": { ... }
                     }
                     """
-                    max_tokens = 100
+                    etapa = "parametrizar:descargar_documento"
                     temperature = 0.1
+                if funcion == "descargar_documentos_zip":
+                    """
+                    Cargar prompt de descarga masiva con datos especificos para que openai tenga mas claridad sobre la accion a ejecutar
+                    """
+                    prompt = """
+                    Ejecuta la funcion con los paremtros necesarios para cumplir con este paso solicitado de acuerdo al historial del asistente.
+                    Servicio que requieres:
+                    - FACTURACION:
+                        descargar_documentos_zip(params): Obtienes un ZIP con varias facturas en un solo paso. Usa "ids" si ya conoces los ids, o "filtro" para descargar todas las que cumplan una consulta
+                            parametros:
+                                ids: lista de ids de facturas (opcional si hay filtro)
+                                filtro: mismos parametros de consultar_facturas (type, folioStart, folioEnd, rfc, dateStart, dateEnd, status)
+                                handle: handle de una consulta anterior del historial (descarga todas sus facturas)
+                                format: pdf/xml tipo de formato
+                                type: issued/recived/payroll
+
+                    Devuelve SOLO un JSON con:
+                    {
+                    "servicio": "FACTURACION",
+                    "funcion": "descargar_documentos_zip"
+                    "params": { ... }
+                    }
+                    """
+                    etapa = "parametrizar:descargar_documentos_zip"
+                    temperature = 0.1
+                if funcion == "analizar_facturas":
+                    """
+                    Cargar prompt de analitica con datos especificos para que openai tenga mas claridad sobre la accion a ejecutar
+                    """
+                    prompt = """
+                    Ejecuta la funcion con los paremtros necesarios para cumplir con este paso solicitado de acuerdo al historial del asistente.
+                    Servicio que requieres:
+                    - FACTURACION:
+                        analizar_facturas(params): Obtienes una tabla con conteo, subtotal, impuestos y total de las facturas, agrupadas si se pide. No sumes tu, usa esta funcion
+                            parametros:
+                                filtro: mismos parametros de consultar_facturas (type, folioStart, folioEnd, rfc, dateStart, dateEnd, status)
+                                handle: handle de una consulta anterior del historial (analiza todas sus facturas)
+                                agrupar_por: ninguno/rfc/mes/dia/status (rfc = por cliente)
+                                top: numero de filas a devolver (ej. top 5 clientes)
+                                orden: desc/asc (default: total de mayor a menor; por fecha si agrupas por mes/dia)
+                                incluir_canceladas: true/false (default false)
+                                type: issued/recived/payroll
+
+                    Devuelve SOLO un JSON con:
+                    {
+                    "servicio": "FACTURACION",
+                    "funcion": "analizar_facturas"
+                    "params": { ... }
+                    }
+                    """
+                    etapa = "parametrizar:analizar_facturas"
+                    temperature = 0.1
+                if funcion == "buscar_catalogo_sat":
+                    """
+                    Cargar prompt de catalogos SAT con datos especificos para que openai tenga mas claridad sobre la accion a ejecutar
+                    """
+                    prompt = """
+                    Ejecuta la funcion con los paremtros necesarios para cumplir con este paso solicitado de acuerdo al historial del asistente.
+                    Servicio que requieres:
+                    - FACTURACION:
+                        buscar_catalogo_sat(params): Obtienes claves candidatas del catalogo del SAT para una descripcion
+                            parametros:
+                                catalogo: c_ClaveProdServ (ProductCode) / c_ClaveUnidad (UnitCode) / c_UsoCFDI (CfdiUse) / c_RegimenFiscal (FiscalRegime) / c_FormaPago (PaymentForm) / c_MetodoPago / c_ObjetoImp / c_TipoDeComprobante / c_Exportacion
+                                texto: descripcion a buscar (ej. "consultoria", "hora", "gastos en general") o clave/prefijo de clave
+                                limite: numero de candidatos (default 5)
+
+                    Devuelve SOLO un JSON con:
+                    {
+                    "servicio": "FACTURACION",
+                    "funcion": "buscar_catalogo_sat"
+                    "params": { ... }
+                    }
+                    """
+                    etapa = "parametrizar:buscar_catalogo_sat"
+                    temperature = 0.1
+                if funcion == "crear_factura" and BORRADOR_FACTURA_ACTIVO:
+                    # Sin parametrizar: los datos se recolectan en el borrador del usuario
+                    return {"servicio": "FACTURACION", "funcion": "crear_factura", "params": {}, "borrador": True}
                 if funcion == "crear_factura":
                     """
                     Cargar prompt de crear factura con datos especificos para que openai tenga mas claridad sobre la accion a ejecutar
@@ -139,6 +324,8 @@ async def clasificar_siguiente_paso(historial):
                     Servicio que requieres:
                     - FACTURACION:
                         crear_factura(params): Funcion para generar factura, IMPORTANTE: siempre los parametros obligatorios son los relacionados con el tipo de factura, los de Items, los de Taxes y los de Receiver. Considera los datos del emisor: RFC=ROLE930613SC5, RAZÓN SOCIAL= EMMANUEL DE JESUS RODRIGUEZ LUEVANO, CODIGO POSTAL=20160, REGIMEN FISCAL=RESICO.
+                            Las claves (ProductCode, UnitCode, CfdiUse, FiscalRegime, PaymentForm) deben existir en los catalogos del SAT; usa las que devolvio buscar_catalogo_sat en el historial.
+                            NO calcules importes: Subtotal, Total y Base/Total de cada impuesto se calculan automaticamente. En cada Item pon Quantity, UnitPrice, Discount (si hay), TaxObject y en Taxes solo Name, Rate e IsRetention. Si omites Taxes en un Item con TaxObject 02 se aplica IVA 16% (y retencion ISR RESICO 1.25% si el receptor es persona moral).
                             ejemplo de parametros:
                                 {
                                     "NameId": 1,
@@ -1823,7 +2010,7 @@ async def clasificar_siguiente_paso(historial):
                     "params": { ... }
                     }
                     """
-                    max_tokens = 2500
+                    etapa = "parametrizar:crear_factura"
                     temperature = 0.1
             if servicio == "WHATSAPP":
                 if funcion == "respuesta_final":
@@ -1842,31 +2029,67 @@ async def clasificar_siguiente_paso(historial):
                     "funcion": "respuesta_final"
                     }
                     """
-                    max_tokens = 50
+                    etapa = "parametrizar:respuesta_final"
                     temperature = 0.1
             messages = historial + [{"role": "user", "content": prompt}]
-            respuesta = await preguntar_a_openai(messages, max_tokens, temperature)
+            return await _obtener_paso_valido(messages, temperature, etapa, validar_paso, user_id)
 
-            # Buscar cualquier objeto JSON en la respuesta
-            match = re.search(r'(\{[\s\S]*\})', respuesta)
-            if match:
-                bloque = match.group(1)
-                try:
-                    return json.loads(bloque)
-                except json.JSONDecodeError as e:
-                    print("⚠️ JSON malformado:", e)
-                    return None
-
-        except json.JSONDecodeError as e:
-            print("⚠️ JSON malformado:", e)
+        except PasoInvalido as e:
+            print("⚠️ Paso inválido:", e)
             return None
+    return None
 
 
-async def generar_respuesta_final(historial):
+async def extraer_delta_borrador(borrador, faltantes, texto_usuario, user_id=None):
+    """
+    Extrae del último mensaje sólo los cambios al borrador de factura.
+    No se envía el historial: el borrador ya resume lo acordado.
+    """
+    prompt = f"""
+    Estás llenando una factura CFDI 4.0 con el usuario. Emisor: RFC=ROLE930613SC5, REGIMEN FISCAL=RESICO.
+    Borrador actual: {json.dumps(borrador, ensure_ascii=False)}
+    Campos que faltan: {", ".join(faltantes) or "ninguno"}
+    Mensaje nuevo del usuario: "{texto_usuario}"
+
+    Devuelve SOLO un JSON con lo que este mensaje agrega o corrige:
+    {{
+      "set": {{"Receiver.Rfc": "...", "PaymentForm": "03", "Items.0.Quantity": 2}},
+      "agregar_items": [{{"Description": "...", "Quantity": 1, "UnitPrice": 100, "UnitCode": "E48", "ProductCode": "..."}}],
+      "quitar_items": [],
+      "cancelar": false,
+      "otro_tema": false
+    }}
+    Campos de "set": CfdiType, PaymentForm (clave c_FormaPago), PaymentMethod (PUE/PPD), Currency,
+    Receiver.Rfc, Receiver.Name, Receiver.CfdiUse, Receiver.FiscalRegime, Receiver.TaxZipCode,
+    Items.<n>.<Description|Quantity|UnitPrice|UnitCode|ProductCode|Discount|TaxObject>.
+    No calcules importes ni impuestos. No repitas lo que ya está en el borrador.
+    "cancelar": true si el usuario ya no quiere la factura; "otro_tema": true si el mensaje no es sobre esta factura.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    return await _obtener_paso_valido(messages, 0.1, "borrador_factura", validar_delta_borrador, user_id,
+                                      funcion="crear_factura")
+
+
+async def generar_respuesta_final(historial, user_id=None):
     """Genera la respuesta de WhatsApp con base en el historial"""
     prompt = """
     Con base en el historial, redacta una respuesta corta, amable y clara
     para enviar por WhatsApp al usuario. No repitas información técnica.
     """
     messages = historial + [{"role": "user", "content": prompt}]
-    return await preguntar_a_openai(messages, max_tokens=250, temperature=0.3)
+    return await preguntar_a_openai(messages, temperature=0.3, etapa="respuesta_final", user_id=user_id,
+                                    funcion="respuesta_final")
+
+
+async def resumir_historial(resumen_previo, mensajes, user_id=None):
+    """Integra mensajes viejos al resumen acumulado de la conversación"""
+    prompt = f"""
+    Resumen actual de la conversación:
+    {resumen_previo or "(vacío)"}
+
+    Integra al resumen los mensajes anteriores. Conserva ids de facturas, folios,
+    RFCs, montos, fechas y datos fiscales mencionados, y lo que el usuario
+    pidió o dejó pendiente. Máximo 150 palabras, sin saludos.
+    """
+    messages = mensajes + [{"role": "user", "content": prompt}]
+    return await preguntar_a_openai(messages, temperature=0.1, etapa="resumir_historial", user_id=user_id)
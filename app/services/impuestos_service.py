@@ -0,0 +1,152 @@
+import os
+import copy
+import numpy as np
+from typing import Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================================
+#          CÁLCULO DE IMPUESTOS Y TOTALES (CFDI 4.0)
+# ==========================================================
+# El LLM sólo extrae cantidades, precios y qué impuestos aplican; los importes
+# (Subtotal, Base, Total de cada impuesto y de cada partida) se calculan aquí
+# antes de enviar a Facturama, que rechaza la factura si no cuadran.
+#
+# Redondeo SAT: cada importe se redondea a 2 decimales (MXN) con redondeo
+# aritmético (mitad hacia arriba), no el redondeo bancario de round()/np.round.
+
+IVA_TASA = float(os.getenv("CFDI_IVA_TASA", "0.16"))
+# Régimen del emisor (626 = RESICO): persona física RESICO que factura a una
+# persona moral debe retener ISR 1.25%
+EMISOR_REGIMEN_FISCAL = os.getenv("CFDI_EMISOR_REGIMEN_FISCAL", "626")
+ISR_RESICO_TASA = float(os.getenv("CFDI_ISR_RESICO_TASA", "0.0125"))
+# Retención de 2/3 del IVA a personas morales (servicios profesionales, arrendamiento)
+RETENER_IVA_PERSONA_MORAL = os.getenv("CFDI_RETENER_IVA_PERSONA_MORAL", "false").lower() == "true"
+IVA_RETENCION_TASA = float(os.getenv("CFDI_IVA_RETENCION_TASA", "0.106667"))
+
+# Objeto de impuesto: 01 no objeto, 02 sí objeto, 03 sí objeto no obligado al desglose,
+# 04 sí objeto que no causa impuesto, 05 sí objeto IVA crédito PODEBI.
+# Sólo 02 recibe los impuestos por defecto; 04 y 05 llevan únicamente los indicados.
+_SIN_DESGLOSE = {"01", "03"}
+_CON_IMPUESTOS_POR_DEFECTO = {"02"}
+
+
+def redondear_sat(valores: np.ndarray, decimales: int = 2) -> np.ndarray:
+    """Redondeo aritmético (0.005 → 0.01) tolerante al error binario de float."""
+    factor = 10 ** decimales
+    valores = np.asarray(valores, dtype=float)
+    return np.sign(valores) * np.floor(np.abs(valores) * factor + 0.5 + 1e-9) / factor
+
+
+def _numero(valor: Any, default: float = 0.0) -> float:
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return default
+
+
+def _tasa(valor: Any) -> float:
+    # El modelo a veces escribe 16 en lugar de 0.16
+    tasa = _numero(valor)
+    return tasa / 100 if tasa > 1 else tasa
+
+
+def impuestos_por_defecto(receptor_rfc: str) -> List[Dict[str, Any]]:
+    """
+    Impuestos de una partida objeto de impuesto cuando no se indicaron:
+    IVA trasladado y, si el emisor es RESICO y el receptor persona moral
+    (RFC de 12 caracteres), retención de ISR (y de IVA si está configurado).
+    """
+    impuestos = [{"Name": "IVA", "Rate": IVA_TASA, "IsRetention": False}]
+    if EMISOR_REGIMEN_FISCAL == "626" and len((receptor_rfc or "").strip()) == 12:
+        impuestos.append({"Name": "ISR", "Rate": ISR_RESICO_TASA, "IsRetention": True})
+        if RETENER_IVA_PERSONA_MORAL:
+            impuestos.append({"Name": "IVA", "Rate": IVA_RETENCION_TASA, "IsRetention": True})
+    return impuestos
+
+
+def calcular_factura(datos_factura: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Devuelve (copia del payload con importes calculados, correcciones hechas).
+    Por partida: Subtotal = Cantidad × ValorUnitario; Base = Subtotal - Descuento;
+    impuesto = Base × Tasa (o Cantidad × cuota si IsQuota); Total = Base +
+    trasladados - retenidos. Todas las partidas se calculan a la vez con NumPy.
+    """
+    datos = copy.deepcopy(datos_factura)
+    items = datos.get("Items") or []
+    correcciones: List[str] = []
+    if not items:
+        return datos, correcciones
+
+    receptor_rfc = (datos.get("Receiver") or {}).get("Rfc", "")
+    for item in items:
+        objeto = str(item.get("TaxObject") or "02")
+        item["TaxObject"] = objeto
+        if objeto in _SIN_DESGLOSE:
+            if item.get("Taxes"):
+                correcciones.append(f"{item.get('Description', 'partida')}: TaxObject {objeto} no lleva impuestos")
+            item["Taxes"] = []
+        elif not item.get("Taxes"):
+            item["Taxes"] = impuestos_por_defecto(receptor_rfc) if objeto in _CON_IMPUESTOS_POR_DEFECTO else []
+
+    cantidad = np.array([_numero(i.get("Quantity")) for i in items])
+    precio = np.array([_numero(i.get("UnitPrice")) for i in items])
+    descuento = redondear_sat([_numero(i.get("Discount")) for i in items])
+    subtotal = redondear_sat(cantidad * precio)
+    base = subtotal - descuento
+
+    # Impuestos aplanados: una fila por impuesto con el índice de su partida
+    impuestos = [(n, t) for n, item in enumerate(items) for t in item["Taxes"]]
+    partida = np.array([n for n, _ in impuestos], dtype=int)
+    tasa = np.array([_tasa(t.get("Rate")) for _, t in impuestos])
+    retencion = np.array([bool(t.get("IsRetention")) for _, t in impuestos], dtype=bool)
+    cuota = np.array([bool(t.get("IsQuota")) for _, t in impuestos], dtype=bool)
+
+    base_impuesto = base[partida]
+    importe = redondear_sat(np.where(cuota, cantidad[partida] * tasa, base_impuesto * tasa))
+    trasladados = np.bincount(partida, weights=np.where(retencion, 0.0, importe), minlength=len(items))
+    retenidos = np.bincount(partida, weights=np.where(retencion, importe, 0.0), minlength=len(items))
+    total = redondear_sat(base + trasladados - retenidos)
+
+    for n, item in enumerate(items):
+        nombre = item.get("Description", f"partida {n + 1}")
+        if item.get("Subtotal") is not None and abs(_numero(item["Subtotal"]) - subtotal[n]) >= 0.01:
+            correcciones.append(f"{nombre}: Subtotal {item['Subtotal']} → {subtotal[n]:.2f}")
+        if item.get("Total") is not None and abs(_numero(item["Total"]) - total[n]) >= 0.01:
+            correcciones.append(f"{nombre}: Total {item['Total']} → {total[n]:.2f}")
+        item["Subtotal"] = float(subtotal[n])
+        if descuento[n]:
+            item["Discount"] = float(descuento[n])
+        item["Total"] = float(total[n])
+
+    for k, (n, impuesto) in enumerate(impuestos):
+        impuesto["Rate"] = float(tasa[k])
+        impuesto["Base"] = float(base_impuesto[k])
+        if impuesto.get("Total") is not None and abs(_numero(impuesto["Total"]) - importe[k]) >= 0.01:
+            correcciones.append(
+                f"{items[n].get('Description', f'partida {n + 1}')}: {impuesto.get('Name')} {impuesto['Total']} → {importe[k]:.2f}"
+            )
+        impuesto["Total"] = float(importe[k])
+        impuesto.setdefault("IsRetention", bool(retencion[k]))
+
+    return datos, correcciones
+
+
+def resumen_totales(datos_factura: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Totales del comprobante a partir de sus partidas ya calculadas:
+    {"Subtotal", "Descuento", "Trasladados", "Retenidos", "Total"}.
+    """
+    items = datos_factura.get("Items") or []
+    impuestos = [t for i in items for t in (i.get("Taxes") or [])]
+    importe = np.array([_numero(t.get("Total")) for t in impuestos])
+    retencion = np.array([bool(t.get("IsRetention")) for t in impuestos], dtype=bool)
+    resumen = {
+        "Subtotal": float(np.sum([_numero(i.get("Subtotal")) for i in items])),
+        "Descuento": float(np.sum([_numero(i.get("Discount")) for i in items])),
+        "Trasladados": float(importe[~retencion].sum()) if impuestos else 0.0,
+        "Retenidos": float(importe[retencion].sum()) if impuestos else 0.0,
+    }
+    resumen["Total"] = resumen["Subtotal"] - resumen["Descuento"] + resumen["Trasladados"] - resumen["Retenidos"]
+    return {k: round(v, 2) for k, v in resumen.items()}
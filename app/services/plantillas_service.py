@@ -0,0 +1,160 @@
+import os
+import re
+from typing import Optional, Dict, Any, Callable, List
+from app.services.enrutador_service import normalizar
+
+# Máximo de filas que se muestran en la tabla de consultar_facturas
+MAX_FILAS_TABLA = int(os.getenv("PLANTILLAS_MAX_FILAS", "10"))
+
+# Si el usuario hizo una pregunta (y no sólo pidió la lista), la redacción
+# se deja al LLM: la plantilla no sabe responder "¿cuál es la más cara?".
+_RE_PREGUNTA = re.compile(
+    r"\?|\b(cual|cuales|cuanto|cuanta|cuantos|cuantas|quien|por que|mas|menos|suma|promedio|total)\b"
+)
+
+# ==========================================================
+#                  REGISTRO DE PLANTILLAS
+# ==========================================================
+
+Plantilla = Callable[[Any, str], Optional[str]]
+PLANTILLAS: Dict[str, Plantilla] = {}
+
+
+def registrar_plantilla(funcion: str):
+    """
+    Decorador para registrar la plantilla de respuesta de una función.
+    La plantilla recibe (resultado, texto_usuario) y devuelve el texto
+    para WhatsApp, o None si el caso no es claro y debe redactarlo el LLM.
+    """
+    def decorador(plantilla: Plantilla) -> Plantilla:
+        PLANTILLAS[funcion] = plantilla
+        return plantilla
+    return decorador
+
+
+def renderizar_respuesta(funcion: Optional[str], resultado: Any, texto_usuario: str = "") -> Optional[str]:
+    """
+    Devuelve la respuesta final renderizada localmente para la última función
+    ejecutada, o None para que se use generar_respuesta_final.
+    """
+    plantilla = PLANTILLAS.get(funcion or "")
+    if not plantilla:
+        return None
+    try:
+        return plantilla(resultado, texto_usuario)
+    except Exception as e:
+        print(f"⚠️ Plantilla {funcion} falló, se usa el LLM: {e}")
+        return None
+
+# ==========================================================
+#                      UTILIDADES
+# ==========================================================
+
+def _campo(registro: Dict[str, Any], *nombres: str) -> Any:
+    """Lee un campo sin importar mayúsculas (la API no es consistente)."""
+    minusculas = {k.lower(): v for k, v in registro.items()}
+    for nombre in nombres:
+        valor = minusculas.get(nombre.lower())
+        if valor not in (None, ""):
+            return valor
+    return None
+
+
+def formatear_monto(valor: Any) -> str:
+    try:
+        return f"${float(valor):,.2f}"
+    except (TypeError, ValueError):
+        return str(valor) if valor is not None else "-"
+
+
+def _lista_facturas(resultado: Any) -> Optional[List[Dict[str, Any]]]:
+    if isinstance(resultado, list):
+        return resultado if all(isinstance(r, dict) for r in resultado) else None
+    if isinstance(resultado, dict):
+        for clave in ("facturas", "Data", "data", "items"):
+            if isinstance(resultado.get(clave), list):
+                return resultado[clave]
+    return None
+
+# ==========================================================
+#                      PLANTILLAS
+# ==========================================================
+
+@registrar_plantilla("descargar_documento")
+def plantilla_descargar_documento(resultado: Any, texto_usuario: str) -> Optional[str]:
+    if not isinstance(resultado, dict) or not resultado.get("archivo"):
+        return None
+    nombre = resultado.get("nombre") or os.path.basename(resultado["archivo"])
+    return f"Aquí tienes tu documento 📄 {nombre}"
+
+
+@registrar_plantilla("descargar_documentos_zip")
+def plantilla_descargar_documentos_zip(resultado: Any, texto_usuario: str) -> Optional[str]:
+    if not isinstance(resultado, dict):
+        return None
+    if not resultado.get("archivo"):
+        # Sin ZIP (nada que descargar o fallaron todas): se explica tal cual
+        return resultado.get("mensaje")
+    texto = f"Aquí tienes {resultado.get('incluidos', 0)} factura(s) en un ZIP 🗂️"
+    if resultado.get("fallidos"):
+        texto += f"\nNo pude descargar: {', '.join(resultado['fallidos'])}"
+    return texto
+
+
+@registrar_plantilla("consultar_facturas")
+def plantilla_consultar_facturas(resultado: Any, texto_usuario: str) -> Optional[str]:
+    if _RE_PREGUNTA.search(normalizar(texto_usuario)):
+        return None
+    facturas = _lista_facturas(resultado)
+    if facturas is None:
+        return None
+    if not facturas:
+        return "No encontré facturas con esos filtros."
+
+    total = resultado.get("total", len(facturas)) if isinstance(resultado, dict) else len(facturas)
+    lineas = [f"Encontré {total} factura(s):"]
+    for f in facturas[:MAX_FILAS_TABLA]:
+        serie = _campo(f, "Serie") or ""
+        folio = _campo(f, "Folio") or "s/f"
+        fecha = str(_campo(f, "Date", "Fecha") or "")[:10]
+        receptor = _campo(f, "TaxName", "Name", "Rfc") or ""
+        monto = formatear_monto(_campo(f, "Total"))
+        estado = _campo(f, "Status") or ""
+        lineas.append(f"• {serie}{folio} | {fecha} | {receptor} | {monto} | {estado}".rstrip(" |"))
+    if total > min(len(facturas), MAX_FILAS_TABLA):
+        lineas.append(f"…y {total - min(len(facturas), MAX_FILAS_TABLA)} más.")
+    return "\n".join(lineas)
+
+
+@registrar_plantilla("analizar_facturas")
+def plantilla_analizar_facturas(resultado: Any, texto_usuario: str) -> Optional[str]:
+    if not isinstance(resultado, dict) or "totales" not in resultado:
+        return None
+    totales = resultado["totales"]
+    if not totales.get("facturas"):
+        return "No encontré facturas con esos filtros."
+
+    resumen = f"{totales['facturas']} factura(s) por {formatear_monto(totales.get('total'))}"
+    if totales.get("impuestos") is not None:
+        resumen += f" (subtotal {formatear_monto(totales.get('subtotal'))}, impuestos {formatear_monto(totales['impuestos'])})"
+    if resultado.get("canceladas_excluidas"):
+        resumen += ", sin canceladas"
+    if resultado.get("agrupado_por", "ninguno") == "ninguno":
+        return f"Total: {resumen}."
+
+    lineas = [f"Total: {resumen}. Por {resultado['agrupado_por']}:"]
+    for fila in resultado.get("filas", []):
+        etiqueta = fila["clave"] + (f" {fila['nombre']}" if fila.get("nombre") else "")
+        lineas.append(f"• {etiqueta} | {fila['facturas']} | {formatear_monto(fila.get('total'))}")
+    if resultado.get("grupos", 0) > len(resultado.get("filas", [])):
+        lineas.append(f"…y {resultado['grupos'] - len(resultado['filas'])} más.")
+    return "\n".join(lineas)
+
+
+@registrar_plantilla("crear_factura")
+def plantilla_crear_factura(resultado: Any, texto_usuario: str) -> Optional[str]:
+    if not isinstance(resultado, dict) or not _campo(resultado, "Id"):
+        return None
+    folio = f"{_campo(resultado, 'Serie') or ''}{_campo(resultado, 'Folio') or ''}" or "sin folio"
+    total = formatear_monto(_campo(resultado, "Total"))
+    return f"✅ Factura emitida. Folio: {folio}, total {total}. Id: {_campo(resultado, 'Id')}"
@@ -2,66 +2,115 @@ import os
 import uuid
 import json
 import base64
+import hashlib
 import asyncio
+import contextvars
 import requests
 from typing import Optional, Dict, Any
 from dotenv import load_dotenv
 from app.services.facturacion_service import (
-    consultar_facturas,
-    descargar_documento,
+    consultar_facturas_paginado,
+    abrir_documento,
+    descargar_documentos_zip,
     crear_factura
 )
+from app.utils.cache_documentos import es_archivo_en_cache
 from app.services.ia_service import (
     clasificar_siguiente_paso,
-    generar_respuesta_final
+    generar_respuesta_final,
+    PresupuestoTokensExcedido
 )
+from app.services.analitica_service import analizar_facturas
+from app.services.borrador_factura_service import atender_borrador, hay_borrador
+from app.services.emision_masiva_service import es_archivo_lote, iniciar_lote, reanudar_lotes
+from app.utils.catalogos_sat import buscar_en_catalogo
+from app.utils.almacen_archivos import guardar_archivo, eliminar_archivo
+from app.utils import archivos_temp
+from app.services.documentos_service import procesar_documento
+from app.services.enrutador_service import enrutar_mensaje
+from app.services.plantillas_service import renderizar_respuesta
+from app.services.historial_service import preparar_contexto
 
 from app.utils.redis_client import (
     agregar_mensaje_historial,
     obtener_historial,
     actualizar_historial,
     enqueue_user_message,
+    enqueue_user_message_once,
+    mensaje_ya_visto,
     dequeue_user_message,
+    peek_user_messages,
+    peek_next_user_message,
     get_queue_length,
     acquire_user_lock,
     release_user_lock,
     refresh_user_lock,
+    iniciar_turno,
+    reclamar_efecto_turno,
+    cancelar_turno,
+    turno_con_efectos,
 )
 
-TEMP_FOLDER = "archivos_temp"
+TEMP_FOLDER = archivos_temp.ARCHIVOS_TEMP_DIR
 os.makedirs(TEMP_FOLDER, exist_ok=True)
 
 load_dotenv()
 
+# Cancelar el turno en curso si llega otro texto del usuario antes de cualquier efecto
+SUPERSESION_ACTIVA = os.getenv("SUPERSESION_ACTIVA", "true").lower() == "true"
+SUPERSESION_INTERVALO_SEGUNDOS = float(os.getenv("SUPERSESION_INTERVALO_SEGUNDOS", "0.3"))
+# Vida del estado del turno en Redis (igual que el lock del usuario)
+SUPERSESION_TURNO_TTL_SEGUNDOS = int(os.getenv("SUPERSESION_TURNO_TTL_SEGUNDOS", "300"))
+
+# Archivos consecutivos de un mismo usuario que se procesan en paralelo
+ARCHIVOS_CONCURRENCIA = int(os.getenv("ARCHIVOS_CONCURRENCIA", "4"))
+
 BAILEYS_API_URL = os.getenv("BAILEYS_API_URL", "http://localhost:3000/api/respuesta")
-DOCUMENTS_API_URL = os.getenv("DOCUMENTS_API_URL", "https://api-documentos-577166035685.us-central1.run.app/process-file")
+
+# Reintentos del webhook: un mensaje ya encolado no se vuelve a encolar.
+# Con X-Message-Id se recuerda un día. Sin él, opcionalmente, el hash del
+# contenido más la hora de envío (X-Message-Timestamp) en una ventana corta.
+# Apagado por omisión: sin la hora, un "sí" repetido a propósito (p. ej. para
+# reintentar una factura) se tomaría como reintento del proveedor.
+WEBHOOK_DEDUP_ACTIVO = os.getenv("WEBHOOK_DEDUP_ACTIVO", "true").lower() == "true"
+WEBHOOK_DEDUP_TTL_SEGUNDOS = int(os.getenv("WEBHOOK_DEDUP_TTL_SEGUNDOS", str(24 * 3600)))
+WEBHOOK_DEDUP_POR_CONTENIDO = os.getenv("WEBHOOK_DEDUP_POR_CONTENIDO", "false").lower() == "true"
+WEBHOOK_DEDUP_TTL_CONTENIDO_SEGUNDOS = int(os.getenv("WEBHOOK_DEDUP_TTL_CONTENIDO_SEGUNDOS", "120"))
 
 # ==========================================================
 #            RETORNA MENSAJE PROCESADO A WHATSAPP
 # ==========================================================
 
-def enviar_respuesta_a_whatsapp(to: str, mensaje: str = None, ruta_archivo: str = None):
+def enviar_respuesta_a_whatsapp(to: str, mensaje: str = None, ruta_archivo: str = None, archivo=None):
     """
     Envía mensajes o archivos a WhatsApp vía Baileys.
     
     :param to: ID del destinatario (ej. "5214492764608@s.whatsapp.net")
     :param mensaje: Texto a enviar
     :param ruta_archivo: Ruta local del archivo a enviar (ej. "archivos_temp/factura.pdf")
+    :param archivo: Archivo ya abierto en modo binario (p. ej. un ArchivoTemporal en memoria);
+                    el nombre se toma de su atributo `nombre` o `name`
     """
+    _marcar_efecto(to)
     try:
         headers = {
             "X-To": to
         }
 
-        if mensaje and not ruta_archivo:
+        if mensaje and not ruta_archivo and archivo is None:
             # Solo texto
             headers["Content-Type"] = "text/plain"
             response = requests.post(BAILEYS_API_URL, data=mensaje.encode("utf-8"), headers=headers)
 
-        elif ruta_archivo:
+        elif ruta_archivo or archivo is not None:
             # Archivo (documento, imagen, etc.)
+            if ruta_archivo:
+                nombre = os.path.basename(ruta_archivo)
+            else:
+                nombre = getattr(archivo, "nombre", None) or os.path.basename(str(getattr(archivo, "name", "archivo")))
+
             mime_type = "application/octet-stream"
-            ext = os.path.splitext(ruta_archivo)[1].lower()
+            ext = os.path.splitext(nombre)[1].lower()
 
             if ext in [".pdf"]:
                 mime_type = "application/pdf"
@@ -69,15 +118,22 @@ def enviar_respuesta_a_whatsapp(to: str, mensaje: str = None, ruta_archivo: str
                 mime_type = "image/jpeg"
             elif ext in [".png"]:
                 mime_type = "image/png"
+            elif ext in [".zip"]:
+                mime_type = "application/zip"
 
             headers["Content-Type"] = mime_type
-            headers["X-Filename"] = os.path.basename(ruta_archivo)
+            headers["X-Filename"] = nombre
 
-            with open(ruta_archivo, "rb") as f:
-                response = requests.post(BAILEYS_API_URL, data=f.read(), headers=headers)
+            # El cuerpo se manda leyendo del archivo, sin copiarlo antes a un bytes
+            if ruta_archivo:
+                with archivos_temp.en_uso(ruta_archivo), open(ruta_archivo, "rb") as f:
+                    response = requests.post(BAILEYS_API_URL, data=f, headers=headers)
+            else:
+                archivo.seek(0)
+                response = requests.post(BAILEYS_API_URL, data=archivo, headers=headers)
 
         else:
-            raise ValueError("Debes especificar un mensaje o una ruta de archivo.")
+            raise ValueError("Debes especificar un mensaje, una ruta de archivo o un archivo abierto.")
 
         response.raise_for_status()
         print(f"✅ Enviado a WhatsApp ({to})")
@@ -91,13 +147,54 @@ def enviar_respuesta_a_whatsapp(to: str, mensaje: str = None, ruta_archivo: str
 #                 UTILIDADES INTERNAS
 # ==========================================================
 
+# (user_id, id del turno) del turno cancelable en curso. asyncio.to_thread
+# copia el contexto, así que también lo ven las llamadas que corren en hilos.
+# El estado (activo / efectos / cancelado) vive en Redis junto al lock: un
+# turno con efectos visibles (mensaje enviado, factura emitida) ya no se
+# cancela, y uno cancelado ya no puede tener efectos.
+_turno_actual: contextvars.ContextVar = contextvars.ContextVar("turno_actual", default=None)
+
+class TurnoCancelado(BaseException):
+    """
+    El turno fue reemplazado por un mensaje más reciente: no debe tener efectos.
+    Como CancelledError, no hereda de Exception para que los `except Exception`
+    del pipeline (p. ej. al emitir) no lo traguen.
+    """
+
+def _marcar_efecto(user_id: str) -> None:
+    """
+    Llamar antes de cada efecto visible. Fuera de un turno cancelable (avisos
+    de lotes, supersesión apagada) no hace nada; si el turno ya fue cancelado
+    lanza TurnoCancelado y el efecto no ocurre.
+    """
+    turno = _turno_actual.get()
+    if turno is None or turno[0] != user_id:
+        return
+    if not reclamar_efecto_turno(user_id, turno[1], SUPERSESION_TURNO_TTL_SEGUNDOS):
+        raise TurnoCancelado(f"Turno {turno[1]} de {user_id} cancelado")
+
+def _descartar_pasos_del_turno(user_id: str) -> None:
+    """Quita del historial los resultados del turno cancelado (conserva los mensajes del usuario)."""
+    historial = obtener_historial(user_id)
+    while historial and historial[-1].get("role") != "user":
+        historial.pop()
+    actualizar_historial(user_id, historial)
+
 def marcar_archivo_usado(historial, archivo_path):
-    """Elimina el archivo y lo marca como usado en el historial"""
-    if os.path.exists(archivo_path):
-        os.remove(archivo_path)
+    """
+    Marca el archivo como ya enviado: su marcador "archivo" en el historial
+    queda en None para que ninguna respuesta_final posterior lo reenvíe.
+    El contenido de los mensajes se guarda como texto JSON.
+    """
     for msg in historial:
-        if isinstance(msg["content"], dict) and msg["content"].get("archivo") == archivo_path:
-            msg["content"]["archivo"] = None
+        content = msg.get("content")
+        try:
+            contenido = json.loads(content) if isinstance(content, str) else content
+        except ValueError:
+            continue
+        if isinstance(contenido, dict) and contenido.get("archivo") == archivo_path:
+            contenido["archivo"] = None
+            msg["content"] = json.dumps(contenido, ensure_ascii=False) if isinstance(content, str) else contenido
     return historial
 
 def enviar_archivo_por_whatsapp(x_from: str, archivo_path: str, filename: str):
@@ -121,14 +218,83 @@ async def _procesar_evento(user_id: str, event: Dict[str, Any]) -> Optional[Dict
 
     etype = event.get("type")
     if etype == "text":
-        return await procesar_mensaje_texto(user_id, event.get("content", ""))
+        try:
+            return await procesar_mensaje_texto(user_id, event.get("content", ""))
+        except PresupuestoTokensExcedido as e:
+            print(f"⛔ Presupuesto de tokens agotado: {e}")
+            respuesta = "Alcanzaste el límite de uso de hoy. Intenta de nuevo mañana."
+            enviar_respuesta_a_whatsapp(to=user_id, mensaje=respuesta)
+            return {"status": "limite", "respuesta": respuesta}
     elif etype == "file":
-        file_bytes = base64.b64decode(event.get("base64", ""))
-        return await procesar_archivo(user_id, event.get("filename", "archivo"), file_bytes)
+        filename = event.get("filename", "archivo")
+        ruta = event.get("ruta")
+        if not ruta:
+            # Evento encolado antes de guardar los archivos en disco
+            ruta = guardar_archivo(filename, base64.b64decode(event.get("base64", "")))
+        try:
+            with archivos_temp.en_uso(ruta):
+                return await procesar_archivo(user_id, filename, ruta, sha256=event.get("sha256"))
+        finally:
+            eliminar_archivo(ruta)
     else:
         print(f"[WARN] Evento no soportado para {user_id}: {event}")
         return None
 
+def _hay_texto_nuevo(user_id: str) -> bool:
+    return any(isinstance(e, dict) and e.get("type") == "text" for e in peek_user_messages(user_id))
+
+async def _procesar_evento_cancelable(user_id: str, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Procesa un texto vigilando la cola: si llega otro texto del usuario y el turno
+    aún no tiene efectos (nada enviado, nada emitido), se cancela el turno en
+    Redis y luego la tarea. Lo que siga corriendo en hilos ya no puede enviar ni
+    emitir. El turno se reinicia con el siguiente mensaje, que verá el historial combinado.
+    """
+    turno_id = uuid.uuid4().hex
+    iniciar_turno(user_id, turno_id, SUPERSESION_TURNO_TTL_SEGUNDOS)
+    ficha = _turno_actual.set((user_id, turno_id))
+    try:
+        tarea = asyncio.create_task(_procesar_evento(user_id, event))
+    finally:
+        _turno_actual.reset(ficha)
+
+    while True:
+        done, _ = await asyncio.wait({tarea}, timeout=SUPERSESION_INTERVALO_SEGUNDOS)
+        if done:
+            try:
+                return tarea.result()
+            except TurnoCancelado:
+                # Se canceló desde otro lado justo antes de un efecto
+                _descartar_pasos_del_turno(user_id)
+                return {"status": "superseded"}
+        if turno_con_efectos(user_id, turno_id) or not _hay_texto_nuevo(user_id):
+            continue
+        if not cancelar_turno(user_id, turno_id):
+            # Alcanzó a reclamar un efecto: el turno termina normalmente
+            continue
+
+        tarea.cancel()
+        try:
+            await tarea
+        except (asyncio.CancelledError, TurnoCancelado):
+            pass
+        _descartar_pasos_del_turno(user_id)
+        print(f"⏭️ Turno de {user_id} reemplazado por un mensaje más reciente")
+        return {"status": "superseded"}
+
+def _es_archivo(event: Any) -> bool:
+    return isinstance(event, dict) and event.get("type") == "file"
+
+def _tomar_archivos_consecutivos(user_id: str, primero: Dict[str, Any], limite: int) -> list:
+    """
+    Saca de la cola los archivos que siguen a `primero` (hasta ARCHIVOS_CONCURRENCIA
+    en total); se detiene en el primer texto para no adelantarlo.
+    """
+    eventos = [primero]
+    while len(eventos) < min(ARCHIVOS_CONCURRENCIA, limite) and _es_archivo(peek_next_user_message(user_id)):
+        eventos.append(dequeue_user_message(user_id))
+    return eventos
+
 async def run_user_queue_worker(user_id: str, max_to_process: int = 20, lock_ttl: int = 300) -> None:
     """
     Toma un lock por usuario y procesa eventos de la cola en orden (FIFO).
@@ -153,8 +319,22 @@ async def run_user_queue_worker(user_id: str, max_to_process: int = 20, lock_ttl
             # Mantener vivo el lock por si el pipeline tarda
             refresh_user_lock(user_id, ttl_seconds=lock_ttl)
 
+            if _es_archivo(event):
+                # Varios archivos seguidos (p. ej. un envío múltiple) son independientes: en paralelo
+                eventos = _tomar_archivos_consecutivos(user_id, event, max_to_process - processed)
+                resultados = await asyncio.gather(*(_procesar_evento(user_id, e) for e in eventos), return_exceptions=True)
+                for resultado in resultados:
+                    if isinstance(resultado, Exception):
+                        print(f"❌ Error procesando archivo de {user_id}: {resultado}")
+                processed += len(eventos)
+                await asyncio.sleep(0)
+                continue
+
             try:
-                await _procesar_evento(user_id, event)
+                if SUPERSESION_ACTIVA and isinstance(event, dict) and event.get("type") == "text":
+                    await _procesar_evento_cancelable(user_id, event)
+                else:
+                    await _procesar_evento(user_id, event)
             except Exception as e:
                 # Loguear y continuar con el siguiente, NO queremos frenar la cola completa por un fallo
                 print(f"❌ Error procesando evento de {user_id}: {e}")
@@ -172,25 +352,67 @@ async def run_user_queue_worker(user_id: str, max_to_process: int = 20, lock_ttl
 #         ENTRADAS PÚBLICAS (WEBHOOK / ROUTES)
 # ==========================================================
 
-async def recibir_mensaje_texto(x_from: str, texto_usuario: str) -> Dict[str, Any]:
+def _llave_entrega(id_mensaje: Optional[str], *contenido: str, marca_tiempo: Optional[str] = None) -> Optional[tuple]:
+    """
+    (id de la entrega, TTL) para deduplicar: X-Message-Id si viene, si no el
+    hash del contenido y la hora de envío. None si no se deduplica.
+    """
+    if not WEBHOOK_DEDUP_ACTIVO:
+        return None
+    if id_mensaje and id_mensaje.strip():
+        return f"id:{id_mensaje.strip()}", WEBHOOK_DEDUP_TTL_SEGUNDOS
+    if WEBHOOK_DEDUP_POR_CONTENIDO:
+        h = hashlib.sha256("\n".join((marca_tiempo or "",) + contenido).encode("utf-8")).hexdigest()
+        return f"sha256:{h}", WEBHOOK_DEDUP_TTL_CONTENIDO_SEGUNDOS
+    return None
+
+def _encolar(x_from: str, mensaje: Dict[str, Any], entrega: Optional[tuple]) -> Optional[int]:
+    """Encola (marcando la entrega como vista). Devuelve el largo de la cola, o None si es duplicado."""
+    if entrega is None:
+        enqueue_user_message(x_from, mensaje)
+        return get_queue_length(x_from)
+    id_entrega, ttl = entrega
+    return enqueue_user_message_once(x_from, mensaje, id_entrega, ttl)
+
+def entrega_repetida(x_from: str, id_mensaje: Optional[str]) -> bool:
+    """
+    True si el X-Message-Id ya se encoló: el webhook contesta sin leer el
+    cuerpo (útil con archivos grandes). La marca definitiva se pone al encolar.
+    """
+    entrega = _llave_entrega(id_mensaje) if id_mensaje else None
+    return bool(entrega) and mensaje_ya_visto(x_from, entrega[0])
+
+async def recibir_mensaje_texto(x_from: str, texto_usuario: str, id_mensaje: Optional[str] = None,
+                                marca_tiempo: Optional[str] = None) -> Dict[str, Any]:
     """
     Punto de entrada cuando Baileys/WhatsApp entrega un texto.
-    Encola y dispara un worker breve para drenar.
+    Encola y dispara un worker breve para drenar. Una reentrega del mismo
+    mensaje se reconoce y no se vuelve a procesar.
     """
-    enqueue_user_message(x_from, {"type": "text", "content": texto_usuario})
-    queue_size = get_queue_length(x_from)
+    entrega = _llave_entrega(id_mensaje, "text", texto_usuario, marca_tiempo=marca_tiempo)
+    queue_size = _encolar(x_from, {"type": "text", "content": texto_usuario}, entrega)
+    if queue_size is None:
+        print(f"♻️ Mensaje repetido de {x_from} ({entrega[0][:20]}), se ignora")
+        return {"status": "duplicate"}
     # Dispara un worker "rápido" para drenar en este request (si es posible)
     asyncio.create_task(run_user_queue_worker(x_from))
     return {"status": "queued", "queued_items": queue_size}
 
-async def recibir_archivo(x_from: str, filename: str, file_bytes: bytes) -> Dict[str, Any]:
+async def recibir_archivo(x_from: str, filename: str, ruta: str, sha256: Optional[str] = None,
+                          tamano: Optional[int] = None, id_mensaje: Optional[str] = None,
+                          marca_tiempo: Optional[str] = None) -> Dict[str, Any]:
     """
-    Punto de entrada cuando Baileys/WhatsApp entrega un archivo.
-    Encola y dispara un worker breve para drenar.
+    Punto de entrada cuando Baileys/WhatsApp entrega un archivo (ya guardado
+    en disco por el webhook). Encola su referencia y dispara un worker breve para drenar.
+    Si es una reentrega se borra la copia recién guardada.
     """
-    file_base64 = base64.b64encode(file_bytes).decode("utf-8")
-    enqueue_user_message(x_from, {"type": "file", "filename": filename, "base64": file_base64})
-    queue_size = get_queue_length(x_from)
+    entrega = _llave_entrega(id_mensaje, "file", filename, sha256 or ruta, marca_tiempo=marca_tiempo)
+    mensaje = {"type": "file", "filename": filename, "ruta": ruta, "sha256": sha256, "bytes": tamano}
+    queue_size = _encolar(x_from, mensaje, entrega)
+    if queue_size is None:
+        print(f"♻️ Archivo repetido de {x_from} ({filename}), se ignora")
+        eliminar_archivo(ruta)
+        return {"status": "duplicate"}
     asyncio.create_task(run_user_queue_worker(x_from))
     return {"status": "queued", "queued_items": queue_size}
 
@@ -198,30 +420,72 @@ async def recibir_archivo(x_from: str, filename: str, file_bytes: bytes) -> Dict
 #        LÓGICA EXISTENTE (AHORA SECUENCIAL POR COLA)
 # ==========================================================
 
+async def _responder_borrador(x_from: str, texto_usuario: str, nuevo: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Turno de la factura en construcción: sólo el delta del mensaje va al LLM.
+    Devuelve None si el mensaje no es sobre la factura (sigue el flujo normal).
+    """
+    async def emitir(datos):
+        _marcar_efecto(x_from)
+        return await asyncio.to_thread(crear_factura, datos)
+
+    turno = await atender_borrador(x_from, texto_usuario, emitir, nuevo=nuevo)
+    if turno is None:
+        return None
+
+    respuesta = turno["respuesta"]
+    if turno["funcion"] == "crear_factura":
+        agregar_mensaje_historial(x_from, "assistant", json.dumps(turno["resultado"], ensure_ascii=False))
+        respuesta = renderizar_respuesta("crear_factura", turno["resultado"], texto_usuario) or "✅ Factura emitida."
+    agregar_mensaje_historial(x_from, "assistant", respuesta)
+    print(f"💬 Respuesta al cliente (borrador): {respuesta}")
+    enviar_respuesta_a_whatsapp(to=x_from, mensaje=respuesta)
+    return {"status": "ok", "respuesta": respuesta}
+
 async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
     """
     PROCESA **UN** MENSAJE (ya encolado y tomado por el worker).
     Mantiene compatibilidad con tu pipeline actual.
     """
+    # Documentos abiertos en este turno: en el historial sólo queda su referencia
+    # ("abierto:<id>/<nombre>"); el archivo en sí no pasa por Redis ni por disco.
+    # Se cierran al terminar el turno pase lo que pase (error, cancelación, salida temprana).
+    archivos_turno: Dict[str, Any] = {}
+    try:
+        return await _procesar_mensaje_texto(x_from, texto_usuario, archivos_turno)
+    finally:
+        for documento in archivos_turno.values():
+            documento.close()
+
+async def _procesar_mensaje_texto(x_from: str, texto_usuario: str, archivos_turno: Dict[str, Any]):
     print(f"Texto recibido de {x_from}: {texto_usuario}")
     agregar_mensaje_historial(x_from, "user", texto_usuario)
 
+    # Factura en construcción: el mensaje se aplica al borrador sin pasar por el planificador
+    if hay_borrador(x_from):
+        respuesta_borrador = await _responder_borrador(x_from, texto_usuario)
+        if respuesta_borrador:
+            return respuesta_borrador
+
+    # Ruta rápida: reglas deterministas antes del planificador LLM.
+    # Si no hay certeza, paso_forzado queda en None y decide clasificar_siguiente_paso.
+    paso_forzado = enrutar_mensaje(texto_usuario)
+
+    # Última función ejecutada y su resultado estructurado (para las plantillas)
+    ultima_funcion, ultimo_resultado = None, None
+
     # Bucle de planificación por pasos (function-calling/plan)
     while True:
         historial = obtener_historial(x_from)
 
-        # Construir messages para OpenAI, siempre como strings
-        messages = []
-        for msg in historial:
-            content = msg["content"]
-            if not isinstance(content, str):
-                content = json.dumps(content, ensure_ascii=False)
-            messages.append({
-                "role": "assistant" if msg["role"] == "assistant" else "user",
-                "content": content
-            })
-
-        siguiente = await clasificar_siguiente_paso(messages)
+        # Construir messages para OpenAI dentro del presupuesto de tokens
+        # (compacta turnos viejos en un resumen si hace falta)
+        historial, messages = await preparar_contexto(x_from, historial)
+
+        if paso_forzado:
+            siguiente, paso_forzado = paso_forzado, None
+        else:
+            siguiente = await clasificar_siguiente_paso(messages, user_id=x_from)
         print(f"🔍 Siguiente paso IA: {siguiente}")
 
         if not siguiente:
@@ -239,20 +503,46 @@ async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
 
         if servicio == "FACTURACION" or servicio == "FACTURACIÓN":
             if funcion == "consultar_facturas":
-                resultado = consultar_facturas(params)
+                # Sólo una página proyectada entra al historial; el resto queda tras un handle
+                resultado = await asyncio.to_thread(consultar_facturas_paginado, params)
 
             elif funcion == "descargar_documento":
-                file_bytes, file_name = descargar_documento(**params)
-                unique_name = f"{uuid.uuid4()}_{file_name}"
-                archivo_path = os.path.join(TEMP_FOLDER, unique_name)
-                with open(archivo_path, "wb") as f:
-                    f.write(file_bytes)
+                # Archivo abierto: en memoria si es chico, del cache en disco si es grande
+                documento = await asyncio.to_thread(abrir_documento, **params)
+                file_name = documento.nombre
+                archivo_path = f"abierto:{uuid.uuid4().hex}/{file_name}"
+                archivos_turno[archivo_path] = documento
 
                 resultado = {
                     "mensaje": f"Documento descargado: {file_name}",
-                    "archivo": archivo_path
+                    "archivo": archivo_path,
+                    "nombre": file_name
                 }
 
+            elif funcion == "descargar_documentos_zip":
+                # Varias facturas en un solo paso del planificador y un solo envío
+                zip_info = await asyncio.to_thread(descargar_documentos_zip, **params)
+                archivo_path = zip_info["archivo"]
+                resultado = {
+                    "mensaje": (zip_info.get("mensaje") or f"ZIP con {zip_info['incluidos']} documento(s)")
+                               + (f"; no se pudieron descargar: {', '.join(zip_info['fallidos'])}" if zip_info["fallidos"] else ""),
+                    "archivo": archivo_path,
+                    "nombre": zip_info["nombre"],
+                    "incluidos": zip_info["incluidos"],
+                    "fallidos": zip_info["fallidos"]
+                }
+
+            elif funcion == "analizar_facturas":
+                # Agregados calculados localmente: al historial sólo llega la tabla
+                resultado = await asyncio.to_thread(analizar_facturas, **params)
+
+            elif funcion == "buscar_catalogo_sat":
+                resultado = buscar_en_catalogo(**params)
+
+            elif funcion == "crear_factura" and siguiente.get("borrador"):
+                # Se abre el borrador con lo que ya traiga este mensaje
+                return await _responder_borrador(x_from, texto_usuario, nuevo=True)
+
             elif funcion == "crear_factura":
                 # Asegúrate de que params sea el payload correcto para tu servicio
                 # file_bytes, file_name = crear_factura(**params)
@@ -264,14 +554,21 @@ async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
                 #     "mensaje": f"Factura generada: {file_name}",
                 #     "archivo": archivo_path
                 # }
-                resultado = crear_factura(params)
+                _marcar_efecto(x_from)
+                resultado = await asyncio.to_thread(crear_factura, params)
 
             else:
                 resultado = "Función de facturación no reconocida."
 
+            ultima_funcion, ultimo_resultado = funcion, resultado
+
         elif servicio == "WHATSAPP":
-            # Generar la respuesta final con tu IA
-            respuesta = await generar_respuesta_final(messages)
+            # Resultados conocidos se redactan con plantilla; el resto con tu IA
+            respuesta = renderizar_respuesta(ultima_funcion, ultimo_resultado, texto_usuario)
+            if respuesta:
+                print(f"🧩 Respuesta por plantilla ({ultima_funcion})")
+            else:
+                respuesta = await generar_respuesta_final(messages, user_id=x_from)
             agregar_mensaje_historial(x_from, "assistant", respuesta)
 
             # Revisar si hay archivos pendientes en historial para enviar por WhatsApp
@@ -284,18 +581,26 @@ async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
 
                 if isinstance(contenido, dict) and contenido.get("archivo"):
                     archivo_path = contenido["archivo"]
-                    if os.path.exists(archivo_path):
+                    documento = archivos_turno.get(archivo_path)
+                    if documento is not None or os.path.exists(archivo_path):
                         print(f"📂 Enviando archivo por WhatsApp: {archivo_path}")
 
-                        # Enviar archivo
-                        enviar_respuesta_a_whatsapp(to=x_from, ruta_archivo=archivo_path)
+                        # Enviar archivo (los documentos abiertos se cierran al terminar el turno)
+                        if documento is not None:
+                            enviar_respuesta_a_whatsapp(to=x_from, archivo=documento)
+                        else:
+                            enviar_respuesta_a_whatsapp(to=x_from, ruta_archivo=archivo_path)
 
-                        # Marcar archivo como enviado y actualizar historial
-                        historial = marcar_archivo_usado(historial, archivo_path)
+                        # Marcar archivo como enviado (se relee el historial: ya trae la respuesta)
+                        historial = marcar_archivo_usado(obtener_historial(x_from), archivo_path)
                         actualizar_historial(x_from, historial)
 
-                        # Enviar mensaje de texto que acompaña al archivo, si existe
-                        mensaje_texto = siguiente.get("params", {}).get("mensaje")
+                        # Los temporales (ZIP) ya no se necesitan; el cache de documentos se conserva
+                        if documento is None and not es_archivo_en_cache(archivo_path):
+                            archivos_temp.eliminar(archivo_path)
+
+                        # Texto que acompaña al archivo: el del plan o, si no trae, la respuesta redactada
+                        mensaje_texto = siguiente.get("params", {}).get("mensaje") or respuesta
                         if mensaje_texto:
                             print(f"💬 Respuesta al cliente: {mensaje_texto}")
                             enviar_respuesta_a_whatsapp(to=x_from, mensaje=mensaje_texto)
@@ -303,7 +608,8 @@ async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
                         # Retornar confirmación
                         return {
                             "status": "ok",
-                            "respuesta": f"Archivo enviado: {os.path.basename(archivo_path)}"
+                            "respuesta": mensaje_texto,
+                            "archivo": os.path.basename(archivo_path)
                         }
 
             # Si no hay archivos, enviar el texto final
@@ -332,26 +638,32 @@ async def procesar_mensaje_texto(x_from: str, texto_usuario: str):
             agregar_mensaje_historial(x_from, "assistant", resultado)
             print(f"📑 Historial de redis: {obtener_historial(x_from)}")
 
+        # Un paso de la ruta rápida es de una sola acción: lo siguiente es responder
+        if siguiente.get("origen") == "enrutador":
+            paso_forzado = {"servicio": "WHATSAPP", "funcion": "respuesta_final", "params": {}}
+
         # Si el plan requiere varios pasos, este while continuará;
         # si ya no hay "siguiente paso", se romperá arriba y retornará.
 
-async def procesar_archivo(x_from: str, filename: str, file_bytes: bytes):
+async def procesar_archivo(x_from: str, filename: str, ruta: str, sha256: Optional[str] = None):
     """
     PROCESA **UN** ARCHIVO (ya encolado y tomado por el worker).
     Envía el archivo al microservicio Node.js y devuelve su respuesta.
     """
-    print(f"Archivo recibido de {x_from}: {filename} ({len(file_bytes)} bytes)")
+    print(f"Archivo recibido de {x_from}: {filename} ({os.path.getsize(ruta)} bytes)")
 
-    # 1. Convertir a base64
-    file_base64 = base64.b64encode(file_bytes).decode('utf-8')
+    # CSV/XLSX con facturas: emisión masiva en segundo plano
+    if es_archivo_lote(filename):
+        with open(ruta, "rb") as f:
+            file_bytes = f.read()
+        resultado = await iniciar_lote(x_from, filename, file_bytes, _notificar_lote)
+        if resultado is not None:
+            return resultado
 
     try:
-        # 3. Enviar POST al servicio Node.js
-        response = requests.post(DOCUMENTS_API_URL, json={"base64": file_base64})
-        response.raise_for_status()
-        data = response.json()
-        print("📄 Respuesta del servicio Node.js:")
-        print(data)
+        # CFDI en XML se lee localmente; lo demás va al servicio de documentos
+        # en streaming desde disco. Un archivo ya procesado (mismo SHA-256) no se vuelve a enviar.
+        data = await asyncio.to_thread(procesar_documento, ruta, filename, sha256)
 
         # Opcional: guardar en historial alguna referencia
         agregar_mensaje_historial(x_from, "api-document", json.dumps({"archivo_procesado": filename, "resultado": data}, ensure_ascii=False))
@@ -360,3 +672,18 @@ async def procesar_archivo(x_from: str, filename: str, file_bytes: bytes):
         print(f"❌ Error al comunicar con el servicio Node.js: {e}")
         agregar_mensaje_historial(x_from, "api-document", f"Error procesando archivo: {str(e)}")
         return {"error": str(e)}
+
+# ==========================================================
+#                  EMISIÓN MASIVA (LOTES)
+# ==========================================================
+
+def _notificar_lote(x_from: str, mensaje: str) -> None:
+    agregar_mensaje_historial(x_from, "assistant", mensaje)
+    enviar_respuesta_a_whatsapp(to=x_from, mensaje=mensaje)
+
+async def reanudar_emisiones_masivas() -> None:
+    """Retoma los lotes de facturas que quedaron a medias al reiniciar."""
+    try:
+        await reanudar_lotes(_notificar_lote)
+    except Exception as e:
+        print(f"❌ Error reanudando lotes de facturas: {e}")
@@ -0,0 +1,112 @@
+import os
+import uuid
+import asyncio
+import hashlib
+import tempfile
+from typing import Iterator, AsyncIterator, Dict, Any
+from dotenv import load_dotenv
+from app.utils import archivos_temp
+
+load_dotenv()
+
+# =============================
+#   ARCHIVOS RECIBIDOS (DISCO)
+# =============================
+# Los archivos que llegan por el webhook se guardan una vez en disco y por la
+# cola sólo viaja su ruta: ya no se codifican en base64 para Redis ni se
+# decodifican en el worker. De aquí se leen en trozos para mandarlos al
+# servicio de documentos.
+#
+# Con varias instancias detrás de la misma cola, ARCHIVOS_ENTRANTES_DIR debe
+# ser un directorio compartido (igual que DOCUMENTOS_CACHE_DIR).
+#
+# El webhook no junta el cuerpo en memoria: lo escribe aquí por trozos
+# (guardar_stream) calculando tamaño y SHA-256 al vuelo, y corta en cuanto
+# pasa del máximo.
+
+ARCHIVOS_ENTRANTES_DIR = os.getenv("ARCHIVOS_ENTRANTES_DIR", os.path.join(archivos_temp.ARCHIVOS_TEMP_DIR, "entrantes"))
+# Un archivo en cola puede esperar a que el worker del usuario se desocupe;
+# mientras no venza este TTL la cuota de archivos_temp no lo desaloja
+ARCHIVOS_ENTRANTES_TTL_SEGUNDOS = float(os.getenv("ARCHIVOS_ENTRANTES_TTL_SEGUNDOS", "3600"))
+TAMANO_TROZO = int(os.getenv("ARCHIVOS_TAMANO_TROZO", str(64 * 1024)))
+
+os.makedirs(ARCHIVOS_ENTRANTES_DIR, exist_ok=True)
+
+
+class ArchivoDemasiadoGrande(Exception):
+    """El cuerpo recibido pasa del tamaño máximo permitido."""
+
+
+def _ruta_nueva(filename: str) -> str:
+    nombre = f"{uuid.uuid4().hex}_{os.path.basename(filename or 'archivo')}"
+    return os.path.join(ARCHIVOS_ENTRANTES_DIR, nombre)
+
+
+def guardar_archivo(filename: str, contenido: bytes) -> str:
+    """
+    Guarda el archivo recibido (escritura atómica) y devuelve su ruta.
+    """
+    ruta = _ruta_nueva(filename)
+    fd, temporal = tempfile.mkstemp(dir=ARCHIVOS_ENTRANTES_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return archivos_temp.registrar(ruta, ARCHIVOS_ENTRANTES_TTL_SEGUNDOS, desalojable=False)
+
+
+async def guardar_stream(filename: str, trozos: AsyncIterator[bytes], max_bytes: int) -> Dict[str, Any]:
+    """
+    Escribe los trozos a disco conforme llegan y devuelve {"ruta", "bytes", "sha256"}.
+    Si se pasa de max_bytes borra lo escrito y lanza ArchivoDemasiadoGrande.
+    """
+    fd, temporal = tempfile.mkstemp(dir=ARCHIVOS_ENTRANTES_DIR, prefix=".tmp-")
+    h = hashlib.sha256()
+    tamano = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for trozo in trozos:
+                if not trozo:
+                    continue
+                tamano += len(trozo)
+                if tamano > max_bytes:
+                    raise ArchivoDemasiadoGrande(f"El archivo pasa del máximo de {max_bytes} bytes")
+                h.update(trozo)
+                await asyncio.to_thread(f.write, trozo)
+        ruta = _ruta_nueva(filename)
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    archivos_temp.registrar(ruta, ARCHIVOS_ENTRANTES_TTL_SEGUNDOS, desalojable=False)
+    return {"ruta": ruta, "bytes": tamano, "sha256": h.hexdigest()}
+
+
+def leer_trozos(ruta: str, tamano: int = TAMANO_TROZO) -> Iterator[bytes]:
+    with open(ruta, "rb") as f:
+        while True:
+            trozo = f.read(tamano)
+            if not trozo:
+                return
+            yield trozo
+
+
+def leer_inicio(ruta: str, tamano: int = 4096) -> bytes:
+    with open(ruta, "rb") as f:
+        return f.read(tamano)
+
+
+def sha256_archivo(ruta: str) -> str:
+    h = hashlib.sha256()
+    for trozo in leer_trozos(ruta):
+        h.update(trozo)
+    return h.hexdigest()
+
+
+def eliminar_archivo(ruta: str) -> None:
+    archivos_temp.eliminar(ruta)
@@ -0,0 +1,275 @@
+import os
+import re
+import time
+import asyncio
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# =============================
+#   CICLO DE VIDA DE TEMPORALES
+# =============================
+# archivos_temp guarda ZIPs y documentos por enviar y los archivos recibidos
+# por el webhook. Sólo se borraban al enviarse por WhatsApp: una conversación
+# abandonada dejaba el archivo para siempre, y en Cloud Run ese disco es memoria.
+#
+#   - Registro: quien crea un temporal lo registra con su TTL; quien lo está
+#     usando (enviando, procesando) lo toma y lo suelta. Lo tomado no se borra.
+#   - Barrido de fondo: borra lo registrado con TTL vencido y los huérfanos
+#     (archivos de otro proceso o de antes de un reinicio) por antigüedad.
+#   - Cuota: si el total pasa de ARCHIVOS_TEMP_MAX_BYTES se desaloja lo usado
+#     hace más tiempo (LRU). Lo registrado como no desalojable (archivos
+#     recibidos que esperan en la cola) sólo se borra al vencer su TTL.
+#
+# Sólo se tocan archivos con nombre de temporal ("<uuid>_nombre", ".tmp-*"):
+# el cache de documentos tiene su propio LRU y otros archivos (p. ej. el
+# índice sqlite) no se consideran temporales.
+#
+# Para lo que sólo se descarga y se reenvía está ArchivoTemporal: se queda en
+# memoria y únicamente pasa a disco si supera ARCHIVOS_TEMP_MEMORIA_MAX_BYTES.
+
+ARCHIVOS_TEMP_DIR = os.getenv("ARCHIVOS_TEMP_DIR", "archivos_temp")
+# Igual que el historial (600 s): pasado ese tiempo nadie va a enviar el archivo
+ARCHIVOS_TEMP_TTL_SEGUNDOS = float(os.getenv("ARCHIVOS_TEMP_TTL_SEGUNDOS", "600"))
+# Archivos que no están en el registro de este proceso
+ARCHIVOS_TEMP_TTL_HUERFANOS_SEGUNDOS = float(os.getenv("ARCHIVOS_TEMP_TTL_HUERFANOS_SEGUNDOS", "3600"))
+ARCHIVOS_TEMP_MAX_BYTES = int(os.getenv("ARCHIVOS_TEMP_MAX_BYTES", str(200 * 1024 * 1024)))
+ARCHIVOS_TEMP_BARRIDO_SEGUNDOS = float(os.getenv("ARCHIVOS_TEMP_BARRIDO_SEGUNDOS", "60"))
+# Hasta este tamaño un ArchivoTemporal no toca disco
+ARCHIVOS_TEMP_MEMORIA_MAX_BYTES = int(os.getenv("ARCHIVOS_TEMP_MEMORIA_MAX_BYTES", str(512 * 1024)))
+
+_RE_TEMPORAL = re.compile(r"^(\.tmp-|[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}_)")
+# Directorios con su propia política (cache de documentos, también si
+# DOCUMENTOS_CACHE_DIR apunta a otro lugar dentro de ARCHIVOS_TEMP_DIR)
+_EXCLUIDOS = {
+    os.path.abspath(os.path.join(ARCHIVOS_TEMP_DIR, "cache")),
+    os.path.abspath(os.getenv("DOCUMENTOS_CACHE_DIR", os.path.join(ARCHIVOS_TEMP_DIR, "cache"))),
+}
+
+_lock = threading.Lock()
+# ruta absoluta → {"expira", "usado", "refs", "desalojable"}
+_registro: Dict[str, Dict[str, float]] = {}
+_metricas = {"registrados": 0, "eliminados": 0, "barridos": 0, "huerfanos": 0, "desalojados": 0, "bytes_liberados": 0}
+
+os.makedirs(ARCHIVOS_TEMP_DIR, exist_ok=True)
+
+
+def _clave(ruta: str) -> str:
+    return os.path.abspath(ruta)
+
+# =============================
+#          REGISTRO
+# =============================
+
+def registrar(ruta: str, ttl_seconds: Optional[float] = None, desalojable: bool = True) -> str:
+    """
+    Registra un temporal recién creado; devuelve la misma ruta. Con
+    desalojable=False la cuota no lo borra antes de que venza su TTL.
+    """
+    ahora = time.time()
+    ttl = ARCHIVOS_TEMP_TTL_SEGUNDOS if ttl_seconds is None else ttl_seconds
+    with _lock:
+        entrada = _registro.setdefault(_clave(ruta), {"refs": 0})
+        entrada.update({"expira": ahora + ttl, "usado": ahora, "desalojable": desalojable})
+        _metricas["registrados"] += 1
+    return ruta
+
+
+def tomar(ruta: str) -> None:
+    """Marca el archivo como en uso: ni el barrido ni la cuota lo borran."""
+    ahora = time.time()
+    with _lock:
+        entrada = _registro.setdefault(
+            _clave(ruta), {"refs": 0, "expira": ahora + ARCHIVOS_TEMP_TTL_SEGUNDOS}
+        )
+        entrada["refs"] += 1
+        entrada["usado"] = ahora
+
+
+def soltar(ruta: str) -> None:
+    with _lock:
+        entrada = _registro.get(_clave(ruta))
+        if entrada:
+            entrada["refs"] = max(0, entrada["refs"] - 1)
+            entrada["usado"] = time.time()
+
+
+@contextmanager
+def en_uso(ruta: str):
+    tomar(ruta)
+    try:
+        yield ruta
+    finally:
+        soltar(ruta)
+
+
+def eliminar(ruta: str) -> None:
+    """Borra el temporal y lo quita del registro (ya no se necesita)."""
+    with _lock:
+        _registro.pop(_clave(ruta), None)
+    try:
+        tamano = os.path.getsize(ruta)
+        os.remove(ruta)
+    except FileNotFoundError:
+        return
+    with _lock:
+        _metricas["eliminados"] += 1
+        _metricas["bytes_liberados"] += tamano
+
+# =============================
+#     TEMPORALES EN MEMORIA
+# =============================
+
+class ArchivoTemporal(tempfile.SpooledTemporaryFile):
+    """
+    Archivo binario con nombre para enviar: vive en memoria y se vuelca a un
+    archivo anónimo en ARCHIVOS_TEMP_DIR si pasa de max_bytes. Ese archivo no
+    tiene entrada en el directorio (desaparece al cerrarse), así que el
+    barrido no lo ve.
+
+    len() da el tamaño total sin pedir fileno(): requests lo usa para el
+    Content-Length y fileno() forzaría el volcado a disco.
+    """
+
+    def __init__(self, nombre: str, max_bytes: Optional[int] = None):
+        max_bytes = ARCHIVOS_TEMP_MEMORIA_MAX_BYTES if max_bytes is None else max_bytes
+        super().__init__(max_size=max_bytes, mode="w+b", dir=ARCHIVOS_TEMP_DIR, prefix=".tmp-")
+        self.nombre = os.path.basename(nombre or "archivo")
+        self._en_disco = False
+
+    def rollover(self) -> None:
+        # Lo llaman write() al pasar de max_bytes y fileno()
+        super().rollover()
+        self._en_disco = True
+
+    @property
+    def en_memoria(self) -> bool:
+        return not self._en_disco
+
+    def __len__(self) -> int:
+        posicion = self.tell()
+        self.seek(0, os.SEEK_END)
+        tamano = self.tell()
+        self.seek(posicion)
+        return tamano
+
+    def __bool__(self) -> bool:
+        # Con __len__ un archivo vacío sería falso
+        return True
+
+
+def archivo_temporal(nombre: str, contenido: bytes = b"") -> ArchivoTemporal:
+    """ArchivoTemporal con `contenido` escrito y listo para leerse desde el inicio."""
+    archivo = ArchivoTemporal(nombre)
+    archivo.write(contenido)
+    archivo.seek(0)
+    return archivo
+
+# =============================
+#      BARRIDO Y CUOTA
+# =============================
+
+def _temporales() -> List[Tuple[str, os.stat_result]]:
+    encontrados = []
+    for raiz, dirs, archivos in os.walk(ARCHIVOS_TEMP_DIR):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(raiz, d)) not in _EXCLUIDOS]
+        for nombre in archivos:
+            if not _RE_TEMPORAL.match(nombre):
+                continue
+            ruta = os.path.join(raiz, nombre)
+            try:
+                encontrados.append((_clave(ruta), os.stat(ruta)))
+            except FileNotFoundError:
+                continue
+    return encontrados
+
+
+def _borrar(ruta: str, tamano: int, motivo: str) -> bool:
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"⚠️ No se pudo borrar el temporal {ruta}: {e}")
+        return False
+    _registro.pop(ruta, None)
+    _metricas[motivo] += 1
+    _metricas["bytes_liberados"] += tamano
+    return True
+
+
+def barrer(max_bytes: Optional[int] = None) -> Dict[str, int]:
+    """
+    Borra los temporales vencidos y, si el total sigue arriba de la cuota, los
+    usados hace más tiempo. Devuelve {"barridos", "huerfanos", "desalojados", "bytes"}.
+    """
+    max_bytes = ARCHIVOS_TEMP_MAX_BYTES if max_bytes is None else max_bytes
+    ahora = time.time()
+    resultado = {"barridos": 0, "huerfanos": 0, "desalojados": 0, "bytes": 0}
+    with _lock:
+        vivos = []
+        for ruta, st in _temporales():
+            entrada = _registro.get(ruta)
+            if entrada is None:
+                if ahora - st.st_mtime > ARCHIVOS_TEMP_TTL_HUERFANOS_SEGUNDOS:
+                    if _borrar(ruta, st.st_size, "huerfanos"):
+                        resultado["huerfanos"] += 1
+                        resultado["bytes"] += st.st_size
+                        continue
+                vivos.append((st.st_mtime, st.st_size, ruta))
+            elif entrada["refs"] == 0 and entrada["expira"] < ahora:
+                if _borrar(ruta, st.st_size, "barridos"):
+                    resultado["barridos"] += 1
+                    resultado["bytes"] += st.st_size
+                    continue
+                vivos.append((entrada["usado"], st.st_size, ruta))
+            else:
+                vivos.append((entrada["usado"], st.st_size, ruta))
+
+        # Entradas de archivos que alguien más ya borró
+        existentes = {ruta for _, _, ruta in vivos}
+        for ruta in [r for r, e in _registro.items() if r not in existentes and e["refs"] == 0]:
+            _registro.pop(ruta, None)
+
+        total = sum(tamano for _, tamano, _ in vivos)
+        for _, tamano, ruta in sorted(vivos):
+            if total <= max_bytes:
+                break
+            entrada = _registro.get(ruta, {})
+            if entrada.get("refs") or not entrada.get("desalojable", True):
+                continue
+            if _borrar(ruta, tamano, "desalojados"):
+                total -= tamano
+                resultado["desalojados"] += 1
+                resultado["bytes"] += tamano
+
+    if any(resultado[k] for k in ("barridos", "huerfanos", "desalojados")):
+        print(f"🧹 Temporales: {resultado}")
+    return resultado
+
+
+def metricas() -> Dict[str, Any]:
+    temporales = _temporales()
+    with _lock:
+        return {
+            "archivos": len(temporales),
+            "bytes": sum(st.st_size for _, st in temporales),
+            "max_bytes": ARCHIVOS_TEMP_MAX_BYTES,
+            "registrados_vivos": len(_registro),
+            "en_uso": sum(1 for e in _registro.values() if e["refs"]),
+            **_metricas,
+        }
+
+
+async def ciclo_barrido() -> None:
+    """Tarea de fondo: barre archivos_temp cada ARCHIVOS_TEMP_BARRIDO_SEGUNDOS."""
+    while True:
+        try:
+            await asyncio.to_thread(barrer)
+        except Exception as e:
+            print(f"❌ Error barriendo temporales: {e}")
+        await asyncio.sleep(ARCHIVOS_TEMP_BARRIDO_SEGUNDOS)
@@ -0,0 +1,89 @@
+import json
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+# Parámetros estándar de BM25
+K1 = 1.2
+B = 0.75
+# Tamaño máximo del texto guardado por documento (lo que vuelve al prompt)
+MAX_CHARS_DOCUMENTO = 500
+# Máximo de registros que se indexan por separado de un resultado en lista
+MAX_FRAGMENTOS = 500
+
+STOPWORDS = {
+    "de", "la", "que", "el", "en", "y", "a", "los", "del", "se", "las", "por", "un", "para",
+    "con", "no", "una", "su", "al", "lo", "como", "mas", "pero", "sus", "le", "ya", "o",
+    "me", "mi", "es", "si", "te", "tu", "esta", "este", "eso", "esa", "hay", "null", "true",
+    "false", "none",
+}
+
+
+def tokenizar(texto: str) -> List[str]:
+    """Minúsculas, sin acentos, sin stopwords; conserva ids con '_' y '-'."""
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    return [t for t in re.findall(r"[a-z0-9][a-z0-9_-]*", texto) if t not in STOPWORDS and len(t) > 1]
+
+
+def fragmentar(contenido: Any) -> List[str]:
+    """
+    Divide un mensaje en documentos indexables: un resultado que es lista de
+    registros (p. ej. consultar_facturas) se indexa registro por registro.
+    """
+    texto = contenido if isinstance(contenido, str) else json.dumps(contenido, ensure_ascii=False)
+    try:
+        datos = json.loads(texto)
+    except (json.JSONDecodeError, TypeError):
+        datos = None
+    if isinstance(datos, dict) and isinstance(datos.get("facturas"), list):
+        # Página de consultar_facturas: cada factura es un documento
+        datos = datos["facturas"]
+    if isinstance(datos, list) and datos and all(isinstance(d, dict) for d in datos):
+        return [json.dumps(d, ensure_ascii=False)[:MAX_CHARS_DOCUMENTO] for d in datos[:MAX_FRAGMENTOS]]
+    return [texto[:MAX_CHARS_DOCUMENTO]]
+
+
+def _texto_indexable(texto: str) -> str:
+    """En registros JSON sólo cuentan los valores: los nombres de campo se repiten en todos."""
+    try:
+        datos = json.loads(texto)
+    except (json.JSONDecodeError, TypeError):
+        return texto
+    if isinstance(datos, dict):
+        return " ".join(str(v) for v in datos.values() if not isinstance(v, (dict, list)))
+    return texto
+
+
+def documento(texto: str) -> Dict[str, Any]:
+    """Documento listo para guardar: texto, frecuencias de términos y longitud."""
+    tokens = tokenizar(_texto_indexable(texto))
+    return {"texto": texto, "tf": dict(Counter(tokens)), "len": len(tokens)}
+
+
+def puntuar(consulta: str, documentos: List[Dict[str, Any]], df: Dict[str, int]) -> List[Tuple[int, float]]:
+    """
+    Devuelve [(posición, score)] de los documentos con score > 0, de mayor a menor.
+    """
+    terminos = set(tokenizar(consulta))
+    n = len(documentos)
+    if not terminos or not n:
+        return []
+    avgdl = sum(d["len"] for d in documentos) / n or 1.0
+
+    resultados = []
+    for i, doc in enumerate(documentos):
+        score = 0.0
+        for termino in terminos:
+            tf = doc["tf"].get(termino)
+            if not tf:
+                continue
+            dft = min(int(df.get(termino, 1)), n)
+            idf = math.log(1 + (n - dft + 0.5) / (dft + 0.5))
+            score += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * doc["len"] / avgdl))
+        if score > 0:
+            resultados.append((i, score))
+    resultados.sort(key=lambda x: x[1], reverse=True)
+    return resultados
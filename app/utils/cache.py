@@ -0,0 +1,106 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class CacheTTL:
+    """
+    Cache en memoria con TTL y tamaño máximo (desaloja el menos usado).
+    Las llamadas concurrentes con la misma llave se combinan: sólo una
+    ejecuta la función y las demás esperan su resultado.
+    Los valores se comparten entre llamadas: trátalos como sólo lectura.
+    """
+
+    def __init__(self, ttl_seconds: float, max_items: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self._datos: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._en_vuelo: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        # Cambia con cada invalidación: un cálculo que empezó antes no se guarda
+        self._generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, llave: Hashable) -> Optional[Any]:
+        with self._lock:
+            entrada = self._obtener_sin_lock(llave)
+            return entrada[1] if entrada else None
+
+    def _obtener_sin_lock(self, llave: Hashable) -> Optional[tuple]:
+        """Devuelve (expira, valor) vigente o None."""
+        entrada = self._datos.get(llave)
+        if entrada is None:
+            return None
+        if entrada[0] < time.monotonic():
+            del self._datos[llave]
+            return None
+        self._datos.move_to_end(llave)
+        return entrada
+
+    def guardar(self, llave: Hashable, valor: Any) -> None:
+        with self._lock:
+            self._guardar_sin_lock(llave, valor)
+
+    def _guardar_sin_lock(self, llave: Hashable, valor: Any) -> None:
+        self._datos[llave] = (time.monotonic() + self.ttl_seconds, valor)
+        self._datos.move_to_end(llave)
+        while len(self._datos) > self.max_items:
+            self._datos.popitem(last=False)
+
+    def obtener_o_calcular(self, llave: Hashable, calcular: Callable[[], Any]) -> Any:
+        """
+        Devuelve el valor en cache o lo calcula una sola vez aunque varios
+        hilos lo pidan al mismo tiempo. Los errores no se guardan.
+        """
+        with self._lock:
+            entrada = self._obtener_sin_lock(llave)
+            if entrada is not None:
+                self.aciertos += 1
+                return entrada[1]
+            futuro = self._en_vuelo.get(llave)
+            propio = futuro is None
+            generacion = self._generacion
+            if propio:
+                self.fallos += 1
+                futuro = Future()
+                self._en_vuelo[llave] = futuro
+
+        if not propio:
+            return futuro.result()
+
+        try:
+            valor = calcular()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                if generacion == self._generacion:
+                    self._guardar_sin_lock(llave, valor)
+            futuro.set_result(valor)
+            return valor
+        finally:
+            with self._lock:
+                if self._en_vuelo.get(llave) is futuro:
+                    del self._en_vuelo[llave]
+
+    def invalidar(self, predicado: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """
+        Borra las llaves que cumplen el predicado (todas si no hay predicado).
+        Los cálculos en curso de esas llaves ya no se comparten con quien llegue después.
+        """
+        with self._lock:
+            self._generacion += 1
+            for llave in [k for k in self._en_vuelo if predicado is None or predicado(k)]:
+                del self._en_vuelo[llave]
+            llaves = [k for k in self._datos if predicado is None or predicado(k)]
+            for llave in llaves:
+                del self._datos[llave]
+            return len(llaves)
+
+    def estadisticas(self) -> Dict[str, int]:
+        with self._lock:
+            return {"items": len(self._datos), "aciertos": self.aciertos, "fallos": self.fallos}
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import tempfile
+import threading
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from app.utils import archivos_temp
+
+load_dotenv()
+
+# =============================
+#   CACHE EN DISCO DE CFDIs
+# =============================
+# Los CFDI emitidos son inmutables: una vez descargado (id, formato, tipo) no
+# hace falta volver a pedirlo a Facturama.
+#
+#   <dir>/objetos/<sha256>/<nombre>   contenido (direccionado por su hash)
+#   <dir>/llaves/<sha1(id|format|type)>  "sha256\nnombre"
+#
+# No hay índice compartido: cada escritura es atómica (os.replace), así que
+# varios workers pueden usar el mismo directorio. El LRU usa el mtime.
+
+DOCUMENTOS_CACHE_DIR = os.getenv("DOCUMENTOS_CACHE_DIR", os.path.join(archivos_temp.ARCHIVOS_TEMP_DIR, "cache"))
+DOCUMENTOS_CACHE_MAX_BYTES = int(os.getenv("DOCUMENTOS_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+_OBJETOS_DIR = os.path.join(DOCUMENTOS_CACHE_DIR, "objetos")
+_LLAVES_DIR = os.path.join(DOCUMENTOS_CACHE_DIR, "llaves")
+os.makedirs(_OBJETOS_DIR, exist_ok=True)
+os.makedirs(_LLAVES_DIR, exist_ok=True)
+
+_lock_desalojo = threading.Lock()
+
+
+def _ruta_llave(id: str, format: str, type: str) -> str:
+    llave = f"{id}|{format.lower()}|{type.lower()}".encode("utf-8")
+    return os.path.join(_LLAVES_DIR, hashlib.sha1(llave).hexdigest())
+
+
+def _escribir_atomico(ruta: str, contenido: bytes) -> None:
+    """Escribe a un temporal en el mismo directorio y lo renombra: nunca queda un archivo a medias."""
+    directorio = os.path.dirname(ruta)
+    os.makedirs(directorio, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(dir=directorio, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def es_archivo_en_cache(ruta: str) -> bool:
+    return os.path.abspath(ruta).startswith(os.path.abspath(DOCUMENTOS_CACHE_DIR) + os.sep)
+
+
+def obtener_documento(id: str, format: str, type: str) -> Optional[Tuple[str, str]]:
+    """
+    Devuelve (ruta local, nombre) si el documento está en cache, o None.
+    """
+    try:
+        with open(_ruta_llave(id, format, type), encoding="utf-8") as f:
+            sha256, nombre = f.read().split("\n", 1)
+    except (FileNotFoundError, ValueError):
+        return None
+    ruta = os.path.join(_OBJETOS_DIR, sha256, nombre)
+    try:
+        os.utime(ruta)  # marca de uso para el LRU
+    except FileNotFoundError:
+        return None  # desalojado
+    return ruta, nombre
+
+
+def guardar_documento(id: str, format: str, type: str, contenido: bytes, nombre: str) -> str:
+    """
+    Guarda el documento (una sola copia por contenido) y devuelve su ruta local.
+    """
+    sha256 = hashlib.sha256(contenido).hexdigest()
+    nombre = os.path.basename(nombre)
+    ruta = os.path.join(_OBJETOS_DIR, sha256, nombre)
+    if not os.path.exists(ruta):
+        _escribir_atomico(ruta, contenido)
+    _escribir_atomico(_ruta_llave(id, format, type), f"{sha256}\n{nombre}".encode("utf-8"))
+    desalojar()
+    return ruta
+
+
+def desalojar(max_bytes: Optional[int] = None) -> int:
+    """
+    Borra los documentos menos usados hasta quedar bajo el límite.
+    Devuelve los bytes liberados.
+    """
+    max_bytes = DOCUMENTOS_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _lock_desalojo:
+        archivos = []
+        for sha256 in os.listdir(_OBJETOS_DIR):
+            carpeta = os.path.join(_OBJETOS_DIR, sha256)
+            try:
+                nombres = [n for n in os.listdir(carpeta) if not n.startswith(".tmp-")]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for nombre in nombres:
+                ruta = os.path.join(carpeta, nombre)
+                try:
+                    st = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                archivos.append((st.st_mtime, st.st_size, ruta))
+
+        total = sum(a[1] for a in archivos)
+        liberados = 0
+        for _, tamano, ruta in sorted(archivos):
+            if total - liberados <= max_bytes:
+                break
+            try:
+                os.remove(ruta)
+            except OSError:
+                continue
+            liberados += tamano
+            try:
+                os.rmdir(os.path.dirname(ruta))
+            except OSError:
+                pass  # otro nombre con el mismo contenido
+        if liberados:
+            print(f"🧹 Cache de documentos: {liberados} bytes desalojados")
+        return liberados
@@ -0,0 +1,524 @@
+import os
+import re
+import sys
+import csv
+import mmap
+import difflib
+import threading
+import numpy as np
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+from dotenv import load_dotenv
+from app.utils.bm25 import tokenizar
+
+load_dotenv()
+
+# =============================
+#      CATÁLOGOS DEL SAT
+# =============================
+# Búsqueda local de claves del SAT (c_ClaveProdServ, c_ClaveUnidad, c_UsoCFDI,
+# c_RegimenFiscal, c_FormaPago, ...) para que el planificador no adivine
+# códigos y crear_factura se valide antes de timbrar.
+#
+# Los catálogos chicos vienen incluidos aquí. Los grandes (c_ClaveProdServ
+# ~52 mil claves, c_ClaveUnidad) se construyen desde el CSV oficial del SAT:
+#
+#   python -m app.utils.catalogos_sat construir c_ClaveProdServ c_ClaveProdServ.csv
+#
+# y quedan en CATALOGOS_SAT_DIR como archivos de sólo lectura que se abren con
+# mmap al primer uso (no se copian a memoria de cada worker):
+#
+#   <catalogo>.filas      "clave\tdescripcion\n" ordenado por clave
+#   <catalogo>.filas.npy  offsets de cada línea
+#   <catalogo>.tokens     "token\tfila fila ...\n" ordenado por token
+#   <catalogo>.tokens.npy offsets de cada línea
+
+CATALOGOS_SAT_DIR = os.getenv("CATALOGOS_SAT_DIR", "catalogos_sat")
+# Similitud mínima (difflib) para aceptar una palabra con errores de dedo
+CATALOGOS_SAT_SIMILITUD = float(os.getenv("CATALOGOS_SAT_SIMILITUD", "0.8"))
+
+CATALOGOS_INCLUIDOS: Dict[str, Dict[str, str]] = {
+    "c_UsoCFDI": {
+        "G01": "Adquisición de mercancías",
+        "G02": "Devoluciones, descuentos o bonificaciones",
+        "G03": "Gastos en general",
+        "I01": "Construcciones",
+        "I02": "Mobiliario y equipo de oficina por inversiones",
+        "I03": "Equipo de transporte",
+        "I04": "Equipo de cómputo y accesorios",
+        "I05": "Dados, troqueles, moldes, matrices y herramental",
+        "I06": "Comunicaciones telefónicas",
+        "I07": "Comunicaciones satelitales",
+        "I08": "Otra maquinaria y equipo",
+        "D01": "Honorarios médicos, dentales y gastos hospitalarios",
+        "D02": "Gastos médicos por incapacidad o discapacidad",
+        "D03": "Gastos funerales",
+        "D04": "Donativos",
+        "D05": "Intereses reales efectivamente pagados por créditos hipotecarios (casa habitación)",
+        "D06": "Aportaciones voluntarias al SAR",
+        "D07": "Primas por seguros de gastos médicos",
+        "D08": "Gastos de transportación escolar obligatoria",
+        "D09": "Depósitos en cuentas para el ahorro, primas que tengan como base planes de pensiones",
+        "D10": "Pagos por servicios educativos (colegiaturas)",
+        "S01": "Sin efectos fiscales",
+        "CP01": "Pagos",
+        "CN01": "Nómina",
+    },
+    "c_RegimenFiscal": {
+        "601": "General de Ley Personas Morales",
+        "603": "Personas Morales con Fines no Lucrativos",
+        "605": "Sueldos y Salarios e Ingresos Asimilados a Salarios",
+        "606": "Arrendamiento",
+        "607": "Régimen de Enajenación o Adquisición de Bienes",
+        "608": "Demás ingresos",
+        "610": "Residentes en el Extranjero sin Establecimiento Permanente en México",
+        "611": "Ingresos por Dividendos (socios y accionistas)",
+        "612": "Personas Físicas con Actividades Empresariales y Profesionales",
+        "614": "Ingresos por intereses",
+        "615": "Régimen de los ingresos por obtención de premios",
+        "616": "Sin obligaciones fiscales",
+        "620": "Sociedades Cooperativas de Producción que optan por diferir sus ingresos",
+        "621": "Incorporación Fiscal",
+        "622": "Actividades Agrícolas, Ganaderas, Silvícolas y Pesqueras",
+        "623": "Opcional para Grupos de Sociedades",
+        "624": "Coordinados",
+        "625": "Régimen de las Actividades Empresariales con ingresos a través de Plataformas Tecnológicas",
+        "626": "Régimen Simplificado de Confianza",
+        "628": "Hidrocarburos",
+        "629": "De los Regímenes Fiscales Preferentes y de las Empresas Multinacionales",
+        "630": "Enajenación de acciones en bolsa de valores",
+    },
+    "c_FormaPago": {
+        "01": "Efectivo",
+        "02": "Cheque nominativo",
+        "03": "Transferencia electrónica de fondos",
+        "04": "Tarjeta de crédito",
+        "05": "Monedero electrónico",
+        "06": "Dinero electrónico",
+        "08": "Vales de despensa",
+        "12": "Dación en pago",
+        "13": "Pago por subrogación",
+        "14": "Pago por consignación",
+        "15": "Condonación",
+        "17": "Compensación",
+        "23": "Novación",
+        "24": "Confusión",
+        "25": "Remisión de deuda",
+        "26": "Prescripción o caducidad",
+        "27": "A satisfacción del acreedor",
+        "28": "Tarjeta de débito",
+        "29": "Tarjeta de servicios",
+        "30": "Aplicación de anticipos",
+        "31": "Intermediario pagos",
+        "99": "Por definir",
+    },
+    "c_MetodoPago": {
+        "PUE": "Pago en una sola exhibición",
+        "PPD": "Pago en parcialidades o diferido",
+    },
+    "c_ObjetoImp": {
+        "01": "No objeto de impuesto",
+        "02": "Sí objeto de impuesto",
+        "03": "Sí objeto del impuesto y no obligado al desglose",
+        "04": "Sí objeto del impuesto y no causa impuesto",
+        "05": "Sí objeto del impuesto, IVA crédito PODEBI",
+    },
+    "c_TipoDeComprobante": {
+        "I": "Ingreso",
+        "E": "Egreso",
+        "T": "Traslado",
+        "N": "Nómina",
+        "P": "Pago",
+    },
+    "c_Exportacion": {
+        "01": "No aplica",
+        "02": "Definitiva con clave A1",
+        "03": "Temporal",
+        "04": "Definitiva con clave distinta a A1 o cuando no existe enajenación en términos del CFF",
+    },
+    # Subconjuntos de uso frecuente; el catálogo completo se construye desde el CSV del SAT
+    "c_ClaveUnidad": {
+        "H87": "Pieza",
+        "E48": "Unidad de servicio",
+        "ACT": "Actividad",
+        "KGM": "Kilogramo",
+        "GRM": "Gramo",
+        "LTR": "Litro",
+        "MTR": "Metro",
+        "MTK": "Metro cuadrado",
+        "MTQ": "Metro cúbico",
+        "XBX": "Caja",
+        "XPK": "Paquete",
+        "SET": "Conjunto",
+        "KT": "Kit",
+        "HUR": "Hora",
+        "DAY": "Día",
+        "MON": "Mes",
+        "ANN": "Año",
+        "A9": "Tarifa",
+        "AS": "Variedad",
+        "C62": "Uno",
+        "XUN": "Unidad",
+    },
+    # Subconjunto de ~52 mil claves: sólo para sugerir claves comunes. Sin el
+    # índice construido desde el CSV del SAT no se rechaza ninguna clave por
+    # no estar aquí (ver _INCLUIDOS_PARCIALES).
+    "c_ClaveProdServ": {
+        "01010101": "No existe en el catálogo",
+        "31162800": "Ferretería en general",
+        "43231500": "Software funcional específico de la empresa",
+        "78101800": "Transporte de carga por carretera",
+        "80101500": "Servicios de consultoría de negocios y administración corporativa",
+        "80131500": "Alquiler y arrendamiento de propiedades o edificaciones",
+        "81111500": "Ingeniería de software o hardware",
+        "81112100": "Servicios de internet",
+        "84111500": "Servicios contables",
+        "84111506": "Servicios de facturación",
+        "90101500": "Establecimientos para comer y beber",
+    },
+}
+
+# Catálogos cuyo subconjunto incluido no sirve para rechazar claves
+_INCLUIDOS_PARCIALES = {"c_ClaveUnidad", "c_ClaveProdServ"}
+# Formato de la clave cuando sólo se tiene el subconjunto
+_FORMATOS_CLAVE = {"c_ClaveProdServ": re.compile(r"^\d{8}$"), "c_ClaveUnidad": re.compile(r"^[A-Z0-9]{1,3}$")}
+
+_cargados: Dict[str, "Catalogo"] = {}
+_lock_carga = threading.Lock()
+
+# =============================
+#          ÍNDICE
+# =============================
+
+def _raiz(token: str) -> str:
+    # Plural simple: "servicios" y "servicio" deben coincidir
+    if len(token) > 3 and token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def _construir_tokens(filas: List[Tuple[str, str]]) -> List[Tuple[str, List[int]]]:
+    postings: Dict[str, List[int]] = defaultdict(list)
+    for i, (_, descripcion) in enumerate(filas):
+        for token in dict.fromkeys(_raiz(t) for t in tokenizar(descripcion)):
+            postings[token].append(i)
+    return sorted(postings.items())
+
+
+class Catalogo(ABC):
+    """
+    Catálogo ordenado por clave con índice invertido de palabras.
+    Las subclases sólo dan acceso a la fila i y al token i.
+    """
+
+    nombre: str
+    completo: bool
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Número de claves."""
+
+    @abstractmethod
+    def _num_tokens(self) -> int:
+        """Número de palabras distintas en el índice invertido."""
+
+    @abstractmethod
+    def fila(self, i: int) -> Tuple[str, str]:
+        """(clave, descripción) de la fila i, en orden de clave."""
+
+    @abstractmethod
+    def _token(self, i: int) -> Tuple[str, List[int]]:
+        """(palabra, filas donde aparece) del token i, en orden de palabra."""
+
+    def _clave(self, i: int) -> str:
+        return self.fila(i)[0]
+
+    def _bisect(self, objetivo: str, clave, n: int) -> int:
+        inicio, fin = 0, n
+        while inicio < fin:
+            medio = (inicio + fin) // 2
+            if clave(medio) < objetivo:
+                inicio = medio + 1
+            else:
+                fin = medio
+        return inicio
+
+    def obtener(self, clave: str) -> Optional[str]:
+        """Descripción de la clave, o None si no existe."""
+        clave = (clave or "").strip().upper()
+        i = self._bisect(clave, self._clave, len(self))
+        if i < len(self) and self._clave(i) == clave:
+            return self.fila(i)[1]
+        return None
+
+    def por_prefijo(self, prefijo: str, limite: int = 10) -> List[Tuple[str, str]]:
+        """Claves que empiezan con el prefijo (p. ej. '8010' → familia de consultoría)."""
+        prefijo = (prefijo or "").strip().upper()
+        i = self._bisect(prefijo, self._clave, len(self))
+        resultado = []
+        while i < len(self) and len(resultado) < limite:
+            fila = self.fila(i)
+            if not fila[0].startswith(prefijo):
+                break
+            resultado.append(fila)
+            i += 1
+        return resultado
+
+    def _filas_de(self, palabra: str) -> Dict[int, float]:
+        """
+        Filas que contienen una palabra que empieza con `palabra` (peso 1, o 1.5
+        si es exacta); si no hay ninguna, palabras parecidas por difflib.
+        """
+        token = lambda i: self._token(i)[0]
+        n = self._num_tokens()
+        pesos: Dict[int, float] = {}
+        i = self._bisect(palabra, token, n)
+        while i < n:
+            texto, filas = self._token(i)
+            if not texto.startswith(palabra):
+                break
+            for f in filas:
+                pesos[f] = max(pesos.get(f, 0), 1.5 if texto == palabra else 1.0)
+            i += 1
+        if pesos or len(palabra) < 4:
+            return pesos
+
+        # Errores de dedo: sólo se comparan las palabras con las mismas dos primeras letras
+        i = self._bisect(palabra[:2], token, n)
+        while i < n:
+            texto, filas = self._token(i)
+            if not texto.startswith(palabra[:2]):
+                break
+            similitud = difflib.SequenceMatcher(None, palabra, texto).ratio()
+            if similitud >= CATALOGOS_SAT_SIMILITUD:
+                for f in filas:
+                    pesos[f] = max(pesos.get(f, 0), similitud)
+            i += 1
+        return pesos
+
+    def buscar(self, texto: str, limite: int = 5) -> List[Dict[str, Any]]:
+        """
+        Claves candidatas para un texto libre ("consultoría", "hora de servicio").
+        Si el texto es una clave o prefijo de clave, se busca por clave.
+        """
+        texto = (texto or "").strip()
+        if not texto:
+            return []
+        exacta = self.obtener(texto)
+        if exacta:
+            return [{"clave": texto.upper(), "descripcion": exacta, "puntaje": 1.0}]
+        if " " not in texto and any(c.isdigit() for c in texto):
+            return [{"clave": c, "descripcion": d, "puntaje": 1.0} for c, d in self.por_prefijo(texto, limite)]
+
+        palabras = [_raiz(t) for t in tokenizar(texto)]
+        if not palabras:
+            return []
+        puntajes: Dict[int, float] = defaultdict(float)
+        for palabra in palabras:
+            for f, peso in self._filas_de(palabra).items():
+                puntajes[f] += peso
+
+        # Empates: descripciones más cortas (más generales) primero
+        mejores = sorted(puntajes.items(), key=lambda x: (-x[1], len(self.fila(x[0])[1])))[:limite]
+        maximo = 1.5 * len(palabras)
+        return [
+            {"clave": self.fila(f)[0], "descripcion": self.fila(f)[1], "puntaje": round(p / maximo, 2)}
+            for f, p in mejores
+        ]
+
+
+class CatalogoEnMemoria(Catalogo):
+    def __init__(self, nombre: str, datos: Dict[str, str], completo: bool):
+        self.nombre = nombre
+        self.completo = completo
+        self._filas = sorted((k.upper(), v) for k, v in datos.items())
+        self._tokens = _construir_tokens(self._filas)
+
+    def __len__(self) -> int:
+        return len(self._filas)
+
+    def _num_tokens(self) -> int:
+        return len(self._tokens)
+
+    def fila(self, i: int) -> Tuple[str, str]:
+        return self._filas[i]
+
+    def _token(self, i: int) -> Tuple[str, List[int]]:
+        return self._tokens[i]
+
+
+class CatalogoMapeado(Catalogo):
+    """Catálogo construido en disco; se lee con mmap sin cargarlo completo."""
+
+    def __init__(self, nombre: str, base: str):
+        self.nombre = nombre
+        self.completo = True
+        self._archivos = []
+        self._filas, self._off_filas = self._abrir(base + ".filas")
+        self._tokens, self._off_tokens = self._abrir(base + ".tokens")
+
+    def _abrir(self, ruta: str):
+        f = open(ruta, "rb")
+        self._archivos.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), np.load(ruta + ".npy", mmap_mode="r")
+
+    def _linea(self, datos: mmap.mmap, offsets: np.ndarray, i: int) -> List[str]:
+        return datos[int(offsets[i]):int(offsets[i + 1]) - 1].decode("utf-8").split("\t", 1)
+
+    def __len__(self) -> int:
+        return len(self._off_filas) - 1
+
+    def _num_tokens(self) -> int:
+        return len(self._off_tokens) - 1
+
+    def fila(self, i: int) -> Tuple[str, str]:
+        clave, descripcion = self._linea(self._filas, self._off_filas, i)
+        return clave, descripcion
+
+    def _token(self, i: int) -> Tuple[str, List[int]]:
+        texto, filas = self._linea(self._tokens, self._off_tokens, i)
+        return texto, [int(f) for f in filas.split()]
+
+
+def _escribir_lineas(ruta: str, lineas: Iterable[str]) -> None:
+    offsets = [0]
+    with open(ruta, "wb") as f:
+        for linea in lineas:
+            datos = (linea + "\n").encode("utf-8")
+            f.write(datos)
+            offsets.append(offsets[-1] + len(datos))
+    np.save(ruta + ".npy", np.array(offsets, dtype=np.uint64))
+
+
+def construir_catalogo(nombre: str, ruta_csv: str, directorio: Optional[str] = None) -> int:
+    """
+    Construye el índice en disco de un catálogo desde el CSV del SAT (las dos
+    primeras columnas son clave y descripción; se ignoran los encabezados).
+    Devuelve el número de claves.
+    """
+    directorio = directorio or CATALOGOS_SAT_DIR
+    os.makedirs(directorio, exist_ok=True)
+    datos = {}
+    with open(ruta_csv, encoding="utf-8-sig", newline="") as f:
+        for fila in csv.reader(f):
+            if len(fila) < 2 or not fila[0].strip() or not fila[1].strip():
+                continue
+            clave, descripcion = fila[0].strip().upper(), " ".join(fila[1].split())
+            if clave.startswith("C_") or clave in ("CLAVE", "ID"):
+                continue  # encabezados del archivo del SAT
+            datos[clave] = descripcion.replace("\t", " ")
+
+    filas = sorted(datos.items())
+    base = os.path.join(directorio, nombre)
+    _escribir_lineas(base + ".filas", (f"{c}\t{d}" for c, d in filas))
+    _escribir_lineas(base + ".tokens", (f"{t}\t{' '.join(map(str, f))}" for t, f in _construir_tokens(filas)))
+    with _lock_carga:
+        _cargados.pop(nombre, None)
+    return len(filas)
+
+# =============================
+#     CARGA PEREZOSA Y API
+# =============================
+
+
+def obtener_catalogo(nombre: str) -> Optional[Catalogo]:
+    """
+    Catálogo por nombre (c_UsoCFDI, c_ClaveProdServ, ...). Se abre al primer
+    uso: el índice en disco si existe, si no el incluido en este módulo.
+    """
+    catalogo = _cargados.get(nombre)
+    if catalogo is not None:
+        return catalogo
+    with _lock_carga:
+        if nombre in _cargados:
+            return _cargados[nombre]
+        base = os.path.join(CATALOGOS_SAT_DIR, nombre)
+        if os.path.exists(base + ".filas") and os.path.exists(base + ".tokens.npy"):
+            catalogo = CatalogoMapeado(nombre, base)
+        elif nombre in CATALOGOS_INCLUIDOS:
+            catalogo = CatalogoEnMemoria(nombre, CATALOGOS_INCLUIDOS[nombre], nombre not in _INCLUIDOS_PARCIALES)
+        else:
+            return None
+        _cargados[nombre] = catalogo
+        return catalogo
+
+
+def precargar_catalogos() -> List[str]:
+    """Abre todos los catálogos disponibles (se llama en segundo plano al arrancar)."""
+    return [n for n in CATALOGOS_INCLUIDOS if obtener_catalogo(n)]
+
+
+def buscar_en_catalogo(catalogo: str, texto: str, limite: int = 5) -> Dict[str, Any]:
+    """
+    Función del planificador: claves candidatas de un catálogo del SAT para un texto.
+    Devuelve {"catalogo", "texto", "candidatos": [{"clave", "descripcion", "puntaje"}]}.
+    """
+    encontrado = obtener_catalogo(catalogo)
+    if encontrado is None:
+        return {"catalogo": catalogo, "texto": texto, "candidatos": [], "error": "catálogo no disponible"}
+    return {"catalogo": catalogo, "texto": texto, "candidatos": encontrado.buscar(texto, limite)}
+
+# Campos del payload de crear_factura y el catálogo que los valida
+_CAMPOS_FACTURA = (
+    (("CfdiType",), "c_TipoDeComprobante"),
+    (("PaymentForm",), "c_FormaPago"),
+    (("PaymentMethod",), "c_MetodoPago"),
+    (("Exportation",), "c_Exportacion"),
+    (("Receiver", "CfdiUse"), "c_UsoCFDI"),
+    (("Receiver", "FiscalRegime"), "c_RegimenFiscal"),
+)
+_CAMPOS_PARTIDA = (
+    ("ProductCode", "c_ClaveProdServ"),
+    ("UnitCode", "c_ClaveUnidad"),
+    ("TaxObject", "c_ObjetoImp"),
+)
+
+
+def _revisar(valor: Any, nombre: str, campo: str, errores: List[str]) -> None:
+    if valor in (None, ""):
+        return
+    catalogo = obtener_catalogo(nombre)
+    if catalogo is None:
+        return
+    if not catalogo.completo:
+        # Con un subconjunto no se puede afirmar que una clave no existe; sólo su formato
+        formato = _FORMATOS_CLAVE.get(nombre)
+        if formato and not formato.match(str(valor).strip().upper()):
+            errores.append(f"{campo}: '{valor}' no tiene el formato de {nombre}")
+        return
+    if catalogo.obtener(str(valor)) is None:
+        valor = str(valor).strip().upper()
+        sugerencias = ", ".join(f"{c} ({d})" for c, d in catalogo.por_prefijo(valor[:max(1, len(valor) // 2)], 3))
+        errores.append(f"{campo}: '{valor}' no existe en {nombre}" + (f"; ¿quisiste decir {sugerencias}?" if sugerencias else ""))
+
+
+def validar_claves_factura(datos_factura: Dict[str, Any]) -> List[str]:
+    """
+    Revisa contra los catálogos las claves del payload de crear_factura.
+    Devuelve la lista de errores (vacía si todo está bien).
+    """
+    errores: List[str] = []
+    for ruta, nombre in _CAMPOS_FACTURA:
+        valor: Any = datos_factura
+        for parte in ruta:
+            valor = valor.get(parte) if isinstance(valor, dict) else None
+        _revisar(valor, nombre, ".".join(ruta), errores)
+    for n, item in enumerate(datos_factura.get("Items") or []):
+        if not isinstance(item, dict):
+            continue
+        for campo, nombre in _CAMPOS_PARTIDA:
+            _revisar(item.get(campo), nombre, f"Items.{n}.{campo}", errores)
+    return errores
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "construir":
+        total = construir_catalogo(sys.argv[2], sys.argv[3])
+        print(f"✅ {sys.argv[2]}: {total} claves en {CATALOGOS_SAT_DIR}")
+    elif len(sys.argv) >= 4 and sys.argv[1] == "buscar":
+        for candidato in buscar_en_catalogo(sys.argv[2], " ".join(sys.argv[3:]))["candidatos"]:
+            print(f"{candidato['clave']}\t{candidato['puntaje']}\t{candidato['descripcion']}")
+    else:
+        print("Uso: python -m app.utils.catalogos_sat construir <catalogo> <archivo.csv>\n"
+              "     python -m app.utils.catalogos_sat buscar <catalogo> <texto>")
@@ -0,0 +1,201 @@
+import io
+import os
+import xml.etree.ElementTree as ET
+from typing import Optional, Dict, Any, List, Union, BinaryIO
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# =============================
+#    LECTURA LOCAL DE CFDI XML
+# =============================
+# Un CFDI que llega por WhatsApp es XML con estructura fija: no hace falta
+# mandarlo (en base64) al servicio de documentos para sacar sus datos. Aquí se
+# detecta por contenido y se lee en streaming con un XMLParser que no arma el
+# árbol: cada Concepto se procesa al llegar, así que la memoria no crece con el
+# número de partidas.
+#
+# PDFs, imágenes y cualquier XML que no sea CFDI siguen yendo al servicio remoto.
+
+# Partidas que se devuelven completas; las demás sólo se cuentan
+CFDI_XML_MAX_CONCEPTOS = int(os.getenv("CFDI_XML_MAX_CONCEPTOS", "100"))
+
+_NS_CFDI = ("http://www.sat.gob.mx/cfd/4", "http://www.sat.gob.mx/cfd/3")
+_NS_TIMBRE = "http://www.sat.gob.mx/TimbreFiscalDigital"
+_BYTES_SNIFF = 4096
+_TAMANO_TROZO = 64 * 1024
+
+_ATRIBUTOS_COMPROBANTE = {
+    "Version": "version", "Serie": "serie", "Folio": "folio", "Fecha": "fecha",
+    "TipoDeComprobante": "tipo_comprobante", "Moneda": "moneda", "TipoCambio": "tipo_cambio",
+    "SubTotal": "subtotal", "Descuento": "descuento", "Total": "total",
+    "FormaPago": "forma_pago", "MetodoPago": "metodo_pago", "LugarExpedicion": "lugar_expedicion",
+    "Exportacion": "exportacion", "NoCertificado": "no_certificado",
+}
+_ATRIBUTOS_EMISOR = {"Rfc": "rfc", "Nombre": "nombre", "RegimenFiscal": "regimen_fiscal"}
+_ATRIBUTOS_RECEPTOR = {
+    "Rfc": "rfc", "Nombre": "nombre", "UsoCFDI": "uso_cfdi",
+    "RegimenFiscalReceptor": "regimen_fiscal", "DomicilioFiscalReceptor": "codigo_postal",
+}
+_ATRIBUTOS_CONCEPTO = {
+    "ClaveProdServ": "clave_producto", "NoIdentificacion": "no_identificacion", "Cantidad": "cantidad",
+    "ClaveUnidad": "clave_unidad", "Unidad": "unidad", "Descripcion": "descripcion",
+    "ValorUnitario": "valor_unitario", "Importe": "importe", "Descuento": "descuento",
+    "ObjetoImp": "objeto_impuesto",
+}
+_ATRIBUTOS_IMPUESTO = {
+    "Impuesto": "impuesto", "TipoFactor": "tipo_factor", "TasaOCuota": "tasa_o_cuota",
+    "Base": "base", "Importe": "importe",
+}
+_ATRIBUTOS_TIMBRE = {
+    "UUID": "uuid", "FechaTimbrado": "fecha_timbrado", "RfcProvCertif": "rfc_proveedor",
+    "NoCertificadoSAT": "no_certificado_sat",
+}
+_NUMERICOS = {"subtotal", "descuento", "total", "tipo_cambio", "cantidad", "valor_unitario",
+              "importe", "base", "tasa_o_cuota", "total_trasladados", "total_retenidos"}
+
+
+def _separar(tag: str) -> tuple:
+    """'{ns}Local' → (ns, Local)."""
+    if tag.startswith("{"):
+        ns, local = tag[1:].split("}", 1)
+        return ns, local
+    return "", tag
+
+
+def _mapear(atributos: Dict[str, str], nombres: Dict[str, str]) -> Dict[str, Any]:
+    resultado = {}
+    for original, nombre in nombres.items():
+        valor = atributos.get(original)
+        if valor is None:
+            continue
+        if nombre in _NUMERICOS:
+            try:
+                valor = float(valor)
+            except ValueError:
+                pass
+        resultado[nombre] = valor
+    return resultado
+
+
+def es_cfdi_xml(inicio: bytes) -> bool:
+    """
+    Detección por contenido (no por extensión): XML cuyo primer elemento es
+    cfdi:Comprobante. Con DOCTYPE se rechaza: un CFDI nunca lo trae.
+    """
+    cabeza = inicio[:_BYTES_SNIFF].lstrip(b"\xef\xbb\xbf \t\r\n")
+    if not cabeza.startswith(b"<"):
+        return False
+    if b"<!DOCTYPE" in cabeza or b"<!ENTITY" in cabeza:
+        return False
+    return b"Comprobante" in cabeza and any(ns.encode() in cabeza for ns in _NS_CFDI)
+
+
+class _Eventos:
+    """
+    Destino del XMLParser: junta (evento, ns, local, atributos) sin armar el
+    árbol, así que la memoria no crece con el número de partidas. Un DOCTYPE
+    corta el parseo antes de que expat lea cualquier declaración de entidad.
+    """
+
+    def __init__(self):
+        self.pendientes: List[tuple] = []
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        self.pendientes.append(("start",) + _separar(tag) + (attrib,))
+
+    def end(self, tag: str) -> None:
+        self.pendientes.append(("end",) + _separar(tag) + (None,))
+
+    def doctype(self, name, pubid, system) -> None:
+        raise ValueError("El XML trae DOCTYPE: un CFDI nunca lo trae")
+
+    def close(self) -> None:
+        return None
+
+    def tomar(self) -> List[tuple]:
+        eventos, self.pendientes = self.pendientes, []
+        return eventos
+
+
+def extraer_cfdi(fuente: Union[bytes, BinaryIO]) -> Dict[str, Any]:
+    """
+    Lee un CFDI (bytes o archivo abierto en modo binario) en streaming y
+    devuelve sus datos: comprobante, emisor, receptor, conceptos (hasta
+    CFDI_XML_MAX_CONCEPTOS), impuestos y timbre. ValueError si no es un CFDI
+    o si trae DOCTYPE (aunque no haya pasado por es_cfdi_xml).
+    """
+    flujo = io.BytesIO(fuente) if isinstance(fuente, (bytes, bytearray)) else fuente
+    resultado: Dict[str, Any] = {"tipo_documento": "CFDI", "origen": "local"}
+    conceptos: List[Dict[str, Any]] = []
+    total_conceptos = 0
+    impuestos: Dict[str, Any] = {"trasladados": [], "retenidos": []}
+    pila: List[str] = []
+    concepto_actual: Optional[Dict[str, Any]] = None
+
+    def procesar(evento: str, ns: str, local: str, attrib: Optional[Dict[str, str]]) -> None:
+        nonlocal total_conceptos, concepto_actual
+        if evento == "end":
+            pila.pop()
+            if ns in _NS_CFDI and local == "Concepto":
+                if len(conceptos) < CFDI_XML_MAX_CONCEPTOS:
+                    conceptos.append(concepto_actual)
+                concepto_actual = None
+            return
+
+        padre = pila[-1] if pila else None
+        if not pila and (ns not in _NS_CFDI or local != "Comprobante"):
+            raise ValueError("El XML no es un CFDI")
+        pila.append(local)
+        if ns in _NS_CFDI:
+            if local == "Comprobante":
+                resultado.update(_mapear(attrib, _ATRIBUTOS_COMPROBANTE))
+            elif local == "Emisor" and padre == "Comprobante":
+                resultado["emisor"] = _mapear(attrib, _ATRIBUTOS_EMISOR)
+            elif local == "Receptor" and padre == "Comprobante":
+                resultado["receptor"] = _mapear(attrib, _ATRIBUTOS_RECEPTOR)
+            elif local == "Concepto":
+                total_conceptos += 1
+                concepto_actual = _mapear(attrib, _ATRIBUTOS_CONCEPTO)
+            elif local == "Impuestos" and padre == "Comprobante":
+                impuestos.update(_mapear(attrib, {
+                    "TotalImpuestosTrasladados": "total_trasladados",
+                    "TotalImpuestosRetenidos": "total_retenidos",
+                }))
+            elif local in ("Traslado", "Retencion"):
+                # Dentro de un Concepto es el desglose de la partida; si no, el resumen del comprobante
+                lista = "trasladados" if local == "Traslado" else "retenidos"
+                impuesto = _mapear(attrib, _ATRIBUTOS_IMPUESTO)
+                if concepto_actual is not None:
+                    concepto_actual.setdefault(lista, []).append(impuesto)
+                else:
+                    impuestos[lista].append(impuesto)
+        elif ns == _NS_TIMBRE and local == "TimbreFiscalDigital":
+            resultado["timbre"] = _mapear(attrib, _ATRIBUTOS_TIMBRE)
+            resultado["uuid"] = resultado["timbre"].get("uuid")
+
+    destino = _Eventos()
+    parser = ET.XMLParser(target=destino)
+    try:
+        while True:
+            trozo = flujo.read(_TAMANO_TROZO)
+            if not trozo:
+                break
+            parser.feed(trozo)
+            for evento in destino.tomar():
+                procesar(*evento)
+        parser.close()
+        for evento in destino.tomar():
+            procesar(*evento)
+    except ET.ParseError as e:
+        raise ValueError(f"XML mal formado: {e}") from e
+
+    if "version" not in resultado:
+        raise ValueError("El XML no es un CFDI")
+    resultado["conceptos"] = conceptos
+    resultado["total_conceptos"] = total_conceptos
+    if total_conceptos > len(conceptos):
+        resultado["conceptos_omitidos"] = total_conceptos - len(conceptos)
+    resultado["impuestos"] = impuestos
+    resultado.setdefault("uuid", None)
+    return resultado
@@ -0,0 +1,55 @@
+import os
+import json
+from typing import Dict, Any
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# -----------------------------
+# Modelos disponibles
+# -----------------------------
+MODELO_PESADO = os.getenv("OPENAI_MODELO_PESADO", "gpt-4o")
+MODELO_LIGERO = os.getenv("OPENAI_MODELO_LIGERO", "gpt-4o-mini")
+
+# =============================
+#     TABLA DE RUTEO POR ETAPA
+# =============================
+# Cada etapa del pipeline usa su propio modelo, max_tokens y timeout (segundos).
+# Las etapas baratas (clasificar, respuestas cortas) van al modelo ligero;
+# la construcción de la factura se queda en el modelo pesado.
+
+RUTAS_MODELO: Dict[str, Dict[str, Any]] = {
+    "clasificar": {"modelo": MODELO_LIGERO, "max_tokens": 50, "timeout": 10},
+    "parametrizar:consultar_facturas": {"modelo": MODELO_LIGERO, "max_tokens": 150, "timeout": 10},
+    "parametrizar:descargar_documento": {"modelo": MODELO_LIGERO, "max_tokens": 100, "timeout": 10},
+    "parametrizar:descargar_documentos_zip": {"modelo": MODELO_LIGERO, "max_tokens": 400, "timeout": 10},
+    "parametrizar:analizar_facturas": {"modelo": MODELO_LIGERO, "max_tokens": 200, "timeout": 10},
+    "parametrizar:buscar_catalogo_sat": {"modelo": MODELO_LIGERO, "max_tokens": 100, "timeout": 10},
+    "parametrizar:crear_factura": {"modelo": MODELO_PESADO, "max_tokens": 2500, "timeout": 60},
+    "parametrizar:respuesta_final": {"modelo": MODELO_LIGERO, "max_tokens": 50, "timeout": 10},
+    "borrador_factura": {"modelo": MODELO_LIGERO, "max_tokens": 400, "timeout": 15},
+    "respuesta_final": {"modelo": MODELO_LIGERO, "max_tokens": 250, "timeout": 20},
+    "resumir_historial": {"modelo": MODELO_LIGERO, "max_tokens": 300, "timeout": 15},
+    "reparar_json": {"modelo": MODELO_LIGERO, "max_tokens": 2500, "timeout": 30},
+    "default": {"modelo": MODELO_PESADO, "max_tokens": 500, "timeout": 30},
+}
+
+# Permite ajustar la tabla sin desplegar código, p. ej.:
+# OPENAI_RUTAS_MODELO='{"respuesta_final": {"modelo": "gpt-4o"}, "clasificar": {"timeout": 5}}'
+_overrides = os.getenv("OPENAI_RUTAS_MODELO")
+if _overrides:
+    try:
+        for _etapa, _config in json.loads(_overrides).items():
+            RUTAS_MODELO.setdefault(_etapa, dict(RUTAS_MODELO["default"])).update(_config)
+    except (json.JSONDecodeError, AttributeError) as e:
+        print(f"⚠️ OPENAI_RUTAS_MODELO inválido, se ignora: {e}")
+
+
+def obtener_config_etapa(etapa: str) -> Dict[str, Any]:
+    """
+    Devuelve {"modelo", "max_tokens", "timeout"} para una etapa.
+    Las etapas 'parametrizar:<funcion>' no registradas heredan de 'default'.
+    """
+    config = dict(RUTAS_MODELO["default"])
+    config.update(RUTAS_MODELO.get(etapa, {}))
+    return config
@@ -2,8 +2,9 @@ import os
 import json
 import uuid
 import redis
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
+from app.utils.bm25 import fragmentar, documento
 
 load_dotenv()
 
@@ -29,6 +30,7 @@ def agregar_mensaje_historial(user_id: str, rol: str, contenido: str, ttl_second
     historial = obtener_historial(user_id)
     historial.append({"role": rol, "content": contenido})
     redis_client.set(key, json.dumps(historial), ex=ttl_seconds)
+    indexar_mensaje_historial(user_id, rol, contenido, ttl_seconds=ttl_seconds)
 
 def obtener_historial(user_id: str) -> List[Dict[str, Any]]:
     """
@@ -43,7 +45,7 @@ def limpiar_historial(user_id: str) -> None:
     Borra el historial de un usuario.
     """
     key = _historial_key(user_id)
-    redis_client.delete(key)
+    redis_client.delete(key, _resumen_key(user_id), *[_indice_key(user_id, p) for p in ("docs", "df", "n")])
 
 def actualizar_historial(user_id: str, historial: list, ttl_seconds: int = 600) -> None:
     """
@@ -52,6 +54,85 @@ def actualizar_historial(user_id: str, historial: list, ttl_seconds: int = 600)
     key = _historial_key(user_id)
     redis_client.set(key, json.dumps(historial), ex=ttl_seconds)
 
+def _resumen_key(user_id: str) -> str:
+    return f"resumen:{user_id}"
+
+def obtener_resumen(user_id: str) -> str:
+    """
+    Obtiene el resumen acumulado de los turnos viejos ya compactados.
+    """
+    return redis_client.get(_resumen_key(user_id)) or ""
+
+def guardar_resumen(user_id: str, resumen: str, ttl_seconds: int = 600) -> None:
+    """
+    Guarda el resumen acumulado con el mismo TTL que el historial.
+    """
+    redis_client.set(_resumen_key(user_id), resumen, ex=ttl_seconds)
+
+# =============================
+#   ÍNDICE LÉXICO DEL HISTORIAL
+# =============================
+# Cada mensaje agregado se indexa (BM25) para poder recuperar entradas viejas
+# relevantes aunque ya no estén en el historial o se hayan compactado.
+
+INDICE_MAX_DOCS = int(os.getenv("INDICE_HISTORIAL_MAX_DOCS", "2000"))
+
+def _indice_key(user_id: str, parte: str) -> str:
+    return f"indice:{user_id}:{parte}"
+
+# Recorta el índice a ARGV[1] documentos y descuenta de la frecuencia documental
+# los términos de los que salen, para que el IDF sólo refleje lo que queda
+_RECORTAR_INDICE_LUA = """
+local exceso = redis.call("LLEN", KEYS[1]) - tonumber(ARGV[1])
+local quitados = 0
+while exceso > 0 do
+  local doc = cjson.decode(redis.call("LPOP", KEYS[1]))
+  for termino, _ in pairs(doc["tf"] or {}) do
+    if redis.call("HINCRBY", KEYS[2], termino, -1) <= 0 then
+      redis.call("HDEL", KEYS[2], termino)
+    end
+  end
+  exceso = exceso - 1
+  quitados = quitados + 1
+end
+return quitados
+"""
+
+def indexar_mensaje_historial(user_id: str, rol: str, contenido: Any, ttl_seconds: int = 600) -> None:
+    """
+    Agrega los documentos de un mensaje al índice del usuario (incremental):
+    guarda texto + frecuencias y actualiza la frecuencia documental de cada término.
+    """
+    try:
+        seq = redis_client.incr(_indice_key(user_id, "n"))
+        docs_key, df_key = _indice_key(user_id, "docs"), _indice_key(user_id, "df")
+        pipe = redis_client.pipeline(transaction=False)
+        for texto in fragmentar(contenido):
+            doc = documento(texto)
+            if not doc["len"]:
+                continue
+            doc.update({"rol": rol, "msg": seq})
+            pipe.rpush(docs_key, json.dumps(doc, ensure_ascii=False))
+            for termino in doc["tf"]:
+                pipe.hincrby(df_key, termino, 1)
+        pipe.eval(_RECORTAR_INDICE_LUA, 2, docs_key, df_key, INDICE_MAX_DOCS)
+        for parte in ("docs", "df", "n"):
+            pipe.expire(_indice_key(user_id, parte), ttl_seconds)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"⚠️ No se pudo indexar mensaje de {user_id}: {e}")
+
+def obtener_indice_historial(user_id: str) -> Tuple[List[Dict[str, Any]], Dict[str, int], int]:
+    """
+    Devuelve (documentos, frecuencia documental, total de mensajes indexados).
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.lrange(_indice_key(user_id, "docs"), 0, -1)
+    pipe.hgetall(_indice_key(user_id, "df"))
+    pipe.get(_indice_key(user_id, "n"))
+    docs, df, n = pipe.execute()
+    return [json.loads(d) for d in docs], {k: int(v) for k, v in df.items()}, int(n or 0)
+
 # =============================
 #           COLAS
 # =============================
@@ -67,6 +148,34 @@ def enqueue_user_message(user_id: str, message: Dict[str, Any]) -> None:
     key = _queue_key(user_id)
     redis_client.rpush(key, json.dumps(message))
 
+# Marca el id como visto (SET NX EX) y encola en el mismo viaje a Redis:
+# dos entregas simultáneas del mismo mensaje no pueden encolarse ambas
+_ENCOLAR_SI_NUEVO_LUA = """
+if redis.call("SET", KEYS[1], "1", "NX", "EX", ARGV[2]) then
+  return redis.call("RPUSH", KEYS[2], ARGV[1])
+end
+return 0
+"""
+
+def _visto_key(user_id: str, id_mensaje: str) -> str:
+    return f"visto:{user_id}:{id_mensaje}"
+
+def enqueue_user_message_once(user_id: str, message: Dict[str, Any], id_mensaje: str,
+                              ttl_seconds: int = 86400) -> Optional[int]:
+    """
+    Encola el mensaje sólo si `id_mensaje` no se ha visto en los últimos
+    `ttl_seconds`. Devuelve el largo de la cola, o None si es un duplicado.
+    """
+    largo = redis_client.eval(
+        _ENCOLAR_SI_NUEVO_LUA, 2, _visto_key(user_id, id_mensaje), _queue_key(user_id),
+        json.dumps(message), int(ttl_seconds)
+    )
+    return int(largo) if largo else None
+
+def mensaje_ya_visto(user_id: str, id_mensaje: str) -> bool:
+    """Consulta sin marcar (para no leer el cuerpo de un reintento ya encolado)."""
+    return bool(redis_client.exists(_visto_key(user_id, id_mensaje)))
+
 def dequeue_user_message(user_id: str) -> Optional[Dict[str, Any]]:
     """
     Saca el siguiente mensaje de la cola del usuario.
@@ -75,6 +184,20 @@ def dequeue_user_message(user_id: str) -> Optional[Dict[str, Any]]:
     msg = redis_client.lpop(key)
     return json.loads(msg) if msg else None
 
+def peek_user_messages(user_id: str) -> List[Dict[str, Any]]:
+    """
+    Devuelve los mensajes en cola del usuario sin sacarlos.
+    """
+    key = _queue_key(user_id)
+    return [json.loads(m) for m in redis_client.lrange(key, 0, -1)]
+
+def peek_next_user_message(user_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Devuelve el siguiente mensaje de la cola sin sacarlo.
+    """
+    msg = redis_client.lindex(_queue_key(user_id), 0)
+    return json.loads(msg) if msg else None
+
 def get_queue_length(user_id: str) -> int:
     key = _queue_key(user_id)
     return redis_client.llen(key)
@@ -129,3 +252,302 @@ def refresh_user_lock(user_id: str, ttl_seconds: int = 300) -> None:
     # Sólo renueva si el lock existe
     if redis_client.ttl(key) > 0:
         redis_client.expire(key, ttl_seconds)
+
+def acquire_task_lock(nombre: str, ttl_seconds: int = 300) -> Optional[str]:
+    """
+    Lock para tareas de fondo: sólo un worker (de todos los procesos) la ejecuta.
+    """
+    return acquire_user_lock(f"tarea:{nombre}", ttl_seconds)
+
+def release_task_lock(nombre: str, token: str) -> bool:
+    return release_user_lock(f"tarea:{nombre}", token)
+
+def refresh_task_lock(nombre: str, ttl_seconds: int = 300) -> None:
+    refresh_user_lock(f"tarea:{nombre}", ttl_seconds)
+
+# =============================
+#     ESTADO DEL TURNO EN CURSO
+# =============================
+# Junto al lock del usuario: id del turno y su estado (activo, efectos,
+# cancelado). Reclamar un efecto y cancelar el turno son atómicos entre sí,
+# así que un turno cancelado nunca emite ni envía nada, aunque su trabajo
+# siga corriendo en un hilo o en otro proceso.
+
+def _turno_key(user_id: str) -> str:
+    return f"turno:{user_id}"
+
+# Devuelve 1 si el turno puede tener efectos (y lo marca), 0 si fue cancelado o reemplazado
+_RECLAMAR_EFECTO_LUA = """
+local id = redis.call("HGET", KEYS[1], "id")
+if id and id ~= ARGV[1] then
+  return 0
+end
+if redis.call("HGET", KEYS[1], "estado") == "cancelado" then
+  return 0
+end
+redis.call("HSET", KEYS[1], "id", ARGV[1], "estado", "efectos")
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+return 1
+"""
+
+# Devuelve 1 si se canceló, 0 si el turno ya tuvo efectos (o ya no es el actual)
+_CANCELAR_TURNO_LUA = """
+if redis.call("HGET", KEYS[1], "id") ~= ARGV[1] then
+  return 0
+end
+if redis.call("HGET", KEYS[1], "estado") == "efectos" then
+  return 0
+end
+redis.call("HSET", KEYS[1], "estado", "cancelado")
+return 1
+"""
+
+def iniciar_turno(user_id: str, turno_id: str, ttl_seconds: int = 300) -> None:
+    key = _turno_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={"id": turno_id, "estado": "activo"})
+    pipe.expire(key, ttl_seconds)
+    pipe.execute()
+
+def reclamar_efecto_turno(user_id: str, turno_id: str, ttl_seconds: int = 300) -> bool:
+    """Llamar justo antes de cada efecto visible (enviar, emitir). False: no hacerlo."""
+    return redis_client.eval(_RECLAMAR_EFECTO_LUA, 1, _turno_key(user_id), turno_id, int(ttl_seconds)) == 1
+
+def cancelar_turno(user_id: str, turno_id: str) -> bool:
+    """Cancela el turno si aún no tiene efectos."""
+    return redis_client.eval(_CANCELAR_TURNO_LUA, 1, _turno_key(user_id), turno_id) == 1
+
+def turno_con_efectos(user_id: str, turno_id: str) -> bool:
+    id_actual, estado = redis_client.hmget(_turno_key(user_id), "id", "estado")
+    return id_actual == turno_id and estado == "efectos"
+
+# =============================
+#    BORRADOR DE FACTURA
+# =============================
+# Factura en construcción de cada usuario: cada turno sólo le aplica el cambio
+# que trae el mensaje nuevo (ver borrador_factura_service).
+
+def _borrador_key(user_id: str) -> str:
+    return f"borrador_factura:{user_id}"
+
+def obtener_borrador(user_id: str) -> Optional[Dict[str, Any]]:
+    data = redis_client.get(_borrador_key(user_id))
+    return json.loads(data) if data else None
+
+def guardar_borrador(user_id: str, borrador: Dict[str, Any], ttl_seconds: int = 3600) -> None:
+    redis_client.set(_borrador_key(user_id), json.dumps(borrador, ensure_ascii=False), ex=ttl_seconds)
+
+def eliminar_borrador(user_id: str) -> None:
+    redis_client.delete(_borrador_key(user_id))
+
+# =============================
+#       EMISIÓN MASIVA
+# =============================
+# Lotes de facturas subidos como CSV/XLSX (ver emision_masiva_service). El
+# payload de cada factura y su resultado se guardan por separado para poder
+# reanudar el lote tras un reinicio sin volver a emitir lo ya timbrado.
+
+LOTES_PENDIENTES_KEY = "lotes_pendientes"
+
+def _lote_key(lote_id: str, parte: str = "meta") -> str:
+    return f"lote:{lote_id}:{parte}"
+
+def crear_lote(lote_id: str, meta: Dict[str, Any], facturas: List[Dict[str, Any]],
+               ttl_seconds: int = 7 * 24 * 3600) -> None:
+    pipe = redis_client.pipeline()
+    pipe.set(_lote_key(lote_id), json.dumps(meta, ensure_ascii=False), ex=ttl_seconds)
+    pipe.hset(_lote_key(lote_id, "facturas"), mapping={
+        str(n): json.dumps(f, ensure_ascii=False) for n, f in enumerate(facturas)
+    })
+    pipe.expire(_lote_key(lote_id, "facturas"), ttl_seconds)
+    pipe.sadd(LOTES_PENDIENTES_KEY, lote_id)
+    pipe.execute()
+
+def obtener_lote(lote_id: str) -> Optional[Dict[str, Any]]:
+    data = redis_client.get(_lote_key(lote_id))
+    return json.loads(data) if data else None
+
+def actualizar_lote(lote_id: str, meta: Dict[str, Any]) -> None:
+    redis_client.set(_lote_key(lote_id), json.dumps(meta, ensure_ascii=False), keepttl=True)
+
+def obtener_facturas_lote(lote_id: str) -> Dict[int, Dict[str, Any]]:
+    return {int(n): json.loads(f) for n, f in redis_client.hgetall(_lote_key(lote_id, "facturas")).items()}
+
+def obtener_resultados_lote(lote_id: str) -> Dict[int, Dict[str, Any]]:
+    return {int(n): json.loads(r) for n, r in redis_client.hgetall(_lote_key(lote_id, "resultados")).items()}
+
+def guardar_resultado_lote(lote_id: str, indice: int, resultado: Dict[str, Any]) -> None:
+    key = _lote_key(lote_id, "resultados")
+    redis_client.hset(key, str(indice), json.dumps(resultado, ensure_ascii=False))
+    if redis_client.ttl(key) < 0:
+        redis_client.expire(key, max(redis_client.ttl(_lote_key(lote_id)), 60))
+
+def cerrar_lote(lote_id: str) -> None:
+    redis_client.srem(LOTES_PENDIENTES_KEY, lote_id)
+
+def obtener_lotes_pendientes() -> List[str]:
+    return sorted(redis_client.smembers(LOTES_PENDIENTES_KEY))
+
+# =============================
+#    DOCUMENTOS PROCESADOS
+# =============================
+# Datos extraídos de un archivo recibido, por SHA-256 de su contenido
+# (ver documentos_service): el mismo archivo no se vuelve a procesar.
+
+def _documento_procesado_key(sha256: str) -> str:
+    return f"documento_procesado:{sha256}"
+
+def obtener_documento_procesado(sha256: str) -> Optional[Any]:
+    data = redis_client.get(_documento_procesado_key(sha256))
+    return json.loads(data) if data else None
+
+def guardar_documento_procesado(sha256: str, datos: Any, ttl_seconds: int = 7 * 24 * 3600) -> None:
+    redis_client.set(_documento_procesado_key(sha256), json.dumps(datos, ensure_ascii=False), ex=ttl_seconds)
+
+# =============================
+#   RESULTADOS FUERA DE BANDA
+# =============================
+# Resultados grandes (p. ej. consultar_facturas completo) se guardan aparte
+# y en el historial sólo viaja un handle con la página proyectada.
+
+def _resultado_key(handle: str) -> str:
+    return f"resultado:{handle}"
+
+def guardar_resultado(datos: Any, ttl_seconds: int = 1800) -> str:
+    """
+    Guarda un resultado completo y devuelve su handle.
+    """
+    handle = uuid.uuid4().hex[:12]
+    redis_client.set(_resultado_key(handle), json.dumps(datos, ensure_ascii=False), ex=ttl_seconds)
+    return handle
+
+def obtener_resultado(handle: str) -> Optional[Any]:
+    """
+    Recupera un resultado por handle (None si expiró).
+    """
+    data = redis_client.get(_resultado_key(handle))
+    return json.loads(data) if data else None
+
+# =============================
+#         MÉTRICAS LLM
+# =============================
+
+def _metricas_llm_key(etapa: str) -> str:
+    return f"metricas_llm:{etapa}"
+
+def registrar_metricas_llm(etapa: str, modelo: str, latencia_ms: float, prompt_tokens: int = 0,
+                           completion_tokens: int = 0, error: bool = False) -> None:
+    """
+    Acumula latencia y tokens por etapa del pipeline (una sola ida a Redis).
+    Guarda además las últimas latencias para poder calcular percentiles.
+    """
+    key = _metricas_llm_key(etapa)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(key, "llamadas", 1)
+        pipe.hincrby(key, "errores", 1 if error else 0)
+        pipe.hincrbyfloat(key, "latencia_ms_total", round(latencia_ms, 2))
+        pipe.hincrby(key, "prompt_tokens", prompt_tokens or 0)
+        pipe.hincrby(key, "completion_tokens", completion_tokens or 0)
+        pipe.hset(key, "modelo", modelo)
+        pipe.lpush(f"{key}:latencias", round(latencia_ms, 2))
+        pipe.ltrim(f"{key}:latencias", 0, 999)
+        pipe.execute()
+    except redis.RedisError as e:
+        # Las métricas nunca deben tumbar una respuesta al usuario
+        print(f"⚠️ No se pudieron registrar métricas LLM ({etapa}): {e}")
+
+def obtener_metricas_llm() -> Dict[str, Dict[str, Any]]:
+    """
+    Resumen por etapa: llamadas, errores, tokens, latencia media y p50/p95.
+    """
+    resumen = {}
+    for key in redis_client.keys("metricas_llm:*"):
+        if key.endswith(":latencias"):
+            continue
+        etapa = key.split(":", 1)[1]
+        datos = redis_client.hgetall(key)
+        llamadas = int(datos.get("llamadas", 0))
+        latencias = sorted(float(x) for x in redis_client.lrange(f"{key}:latencias", 0, -1))
+        resumen[etapa] = {
+            "modelo": datos.get("modelo"),
+            "llamadas": llamadas,
+            "errores": int(datos.get("errores", 0)),
+            "prompt_tokens": int(datos.get("prompt_tokens", 0)),
+            "completion_tokens": int(datos.get("completion_tokens", 0)),
+            "latencia_media_ms": float(datos.get("latencia_ms_total", 0)) / llamadas if llamadas else 0.0,
+            "latencia_p50_ms": latencias[len(latencias) // 2] if latencias else None,
+            "latencia_p95_ms": latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))] if latencias else None,
+        }
+    return resumen
+
+# =============================
+#     USO DE LLM POR USUARIO
+# =============================
+# Contadores diarios por usuario (total, por etapa y por función), acumulados
+# por función y un ranking diario de usuarios por tokens para encontrar los
+# más caros. Las etapas sin función propia (clasificar, resumir_historial)
+# sólo cuentan en el total y en su etapa.
+
+USO_LLM_TTL_SECONDS = int(os.getenv("USO_LLM_TTL_SECONDS", str(35 * 24 * 3600)))
+
+def _uso_usuario_key(user_id: str, fecha: str) -> str:
+    return f"uso_llm:usuario:{user_id}:{fecha}"
+
+def _uso_ranking_key(fecha: str) -> str:
+    return f"uso_llm:ranking:{fecha}"
+
+def _uso_funcion_key(funcion: str) -> str:
+    return f"uso_llm:funcion:{funcion}"
+
+def registrar_uso_llm(user_id: str, etapa: str, funcion: Optional[str], fecha: str,
+                      prompt_tokens: int, completion_tokens: int) -> None:
+    """
+    Suma el uso real reportado por OpenAI (una sola ida a Redis).
+    """
+    total = (prompt_tokens or 0) + (completion_tokens or 0)
+    usuario_key = _uso_usuario_key(user_id, fecha)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(usuario_key, "llamadas", 1)
+        pipe.hincrby(usuario_key, "prompt_tokens", prompt_tokens or 0)
+        pipe.hincrby(usuario_key, "completion_tokens", completion_tokens or 0)
+        pipe.hincrby(usuario_key, "total_tokens", total)
+        pipe.hincrby(usuario_key, f"etapa:{etapa}", total)
+        if funcion:
+            pipe.hincrby(usuario_key, f"funcion:{funcion}", total)
+            pipe.hincrby(_uso_funcion_key(funcion), "llamadas", 1)
+            pipe.hincrby(_uso_funcion_key(funcion), "total_tokens", total)
+        pipe.expire(usuario_key, USO_LLM_TTL_SECONDS)
+        pipe.zincrby(_uso_ranking_key(fecha), total, user_id)
+        pipe.expire(_uso_ranking_key(fecha), USO_LLM_TTL_SECONDS)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"⚠️ No se pudo registrar uso LLM de {user_id}: {e}")
+
+def obtener_uso_usuario(user_id: str, fecha: str) -> Dict[str, int]:
+    """
+    Uso de un usuario en un día (YYYY-MM-DD): totales, por etapa y por función.
+    """
+    datos = redis_client.hgetall(_uso_usuario_key(user_id, fecha))
+    return {k: int(v) for k, v in datos.items()}
+
+def obtener_tokens_usados_hoy(user_id: str, fecha: str) -> int:
+    return int(redis_client.hget(_uso_usuario_key(user_id, fecha), "total_tokens") or 0)
+
+def obtener_ranking_uso(fecha: str, limite: int = 10) -> List[Dict[str, Any]]:
+    """
+    Usuarios con más tokens consumidos en el día.
+    """
+    ranking = redis_client.zrevrange(_uso_ranking_key(fecha), 0, limite - 1, withscores=True)
+    return [{"user_id": user_id, "total_tokens": int(score)} for user_id, score in ranking]
+
+def obtener_uso_funciones() -> Dict[str, Dict[str, int]]:
+    """
+    Uso acumulado por función del pipeline.
+    """
+    resumen = {}
+    for key in redis_client.keys("uso_llm:funcion:*"):
+        resumen[key.split(":", 2)[2]] = {k: int(v) for k, v in redis_client.hgetall(key).items()}
+    return resumen
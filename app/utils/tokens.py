@@ -0,0 +1,51 @@
+from functools import lru_cache
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken es opcional: sin él se usa una aproximación
+    tiktoken = None
+
+# Tokens extra que agrega el formato de chat por cada mensaje y por la respuesta
+TOKENS_POR_MENSAJE = 4
+TOKENS_RESPUESTA = 3
+
+
+@lru_cache(maxsize=8)
+def _encoder(modelo: str):
+    """Carga el tokenizer una sola vez por modelo (cargarlo cuesta ~100 ms)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(modelo)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def contar_tokens(texto: str, modelo: str = "gpt-4o") -> int:
+    """Cuenta tokens localmente; ~4 caracteres por token si no hay tiktoken."""
+    encoder = _encoder(modelo)
+    if encoder is None:
+        return len(texto or "") // 4 + 1
+    return len(encoder.encode(texto or "", disallowed_special=()))
+
+
+def recortar_tokens(texto: str, max_tokens: int, modelo: str = "gpt-4o") -> str:
+    """
+    Conserva el final del texto hasta max_tokens (lo más reciente es lo que
+    importa en un resumen acumulado). Mismo conteo que contar_tokens.
+    """
+    texto = texto or ""
+    if max_tokens <= 0:
+        return ""
+    if contar_tokens(texto, modelo) <= max_tokens:
+        return texto
+    encoder = _encoder(modelo)
+    if encoder is None:
+        return texto[-(max_tokens - 1) * 4:] if max_tokens > 1 else ""
+    return encoder.decode(encoder.encode(texto, disallowed_special=())[-max_tokens:])
+
+
+def contar_tokens_mensajes(messages: List[Dict[str, str]], modelo: str = "gpt-4o") -> int:
+    """Tokens de entrada de una llamada de chat completa."""
+    return sum(contar_tokens(m.get("content") or "", modelo) + TOKENS_POR_MENSAJE for m in messages) + TOKENS_RESPUESTA
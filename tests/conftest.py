@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Los módulos leen su configuración al importarse: directorios temporales
+# propios y una llave ficticia para que el cliente de OpenAI se pueda crear.
+_TMP = tempfile.mkdtemp(prefix="orquestador-tests-")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ARCHIVOS_TEMP_DIR", os.path.join(_TMP, "archivos_temp"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis  # noqa: E402
+from app.utils import redis_client as _redis_client  # noqa: E402
+
+
+@pytest.fixture
+def redis_falso(monkeypatch):
+    """Redis en memoria con Lua (fakeredis[lua]): los scripts corren tal cual."""
+    cliente = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(_redis_client, "redis_client", cliente)
+    return cliente
@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+from app.services import analitica_service as an
+
+
+def _facturas(n=300, semilla=7):
+    azar = random.Random(semilla)
+    facturas = []
+    for _ in range(n):
+        factura = {
+            "Rfc": azar.choice(["aaa010101aaa", "AAA010101AAA", "BBB010101BBB", "CCC010101CCC", "XAXX010101000"]),
+            "Date": f"2025-{azar.randint(1, 4):02d}-{azar.randint(1, 28):02d}T10:00:00",
+            "Status": azar.choice(["Active", "active", "Canceled"]),
+        }
+        if azar.random() < 0.5:
+            factura["TaxName"] = azar.choice(["Uno SA", "Dos SC"])
+        # Algunos registros sin Total/Subtotal: su grupo no se puede sumar
+        if azar.random() < 0.97:
+            factura["Subtotal"] = round(azar.uniform(1, 5000), 2)
+        if azar.random() < 0.97:
+            factura["Total"] = round(factura.get("Subtotal", 0) * 1.16, 2)
+        if azar.random() < 0.3:
+            factura["Discount"] = round(azar.uniform(0, 50), 2)
+        facturas.append(factura)
+    return facturas
+
+
+def _completas():
+    return [f for f in _facturas() if "Total" in f and "Subtotal" in f]
+
+
+def _referencia(facturas, agrupar_por):
+    """Las mismas agregaciones con dicts y sum()."""
+    grupos = {}
+    for f in facturas:
+        llave = {
+            "ninguno": "total",
+            "rfc": f["Rfc"].upper(),
+            "mes": f["Date"][:7],
+            "dia": f["Date"][:10],
+            "status": f["Status"].lower(),
+        }[agrupar_por]
+        grupo = grupos.setdefault(llave, {"clave": llave, "facturas": 0, "subtotal": [], "impuestos": [], "total": []})
+        if f.get("TaxName") and "nombre" not in grupo and grupo["facturas"] == 0:
+            grupo["nombre"] = f["TaxName"]
+        grupo["facturas"] += 1
+        total, subtotal = f.get("Total"), f.get("Subtotal")
+        grupo["subtotal"].append(subtotal)
+        grupo["total"].append(total)
+        grupo["impuestos"].append(None if total is None or subtotal is None else total - subtotal + f.get("Discount", 0))
+
+    for grupo in grupos.values():
+        for c in ("subtotal", "impuestos", "total"):
+            valores = grupo[c]
+            grupo[c] = None if None in valores else round(sum(valores), 2)
+        if agrupar_por != "rfc":
+            grupo.pop("nombre", None)
+    return grupos
+
+
+@pytest.mark.parametrize("agrupar_por", an.AGRUPACIONES)
+def test_agregar_coincide_con_referencia(monkeypatch, agrupar_por):
+    monkeypatch.setattr(an, "ANALITICA_MAX_FILAS", 1000)
+    facturas = _facturas()
+
+    resultado = an.agregar(an.cargar_columnas(facturas), agrupar_por)
+    esperado = _referencia(facturas, agrupar_por)
+
+    assert resultado["grupos"] == len(esperado)
+    assert {f["clave"]: f for f in resultado["filas"]} == esperado
+    assert resultado["totales"]["facturas"] == len(facturas)
+
+
+def test_orden_y_top(monkeypatch):
+    monkeypatch.setattr(an, "ANALITICA_MAX_FILAS", 1000)
+    columnas = an.cargar_columnas(_facturas())
+
+    por_mes = an.agregar(columnas, "mes")["filas"]
+    assert [f["clave"] for f in por_mes] == sorted(f["clave"] for f in por_mes)
+
+    facturas = _completas()
+    completas = an.cargar_columnas(facturas)
+    top = an.agregar(completas, "rfc", top=2)["filas"]
+    esperado = sorted(_referencia(facturas, "rfc").values(), key=lambda f: f["total"], reverse=True)
+    assert [f["clave"] for f in top] == [f["clave"] for f in esperado[:2]]
+    assert [f["clave"] for f in an.agregar(completas, "rfc", orden="asc")["filas"]] == [f["clave"] for f in esperado[::-1]]
+
+
+def test_analizar_excluye_canceladas(redis_falso, monkeypatch):
+    facturas = _completas()
+    monkeypatch.setattr(an, "consultar_facturas", lambda filtro: facturas)
+
+    resultado = an.analizar_facturas({"dateStart": "2025-01-01"})
+    vigentes = [f for f in facturas if f["Status"].lower() != "canceled"]
+
+    assert resultado["totales"]["facturas"] == len(vigentes)
+    assert resultado["totales"]["total"] == round(sum(f["Total"] for f in vigentes), 2)
+    assert resultado["filtro"] == {"dateStart": "2025-01-01", "type": "issued"}
@@ -0,0 +1,121 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from app.utils import almacen_archivos, archivos_temp
+
+
+def test_archivo_temporal_chico_queda_en_memoria():
+    archivo = archivos_temp.archivo_temporal("F1.xml", b"<cfdi/>")
+    assert archivo.en_memoria
+    assert len(archivo) == 7
+    assert archivo.read() == b"<cfdi/>"
+    assert archivo.nombre == "F1.xml"
+
+
+def test_archivo_temporal_grande_pasa_a_disco():
+    archivo = archivos_temp.ArchivoTemporal("F1.pdf", max_bytes=10)
+    archivo.write(b"x" * 11)
+    assert not archivo.en_memoria
+    assert len(archivo) == 11
+    archivo.close()
+
+
+def test_fileno_tambien_cuenta_como_volcado():
+    archivo = archivos_temp.archivo_temporal("F1.xml", b"abc")
+    archivo.fileno()
+    assert not archivo.en_memoria
+    archivo.close()
+
+
+def test_archivo_vacio_es_verdadero():
+    assert archivos_temp.archivo_temporal("vacio.txt")
+
+
+
+@pytest.fixture
+def carpeta(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivos_temp, "ARCHIVOS_TEMP_DIR", str(tmp_path))
+    monkeypatch.setattr(archivos_temp, "_EXCLUIDOS", {os.path.abspath(tmp_path / "cache")})
+    monkeypatch.setattr(archivos_temp, "_registro", {})
+    return tmp_path
+
+
+def _temporal(carpeta, tamano=10, edad=0, subdir=None):
+    destino = carpeta / subdir if subdir else carpeta
+    destino.mkdir(parents=True, exist_ok=True)
+    ruta = destino / f"{uuid.uuid4().hex}_doc.pdf"
+    ruta.write_bytes(b"x" * tamano)
+    if edad:
+        antes = time.time() - edad
+        os.utime(ruta, (antes, antes))
+    return str(ruta)
+
+
+def test_barrer_huerfanos_viejos_y_respeta_otros_archivos(carpeta):
+    viejo = _temporal(carpeta, edad=archivos_temp.ARCHIVOS_TEMP_TTL_HUERFANOS_SEGUNDOS + 10)
+    reciente = _temporal(carpeta)
+    ajeno = carpeta / "indice.sqlite"
+    ajeno.write_bytes(b"db")
+    os.utime(ajeno, (0, 0))
+
+    resultado = archivos_temp.barrer()
+    assert resultado["huerfanos"] == 1
+    assert not os.path.exists(viejo)
+    assert os.path.exists(reciente) and ajeno.exists()
+
+
+def test_barrer_ttl_vencido_salvo_en_uso(carpeta):
+    vencido = archivos_temp.registrar(_temporal(carpeta), ttl_seconds=-1)
+    tomado = archivos_temp.registrar(_temporal(carpeta), ttl_seconds=-1)
+    vigente = archivos_temp.registrar(_temporal(carpeta), ttl_seconds=600)
+
+    with archivos_temp.en_uso(tomado):
+        assert archivos_temp.barrer()["barridos"] == 1
+        assert os.path.exists(tomado)
+    assert not os.path.exists(vencido)
+    assert os.path.exists(vigente)
+    # Al soltarlo ya se puede barrer
+    assert archivos_temp.barrer()["barridos"] == 1
+    assert not os.path.exists(tomado)
+
+
+def test_cuota_desaloja_lo_usado_hace_mas_tiempo_salvo_en_uso(carpeta):
+    rutas = [archivos_temp.registrar(_temporal(carpeta, tamano=100)) for _ in range(3)]
+    archivos_temp.tomar(rutas[0])
+    for n, ruta in enumerate(rutas):
+        archivos_temp._registro[archivos_temp._clave(ruta)]["usado"] = 1000 + n
+
+    resultado = archivos_temp.barrer(max_bytes=250)
+    assert resultado == {"barridos": 0, "huerfanos": 0, "desalojados": 1, "bytes": 100}
+    assert [os.path.exists(r) for r in rutas] == [True, False, True]
+
+
+def test_barrer_no_entra_al_cache_de_documentos(carpeta):
+    viejo = archivos_temp.ARCHIVOS_TEMP_TTL_HUERFANOS_SEGUNDOS + 10
+    en_cache = _temporal(carpeta, edad=viejo, subdir="cache")
+    entrante = _temporal(carpeta, edad=viejo, subdir="entrantes")
+
+    assert archivos_temp.barrer(max_bytes=0)["huerfanos"] == 1
+    assert os.path.exists(en_cache)
+    assert not os.path.exists(entrante)
+
+
+def test_cuota_no_desaloja_un_archivo_recibido_en_cola(carpeta, monkeypatch):
+    monkeypatch.setattr(almacen_archivos, "ARCHIVOS_ENTRANTES_DIR", str(carpeta / "entrantes"))
+    (carpeta / "entrantes").mkdir(exist_ok=True)
+    en_cola = almacen_archivos.guardar_archivo("factura.pdf", b"x" * 100)
+    archivos_temp._registro[archivos_temp._clave(en_cola)]["usado"] = 0
+    zip_viejo = archivos_temp.registrar(_temporal(carpeta, tamano=100))
+
+    resultado = archivos_temp.barrer(max_bytes=50)
+    assert resultado["desalojados"] == 1
+    assert os.path.exists(en_cola)
+    assert not os.path.exists(zip_viejo)
+
+    # Vencido su TTL ya se barre aunque nadie lo haya procesado
+    archivos_temp._registro[archivos_temp._clave(en_cola)]["expira"] = 0
+    assert archivos_temp.barrer()["barridos"] == 1
+    assert not os.path.exists(en_cola)
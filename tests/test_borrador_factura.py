@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from app.services import borrador_factura_service as bf
+from app.services.enrutador_service import normalizar
+from app.utils.redis_client import guardar_borrador, obtener_borrador
+
+
+def _borrador_listo():
+    borrador = bf.nuevo_borrador()
+    borrador["estado"] = "confirmando"
+    borrador["datos"].update({
+        "PaymentForm": "03",
+        "PaymentMethod": "PUE",
+        "Receiver": {
+            "Rfc": "XAXX010101000", "Name": "PUBLICO EN GENERAL", "CfdiUse": "S01",
+            "FiscalRegime": "616", "TaxZipCode": "20160",
+        },
+        "Items": [{
+            "Description": "Servicio de consultoría", "Quantity": 1, "UnitPrice": 1000,
+            "ProductCode": "80111600", "UnitCode": "E48",
+        }],
+    })
+    return borrador
+
+
+@pytest.mark.parametrize("texto", ["Sí", "si, emitela", "Ok!", "sí por favor", "dale gracias", "de acuerdo."])
+def test_confirmacion_mensaje_completo(texto):
+    assert bf._RE_CONFIRMACION.match(normalizar(texto))
+
+
+@pytest.mark.parametrize("texto", [
+    "Sí, pero cambia la cantidad a 3",
+    "va a ser para otro RFC",
+    "ok pero el RFC es XAXX010101000",
+])
+def test_correccion_no_es_confirmacion(texto):
+    assert not bf._RE_CONFIRMACION.match(normalizar(texto))
+
+
+def test_confirmacion_emite_y_borra_borrador(redis_falso):
+    guardar_borrador("u1", _borrador_listo())
+    emitidas = []
+
+    async def emitir(datos):
+        emitidas.append(datos)
+        return {"Id": "F1"}
+
+    turno = asyncio.run(bf.atender_borrador("u1", "sí", emitir))
+    assert turno["funcion"] == "crear_factura"
+    assert turno["resultado"] == {"Id": "F1"}
+    assert len(emitidas) == 1
+    assert obtener_borrador("u1") is None
+
+
+def test_error_al_emitir_conserva_borrador(redis_falso):
+    guardar_borrador("u1", _borrador_listo())
+
+    class Respuesta:
+        def json(self):
+            return {"Message": "La solicitud no es válida.", "ModelState": {"Receiver.Rfc": ["RFC inválido"]}}
+
+    class ErrorHTTP(Exception):
+        response = Respuesta()
+
+    async def emitir(datos):
+        raise ErrorHTTP("400 Client Error")
+
+    turno = asyncio.run(bf.atender_borrador("u1", "sí", emitir))
+    assert turno["funcion"] is None
+    assert "RFC inválido" in turno["respuesta"]
+    borrador = obtener_borrador("u1")
+    assert borrador is not None and borrador["estado"] == "confirmando"
@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils.cache import CacheTTL
+
+
+def test_llamadas_concurrentes_calculan_una_vez():
+    cache = CacheTTL(60, 10)
+    llamadas = []
+    liberar = threading.Event()
+
+    def calcular():
+        llamadas.append(1)
+        liberar.wait(5)
+        return {"facturas": []}
+
+    with ThreadPoolExecutor(8) as pool:
+        futuros = [pool.submit(cache.obtener_o_calcular, "k", calcular) for _ in range(8)]
+        time.sleep(0.1)
+        liberar.set()
+        resultados = [f.result() for f in futuros]
+
+    assert len(llamadas) == 1
+    assert all(r is resultados[0] for r in resultados)
+    assert cache.estadisticas() == {"items": 1, "aciertos": 0, "fallos": 1}
+    assert cache.obtener_o_calcular("k", lambda: pytest.fail("debía venir del cache")) is resultados[0]
+
+
+def test_errores_no_se_guardan_y_llegan_a_todos():
+    cache = CacheTTL(60, 10)
+
+    def falla():
+        raise ConnectionError("Facturama caído")
+
+    with pytest.raises(ConnectionError):
+        cache.obtener_o_calcular("k", falla)
+    assert cache.obtener("k") is None
+    assert cache.obtener_o_calcular("k", lambda: 1) == 1
+
+
+def test_desaloja_el_menos_usado_y_respeta_ttl(monkeypatch):
+    cache = CacheTTL(10, 2)
+    cache.guardar("a", 1)
+    cache.guardar("b", 2)
+    cache.obtener("a")
+    cache.guardar("c", 3)
+    assert (cache.obtener("a"), cache.obtener("b"), cache.obtener("c")) == (1, None, 3)
+
+    ahora = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: ahora + 11)
+    assert cache.obtener("a") is None
+
+
+def test_invalidar_durante_el_calculo_no_guarda_el_valor_viejo():
+    cache = CacheTTL(60, 10)
+    empezo, liberar = threading.Event(), threading.Event()
+
+    def calcular_viejo():
+        empezo.set()
+        liberar.wait(5)
+        return "viejo"
+
+    with ThreadPoolExecutor(1) as pool:
+        futuro = pool.submit(cache.obtener_o_calcular, "k", calcular_viejo)
+        empezo.wait(5)
+        assert cache.invalidar() == 0
+        # Quien llega después de invalidar no se une al cálculo viejo
+        assert cache.obtener_o_calcular("k", lambda: "nuevo") == "nuevo"
+        liberar.set()
+        assert futuro.result() == "viejo"
+
+    assert cache.obtener("k") == "nuevo"
+
+
+def test_invalidar_con_predicado():
+    cache = CacheTTL(60, 10)
+    cache.guardar(("cuenta1", "q"), 1)
+    cache.guardar(("cuenta2", "q"), 2)
+    assert cache.invalidar(lambda llave: llave[0] == "cuenta1") == 1
+    assert cache.obtener(("cuenta2", "q")) == 2
@@ -0,0 +1,45 @@
+import os
+import time
+
+from app.utils import archivos_temp, cache_documentos
+
+
+def test_cache_vive_dentro_de_archivos_temp():
+    assert os.path.abspath(cache_documentos.DOCUMENTOS_CACHE_DIR).startswith(
+        os.path.abspath(archivos_temp.ARCHIVOS_TEMP_DIR) + os.sep)
+
+
+def test_guardar_y_obtener():
+    ruta = cache_documentos.guardar_documento("C1", "pdf", "issued", b"%PDF-1", "C1.pdf")
+    assert cache_documentos.obtener_documento("C1", "PDF", "Issued") == (ruta, "C1.pdf")
+    assert cache_documentos.es_archivo_en_cache(ruta)
+    assert cache_documentos.obtener_documento("C1", "xml", "issued") is None
+
+
+def test_mismo_contenido_una_sola_copia():
+    a = cache_documentos.guardar_documento("C2", "pdf", "issued", b"igual", "C2.pdf")
+    b = cache_documentos.guardar_documento("C3", "pdf", "issued", b"igual", "C2.pdf")
+    assert a == b
+
+
+def test_desalojar_borra_lo_menos_usado():
+    viejo = cache_documentos.guardar_documento("C4", "pdf", "issued", b"v" * 100, "C4.pdf")
+    nuevo = cache_documentos.guardar_documento("C5", "pdf", "issued", b"n" * 100, "C5.pdf")
+    hace_rato = time.time() - 3600
+    os.utime(viejo, (hace_rato, hace_rato))
+
+    cache_documentos.desalojar(max_bytes=150)
+
+    assert not os.path.exists(viejo)
+    assert os.path.exists(nuevo)
+    assert cache_documentos.obtener_documento("C4", "pdf", "issued") is None
+
+
+def test_barrido_no_toca_el_cache():
+    # Nombre con forma de temporal: sólo lo protege la exclusión del directorio
+    nombre = "0f8fad5b-d9cb-469f-a165-70867728950e_C6.pdf"
+    ruta = cache_documentos.guardar_documento("C6", "pdf", "issued", b"x" * 10, nombre)
+    hace_rato = time.time() - 10 * 24 * 3600
+    os.utime(ruta, (hace_rato, hace_rato))
+    archivos_temp.barrer(max_bytes=0)
+    assert os.path.exists(ruta)
@@ -0,0 +1,37 @@
+import pytest
+
+from app.utils import catalogos_sat as cs
+
+
+def test_catalogo_es_abstracto():
+    with pytest.raises(TypeError):
+        cs.Catalogo()
+
+
+def test_subconjunto_de_claveprodserv_no_rechaza_claves_validas():
+    catalogo = cs.obtener_catalogo("c_ClaveProdServ")
+    assert not catalogo.completo
+    assert catalogo.obtener("50202306") is None  # no está en el subconjunto incluido
+
+    errores = cs.validar_claves_factura({"Items": [{"ProductCode": "50202306", "UnitCode": "H87"}]})
+    assert errores == []
+
+
+def test_subconjunto_revisa_el_formato():
+    errores = cs.validar_claves_factura({"Items": [{"ProductCode": "5020", "UnitCode": "H87"}]})
+    assert any("ProductCode" in e for e in errores)
+
+
+def test_catalogo_completo_rechaza_y_sugiere():
+    errores = cs.validar_claves_factura({"Receiver": {"CfdiUse": "G09"}})
+    assert errores and "G01" in errores[0]
+
+
+def test_busqueda_tolera_errores_de_dedo():
+    resultado = cs.buscar_en_catalogo("c_ClaveProdServ", "servicios contabls")
+    assert resultado["candidatos"][0]["clave"] == "84111500"
+
+
+@pytest.mark.parametrize("regimen", ["626", "628", "629", "630"])
+def test_regimenes_fiscales_vigentes(regimen):
+    assert cs.validar_claves_factura({"Receiver": {"FiscalRegime": regimen}}) == []
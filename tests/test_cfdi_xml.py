@@ -0,0 +1,90 @@
+import io
+
+import pytest
+
+from app.utils import cfdi_xml
+
+
+def _cfdi(version="4.0", conceptos=2, timbre=True):
+    ns = "http://www.sat.gob.mx/cfd/4" if version == "4.0" else "http://www.sat.gob.mx/cfd/3"
+    partidas = "".join(
+        f'<cfdi:Concepto ClaveProdServ="80111600" Cantidad="1" ClaveUnidad="E48" Descripcion="Servicio {n}" '
+        f'ValorUnitario="100" Importe="100" ObjetoImp="02"><cfdi:Impuestos><cfdi:Traslados>'
+        f'<cfdi:Traslado Base="100" Impuesto="002" TipoFactor="Tasa" TasaOCuota="0.160000" Importe="16"/>'
+        f'</cfdi:Traslados></cfdi:Impuestos></cfdi:Concepto>'
+        for n in range(conceptos)
+    )
+    complemento = (
+        '<cfdi:Complemento><tfd:TimbreFiscalDigital xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital" '
+        'UUID="ABCDEF01-2345-6789-ABCD-EF0123456789" FechaTimbrado="2025-01-10T10:00:01"/></cfdi:Complemento>'
+        if timbre else ""
+    )
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<cfdi:Comprobante xmlns:cfdi="{ns}" Version="{version}" Serie="A" '
+        f'Folio="7" Fecha="2025-01-10T10:00:00" SubTotal="{100 * conceptos}" Total="{116 * conceptos}" Moneda="MXN" '
+        f'TipoDeComprobante="I"><cfdi:Emisor Rfc="ROLE930613SC5" RegimenFiscal="626"/>'
+        f'<cfdi:Receptor Rfc="XAXX010101000" UsoCFDI="S01"/><cfdi:Conceptos>{partidas}</cfdi:Conceptos>'
+        f'<cfdi:Impuestos TotalImpuestosTrasladados="{16 * conceptos}"><cfdi:Traslados>'
+        f'<cfdi:Traslado Base="{100 * conceptos}" Impuesto="002" TipoFactor="Tasa" TasaOCuota="0.160000" '
+        f'Importe="{16 * conceptos}"/></cfdi:Traslados></cfdi:Impuestos>{complemento}</cfdi:Comprobante>'
+    ).encode("utf-8")
+
+
+@pytest.mark.parametrize("version", ["4.0", "3.3"])
+def test_extraer_cfdi_por_version(version):
+    xml = _cfdi(version)
+    assert cfdi_xml.es_cfdi_xml(xml)
+    datos = cfdi_xml.extraer_cfdi(io.BytesIO(xml))
+    assert datos["version"] == version
+    assert (datos["serie"], datos["folio"], datos["total"]) == ("A", "7", 232.0)
+    assert datos["emisor"]["rfc"] == "ROLE930613SC5"
+    assert datos["receptor"]["rfc"] == "XAXX010101000"
+    assert datos["uuid"] == "ABCDEF01-2345-6789-ABCD-EF0123456789"
+    assert datos["total_conceptos"] == 2
+    assert "conceptos_omitidos" not in datos
+
+
+def test_impuestos_de_partida_y_de_comprobante_se_separan():
+    datos = cfdi_xml.extraer_cfdi(_cfdi(conceptos=2))
+    for concepto in datos["conceptos"]:
+        assert concepto["trasladados"] == [{"impuesto": "002", "tipo_factor": "Tasa", "tasa_o_cuota": 0.16,
+                                            "base": 100.0, "importe": 16.0}]
+    assert datos["impuestos"]["total_trasladados"] == 32.0
+    assert [t["importe"] for t in datos["impuestos"]["trasladados"]] == [32.0]
+    assert datos["impuestos"]["retenidos"] == []
+
+
+def test_limite_de_conceptos(monkeypatch):
+    monkeypatch.setattr(cfdi_xml, "CFDI_XML_MAX_CONCEPTOS", 3)
+    datos = cfdi_xml.extraer_cfdi(_cfdi(conceptos=5))
+    assert [c["descripcion"] for c in datos["conceptos"]] == ["Servicio 0", "Servicio 1", "Servicio 2"]
+    assert datos["total_conceptos"] == 5
+    assert datos["conceptos_omitidos"] == 2
+
+
+def test_sin_timbre():
+    assert cfdi_xml.extraer_cfdi(_cfdi(timbre=False))["uuid"] is None
+
+
+@pytest.mark.parametrize("xml", [
+    b'<?xml version="1.0"?><factura Total="10"/>',
+    b'<Comprobante xmlns="http://otro.ns" Version="4.0"/>',
+    b'<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4" Version="4.0"><cfdi:Emisor',
+])
+def test_rechaza_lo_que_no_es_cfdi(xml):
+    with pytest.raises(ValueError):
+        cfdi_xml.extraer_cfdi(xml)
+
+
+def test_rechaza_doctype_en_el_parser():
+    # Entidades anidadas (billion laughs) después de más de 4 KB de relleno:
+    # es_cfdi_xml no las ve, el parser tampoco debe expandirlas
+    relleno = b"<!-- " + b"x" * 5000 + b" -->\n"
+    bomba = (
+        b'<?xml version="1.0"?>\n' + relleno
+        + b'<!DOCTYPE cfdi:Comprobante [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>\n'
+        + b'<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4" Version="4.0" Serie="&b;"/>'
+    )
+    with pytest.raises(ValueError, match="DOCTYPE"):
+        cfdi_xml.extraer_cfdi(bomba)
+    assert not cfdi_xml.es_cfdi_xml(_cfdi().replace(b"\n", b'\n<!DOCTYPE x>\n', 1))
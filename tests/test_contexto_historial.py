@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+from app.services import historial_service as hs
+from app.utils.redis_client import obtener_resumen
+
+
+def _conversacion(turnos):
+    historial = []
+    for n in range(turnos):
+        historial.append({"role": "user", "content": f"pregunta {n}"})
+        historial.append({"role": "assistant", "content": json.dumps({"Id": f"F{n}", "Total": n})})
+    historial.append({"role": "user", "content": "y la última?"})
+    return historial
+
+
+def test_bajo_presupuesto_se_conservan_todos_los_turnos(redis_falso, monkeypatch):
+    async def no_resumir(*args, **kwargs):
+        raise AssertionError("no se debe resumir bajo el presupuesto")
+    monkeypatch.setattr(hs, "resumir_historial", no_resumir)
+    historial = _conversacion(10)
+
+    nuevo, messages = asyncio.run(hs.preparar_contexto("u1", historial))
+
+    assert nuevo == historial
+    assert [m["content"] for m in messages] == [hs._a_texto(m["content"]) for m in historial]
+    assert obtener_resumen("u1") == ""
+
+
+def test_sobre_presupuesto_se_compacta_la_parte_vieja(redis_falso, monkeypatch):
+    async def resumir(resumen, mensajes, user_id=None):
+        return f"{len(mensajes)} mensajes"
+    monkeypatch.setattr(hs, "resumir_historial", resumir)
+    monkeypatch.setattr(hs, "HISTORIAL_TOKEN_BUDGET", 10)
+    historial = _conversacion(10)
+
+    nuevo, messages = asyncio.run(hs.preparar_contexto("u1", historial))
+
+    assert nuevo == historial[-hs.HISTORIAL_TURNOS_RECIENTES:]
+    assert messages[0]["content"].endswith(f"{len(historial) - len(nuevo)} mensajes")
+    assert [m["content"] for m in messages[1:]] == [hs._a_texto(m["content"]) for m in nuevo]
@@ -0,0 +1,84 @@
+import base64
+import email
+import json
+import os
+
+import pytest
+
+from app.services import documentos_service as ds
+
+_TAMANOS = [0, 1, 2, 3, 4, 5, 6, 7, 998, 999, 1000, 4097]
+
+
+def _archivo(tmp_path, tamano):
+    ruta = tmp_path / f"doc-{tamano}.pdf"
+    ruta.write_bytes(os.urandom(tamano))
+    return str(ruta)
+
+
+def _leer_como_requests(cuerpo, bloque):
+    partes = []
+    while True:
+        trozo = cuerpo.read(bloque)
+        if not trozo:
+            return b"".join(partes)
+        partes.append(trozo)
+
+
+@pytest.mark.parametrize("trozo", [2, 7, 64 * 1024])
+@pytest.mark.parametrize("tamano", _TAMANOS)
+def test_base64_igual_al_archivo_completo(tmp_path, monkeypatch, tamano, trozo):
+    monkeypatch.setattr(ds, "TAMANO_TROZO", trozo)
+    ruta = _archivo(tmp_path, tamano)
+    cuerpo = ds.cuerpo_base64(ruta)
+
+    enviado = _leer_como_requests(cuerpo, 5)
+    with open(ruta, "rb") as f:
+        esperado = json.dumps({"base64": base64.b64encode(f.read()).decode()}).encode()
+    assert enviado == esperado
+    assert len(cuerpo) == len(esperado)
+
+
+@pytest.mark.parametrize("tamano", [0, 1, 1000, 70 * 1024])
+def test_multipart_enmarca_el_archivo(tmp_path, tamano):
+    ruta = _archivo(tmp_path, tamano)
+    cuerpo, tipo = ds.cuerpo_multipart(ruta, "Factura ñ.pdf")
+
+    enviado = _leer_como_requests(cuerpo, 8192)
+    assert len(cuerpo) == len(enviado)
+    mensaje = email.message_from_bytes(f"Content-Type: {tipo}\r\n\r\n".encode() + enviado)
+    (parte,) = mensaje.get_payload()
+    assert parte.get_param("name", header="content-disposition") == "file"
+    assert parte.get_content_type() == "application/pdf"
+    with open(ruta, "rb") as f:
+        assert parte.get_payload(decode=True) == f.read()
+
+
+def test_read_sin_limite_devuelve_todo():
+    cuerpo = ds.CuerpoEnStreaming([b"ab", b"", b"cde"], 5)
+    assert cuerpo.read(1) == b"a"
+    assert cuerpo.read() == b"bcde"
+    assert cuerpo.read(10) == b""
+
+
+@pytest.mark.parametrize("protocolo", ["base64", "multipart"])
+def test_content_length_coincide_con_lo_enviado(tmp_path, monkeypatch, protocolo):
+    monkeypatch.setattr(ds, "DOCUMENTOS_API_PROTOCOLO", protocolo)
+    ruta = _archivo(tmp_path, 1001)
+    enviados = {}
+
+    class Respuesta:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"ok": True}
+
+    def post(url, data=None, headers=None, timeout=None):
+        enviados["longitud"] = len(data)
+        enviados["cuerpo"] = _leer_como_requests(data, 8192)
+        return Respuesta()
+    monkeypatch.setattr(ds.requests, "post", post)
+
+    assert ds._procesar_remoto(ruta, "f.pdf", "sha") == {"ok": True}
+    assert enviados["longitud"] == len(enviados["cuerpo"])
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routes import whatsapp_routes
+from app.services import whatsapp_service
+from app.utils.redis_client import enqueue_user_message_once, mensaje_ya_visto, peek_user_messages
+
+
+@pytest.fixture
+def cliente(redis_falso, monkeypatch):
+    async def worker(x_from):
+        return None
+    monkeypatch.setattr(whatsapp_service, "run_user_queue_worker", worker)
+    app = FastAPI()
+    app.include_router(whatsapp_routes.router)
+    return TestClient(app)
+
+
+def test_encolar_una_vez(redis_falso):
+    assert enqueue_user_message_once("u1", {"type": "text", "content": "hola"}, "id:1", 60) == 1
+    assert enqueue_user_message_once("u1", {"type": "text", "content": "hola"}, "id:1", 60) is None
+    assert enqueue_user_message_once("u1", {"type": "text", "content": "otro"}, "id:2", 60) == 2
+    assert [m["content"] for m in peek_user_messages("u1")] == ["hola", "otro"]
+    assert mensaje_ya_visto("u1", "id:1")
+    assert 0 < redis_falso.ttl("visto:u1:id:1") <= 60
+
+
+def test_reintento_con_mismo_id_no_se_encola(cliente):
+    headers = {"X-From": "u1", "Content-Type": "text/plain", "X-Message-Id": "ABC"}
+    primera = cliente.post("/webhook/orquestador", content="hola".encode(), headers=headers)
+    segunda = cliente.post("/webhook/orquestador", content="hola".encode(), headers=headers)
+    assert primera.json()["status"] == "accepted"
+    assert segunda.status_code == 200
+    assert segunda.json()["status"] == "duplicate"
+    assert len(peek_user_messages("u1")) == 1
+
+
+def test_sin_id_un_si_repetido_se_encola_por_omision(cliente):
+    headers = {"X-From": "u1", "Content-Type": "text/plain"}
+    for _ in range(2):
+        assert cliente.post("/webhook/orquestador", content="sí".encode(), headers=headers).json()["status"] == "accepted"
+    assert [m["content"] for m in peek_user_messages("u1")] == ["sí", "sí"]
+
+
+def test_por_contenido_distingue_la_hora_de_envio(cliente, monkeypatch):
+    monkeypatch.setattr(whatsapp_service, "WEBHOOK_DEDUP_POR_CONTENIDO", True)
+
+    def enviar(texto, marca):
+        headers = {"X-From": "u1", "Content-Type": "text/plain", "X-Message-Timestamp": marca}
+        return cliente.post("/webhook/orquestador", content=texto.encode(), headers=headers).json()["status"]
+
+    assert enviar("sí", "1700000000") == "accepted"
+    assert enviar("sí", "1700000000") == "duplicate"
+    assert enviar("sí", "1700000042") == "accepted"
+    assert [m["content"] for m in peek_user_messages("u1")] == ["sí", "sí"]
+
+
+def test_archivo_repetido_borra_la_copia_nueva(cliente, monkeypatch):
+    monkeypatch.setattr(whatsapp_service, "WEBHOOK_DEDUP_POR_CONTENIDO", True)
+    headers = {"X-From": "u1", "Content-Type": "application/pdf", "X-Filename": "factura.pdf"}
+    assert cliente.post("/webhook/orquestador", content=b"%PDF-1", headers=headers).json()["status"] == "accepted"
+    assert cliente.post("/webhook/orquestador", content=b"%PDF-1", headers=headers).json()["status"] == "duplicate"
+    encolados = peek_user_messages("u1")
+    assert len(encolados) == 1
+    carpeta = os.path.dirname(encolados[0]["ruta"])
+    assert [f for f in os.listdir(carpeta) if f.endswith("factura.pdf")] == [os.path.basename(encolados[0]["ruta"])]
+
+
+def test_archivo_con_id_visto_no_lee_el_cuerpo(cliente, monkeypatch):
+    headers = {"X-From": "u1", "Content-Type": "application/pdf", "X-Filename": "f.pdf", "X-Message-Id": "M1"}
+    assert cliente.post("/webhook/orquestador", content=b"%PDF-1", headers=headers).json()["status"] == "accepted"
+
+    async def no_leer(*args, **kwargs):
+        raise AssertionError("no se debe guardar un reintento")
+    monkeypatch.setattr(whatsapp_routes, "guardar_stream", no_leer)
+    assert cliente.post("/webhook/orquestador", content=b"%PDF-1", headers=headers).json()["status"] == "duplicate"
+
+
+def test_dedup_apagado(cliente, monkeypatch):
+    monkeypatch.setattr(whatsapp_service, "WEBHOOK_DEDUP_ACTIVO", False)
+    headers = {"X-From": "u1", "Content-Type": "text/plain", "X-Message-Id": "ABC"}
+    for _ in range(2):
+        assert cliente.post("/webhook/orquestador", content=b"hola", headers=headers).json()["status"] == "accepted"
+    assert len(peek_user_messages("u1")) == 2
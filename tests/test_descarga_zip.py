@@ -0,0 +1,45 @@
+import os
+import zipfile
+
+from app.services import facturacion_service as fs
+from app.services.plantillas_service import renderizar_respuesta
+
+
+def _documentos(monkeypatch, tmp_path, faltantes=(), fallan=()):
+    def obtener(id, format, type):
+        if id in fallan:
+            raise RuntimeError("404")
+        ruta = tmp_path / f"{id}.{format}"
+        if id not in faltantes:
+            ruta.write_bytes(f"doc {id}".encode())
+        return str(ruta), f"{id}.{format}"
+
+    monkeypatch.setattr(fs, "obtener_documento_local", obtener)
+
+
+def test_zip_con_documento_desalojado_cuenta_como_fallido(monkeypatch, tmp_path):
+    _documentos(monkeypatch, tmp_path, faltantes={"B"}, fallan={"C"})
+    resultado = fs.descargar_documentos_zip(ids=["A", "B", "C", "A"])
+
+    assert resultado["incluidos"] == 1
+    assert sorted(resultado["fallidos"]) == ["B", "C"]
+    with zipfile.ZipFile(resultado["archivo"]) as zf:
+        assert zf.namelist() == ["A.pdf"]
+    os.remove(resultado["archivo"])
+
+
+def test_zip_sin_ids_devuelve_mensaje():
+    resultado = fs.descargar_documentos_zip(ids=[])
+    assert resultado["archivo"] is None
+    assert renderizar_respuesta("descargar_documentos_zip", resultado, "") == resultado["mensaje"]
+
+
+def test_zip_todos_fallan_devuelve_mensaje_y_no_deja_temporales(monkeypatch, tmp_path):
+    _documentos(monkeypatch, tmp_path, fallan={"A", "B"})
+    antes = set(os.listdir(fs.DESCARGAS_DIR))
+    resultado = fs.descargar_documentos_zip(ids=["A", "B"])
+
+    assert resultado["archivo"] is None
+    assert sorted(resultado["fallidos"]) == ["A", "B"]
+    assert "ninguna" in resultado["mensaje"]
+    assert set(os.listdir(fs.DESCARGAS_DIR)) == antes
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+
+from app.services import emision_masiva_service as em
+from app.utils.redis_client import crear_lote, guardar_resultado_lote, obtener_resultados_lote
+
+_CSV = (
+    "factura,rfc,forma_pago,descripcion,cantidad,precio_unitario,clave_producto,clave_unidad\n"
+    "A,XAXX010101000,3,Consultoría,1,\"1,000.00\",80111600,E48\n"
+    "A,XAXX010101000,3,Capacitación,2,500,80111600,E48\n"
+    "B,XAXX010101000,3,Soporte,1,250,80111600,E48\n"
+    ",,,,,,,\n"
+)
+
+
+def _facturas(texto=_CSV):
+    return em.armar_facturas(*em.leer_filas("lote.csv", texto.encode("utf-8")))
+
+
+def test_leer_filas_mapea_encabezados_y_salta_vacias():
+    columnas, filas = em.leer_filas("lote.csv", _CSV.encode("utf-8"))
+    assert columnas[0] == "factura"
+    assert columnas[1] == "Receiver.Rfc"
+    assert [n for n, _ in filas] == [2, 3, 4]
+
+
+def test_leer_filas_csv_excel_en_espanol():
+    texto = "RFC;Descripción;Precio unitario\nXAXX010101000;Renta;1000\n"
+    columnas, filas = em.leer_filas("lote.csv", texto.encode("cp1252"))
+    assert set(columnas.values()) == {"Receiver.Rfc", "Items.Description", "Items.UnitPrice"}
+    assert filas == [(2, ["XAXX010101000", "Renta", "1000"])]
+
+
+def test_leer_filas_sin_columnas_de_lote():
+    assert em.leer_filas("notas.csv", b"nombre,telefono\nAna,123\n") is None
+
+
+def test_armar_facturas_agrupa_por_columna_factura():
+    facturas, filas, errores = _facturas()
+    assert errores == []
+    assert filas == [[2, 3], [4]]
+    assert [len(f["Items"]) for f in facturas] == [2, 1]
+    assert facturas[0]["Items"][0]["UnitPrice"] == 1000.0
+    # Excel pierde los ceros a la izquierda de las claves
+    assert facturas[0]["PaymentForm"] == "03"
+    assert facturas[0]["Receiver"]["Name"] == "PUBLICO EN GENERAL"
+
+
+def test_armar_facturas_reporta_numero_invalido_con_fila():
+    texto = "rfc,descripcion,precio_unitario,clave_producto,clave_unidad,forma_pago\n" \
+            "XAXX010101000,Renta,mil,80111600,E48,03\n"
+    _, _, errores = _facturas(texto)
+    assert any(e.startswith("Fila 2: precio_unitario \"mil\"") for e in errores)
+
+
+def test_con_referencia_conserva_observaciones():
+    datos = em._con_referencia({"Observations": "Pago anticipado"}, "Lote abc-1")
+    assert datos["Observations"] == "Pago anticipado [Lote abc-1]"
+
+
+def _enviando():
+    return {"estado": "enviando", "referencia": "Lote abc-1", "desde": time.time()}
+
+
+def _factura():
+    facturas, _, _ = _facturas()
+    return facturas[1]
+
+
+def test_conciliar_por_referencia(monkeypatch):
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", lambda rfc, desde: [
+        {"Id": "X", "Total": 290, "Observations": "otra"},
+        {"Id": "F1", "Total": 290, "Observations": "[Lote abc-1]"},
+    ])
+    assert em.conciliar_envio(_factura(), _enviando(), set()) == ("emitida", {"Id": "F1", "Total": 290, "Observations": "[Lote abc-1]"})
+
+
+def test_conciliar_por_total_si_el_listado_no_trae_observaciones(monkeypatch):
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", lambda rfc, desde: [
+        {"Id": "X", "Total": 999},
+        {"Id": "F1", "Total": 290.0},
+        {"Id": "F0", "Total": 290.0},
+    ])
+    estado, factura = em.conciliar_envio(_factura(), _enviando(), {"F0"})
+    assert (estado, factura["Id"]) == ("emitida", "F1")
+
+
+def test_conciliar_sin_coincidencias_se_reintenta(monkeypatch):
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", lambda rfc, desde: [])
+    assert em.conciliar_envio(_factura(), _enviando(), set()) == ("pendiente", None)
+
+
+def test_conciliar_ambigua_o_sin_facturama_queda_en_duda(monkeypatch):
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", lambda rfc, desde: [
+        {"Id": "F1", "Total": 290}, {"Id": "F2", "Total": 290},
+    ])
+    assert em.conciliar_envio(_factura(), _enviando(), set())[0] == "en_duda"
+
+    def caida(rfc, desde):
+        raise ConnectionError("sin red")
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", caida)
+    assert em.conciliar_envio(_factura(), _enviando(), set())[0] == "en_duda"
+    assert em.conciliar_envio(_factura(), {"estado": "enviando"}, set())[0] == "en_duda"
+
+
+@pytest.mark.parametrize("encontrada, emitidas", [(True, 0), (False, 1)])
+def test_reanudar_lote_concilia_antes_de_reintentar(redis_falso, monkeypatch, encontrada, emitidas):
+    facturas, filas, _ = _facturas()
+    crear_lote("abc", {"user_id": "u1", "archivo": "lote.csv", "total": 2, "filas": filas,
+                       "estado": "en_proceso", "creado": time.time()}, facturas)
+    guardar_resultado_lote("abc", 0, {"estado": "emitida", "id": "F0", "folio": "1", "total": 1000})
+    guardar_resultado_lote("abc", 1, {"estado": "enviando", "referencia": "Lote abc-2", "desde": time.time()})
+
+    enviadas, avisos = [], []
+    monkeypatch.setattr(em, "buscar_facturas_emitidas", lambda rfc, desde: (
+        [{"Id": "F1", "Folio": "2", "Total": 290, "Observations": "[Lote abc-2]"}] if encontrada else []
+    ))
+
+    def crear(datos):
+        enviadas.append(datos)
+        return {"Id": "F9", "Folio": "9", "Total": 290}
+    monkeypatch.setattr(em, "crear_factura", crear)
+
+    conteos = asyncio.run(em.ejecutar_lote("abc", lambda user_id, texto: avisos.append(texto)))
+    assert conteos["emitida"] == 2
+    assert len(enviadas) == emitidas
+    assert obtener_resultados_lote("abc")[1]["id"] == ("F1" if encontrada else "F9")
+    assert "sin confirmar" not in avisos[-1]
+    if enviadas:
+        assert "[Lote abc-2]" in enviadas[0]["Observations"]
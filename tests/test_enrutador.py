@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+from app.services import enrutador_service as enr
+
+with open(os.path.join(os.path.dirname(__file__), "casos_enrutador.jsonl"), encoding="utf-8") as f:
+    CASOS = [json.loads(linea) for linea in f if linea.strip()]
+
+# Con palabras que ninguna regla explica el enrutador cede al planificador LLM
+_CON_RESIDUO = {
+    "facturas de enero 2025 del proveedor de limpieza": "consulta las facturas de enero 2025",
+    "descarga la factura 6Kx9q2LmN0pQrStUvWxYz1 que le hice a pepe": "mándame la factura 6Kx9q2LmN0pQrStUvWxYz1",
+}
+
+
+@pytest.mark.parametrize("caso", CASOS, ids=[c["texto"] for c in CASOS])
+def test_decision_por_intencion(caso):
+    obtenido = enr.enrutar_mensaje(caso["texto"])
+    esperado = caso["esperado"]
+    if esperado is None or caso["texto"] in _CON_RESIDUO:
+        assert obtenido is None
+        return
+    assert obtenido["funcion"] == esperado["funcion"]
+    assert obtenido["origen"] == "enrutador"
+    for clave, valor in esperado["params"].items():
+        assert obtenido["params"][clave] == valor
+
+
+@pytest.mark.parametrize("con_residuo, limpio", _CON_RESIDUO.items())
+def test_residuo_baja_la_confianza(con_residuo, limpio):
+    def confianza(texto):
+        return max(c["confianza"] for c in (regla(texto) for regla in enr.REGLAS) if c)
+
+    assert confianza(con_residuo) == pytest.approx(confianza(limpio) - 0.3)
+    assert confianza(con_residuo) < enr.UMBRAL_CONFIANZA
+    # Con un umbral más bajo la misma regla sí decide
+    assert enr.enrutar_mensaje(con_residuo, umbral=0.5) is not None
+
+
+def test_medir_precision_sobre_los_casos():
+    resultado = enr.medir_precision(CASOS)
+    assert resultado["casos"] == len(CASOS)
+    assert resultado["enrutados"] == 9
+    assert resultado["precision"] == 1.0
+    assert resultado["cobertura"] == pytest.approx(9 / 11)
+    assert resultado["errores"] == []
+
+
+def test_medir_precision_cuenta_errores():
+    casos = [{"texto": "facturas del RFC XAXX010101000", "esperado": {"funcion": "analizar_facturas"}},
+             {"texto": "facturas de los folios 10 al 20", "esperado": None}]
+    resultado = enr.medir_precision(casos)
+    assert resultado["enrutados"] == 2
+    assert resultado["aciertos"] == 0
+    assert resultado["precision"] == 0.0
+    assert len(resultado["errores"]) == 2
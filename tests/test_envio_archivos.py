@@ -0,0 +1,121 @@
+import os
+import json
+import asyncio
+
+import pytest
+
+from app.services import whatsapp_service as ws
+
+
+def test_marcar_archivo_usado_limpia_marcador_en_texto_json():
+    historial = [
+        {"role": "user", "content": "mándame la factura"},
+        {"role": "assistant", "content": json.dumps({"mensaje": "Documento descargado", "archivo": "a/F1.pdf"})},
+        {"role": "assistant", "content": json.dumps({"mensaje": "Otro", "archivo": "a/F2.pdf"})},
+    ]
+    historial = ws.marcar_archivo_usado(historial, "a/F1.pdf")
+    assert json.loads(historial[1]["content"])["archivo"] is None
+    assert json.loads(historial[2]["content"])["archivo"] == "a/F2.pdf"
+    assert historial[0]["content"] == "mándame la factura"
+
+
+def _turno(monkeypatch, texto, paso, enviados, abrir=None):
+    """Corre procesar_mensaje_texto con el paso forzado y sin red."""
+    from app.utils import archivos_temp
+
+    monkeypatch.setattr(ws, "enrutar_mensaje", lambda t: dict(paso) if paso else None)
+    monkeypatch.setattr(ws, "abrir_documento", abrir or (
+        lambda **p: archivos_temp.archivo_temporal(f"{p['id']}.{p['format']}", b"<cfdi/>")))
+
+    async def clasificar(messages, user_id=None):
+        return {"servicio": "WHATSAPP", "funcion": "respuesta_final", "params": {}}
+
+    async def generar(messages, user_id=None):
+        return "¿Algo más?"
+
+    monkeypatch.setattr(ws, "clasificar_siguiente_paso", clasificar)
+    monkeypatch.setattr(ws, "generar_respuesta_final", generar)
+
+    def enviar(to, mensaje=None, ruta_archivo=None, archivo=None):
+        if archivo is not None:
+            enviados.append(("archivo", archivo.nombre))
+        elif ruta_archivo:
+            enviados.append(("ruta", os.path.basename(ruta_archivo)))
+        else:
+            enviados.append(("texto", mensaje))
+        return True
+
+    monkeypatch.setattr(ws, "enviar_respuesta_a_whatsapp", enviar)
+    return asyncio.run(ws.procesar_mensaje_texto("u1", texto))
+
+
+DESCARGA = {"servicio": "FACTURACION", "funcion": "descargar_documento",
+            "params": {"id": "F1", "format": "xml", "type": "issued"}, "origen": "enrutador"}
+
+
+def test_archivo_enviado_no_se_reenvia_en_el_siguiente_turno(redis_falso, monkeypatch):
+    enviados = []
+    _turno(monkeypatch, "mándame el xml de F1", DESCARGA, enviados)
+    assert ("archivo", "F1.xml") in enviados
+
+    enviados.clear()
+    _turno(monkeypatch, "gracias", None, enviados)
+    assert enviados == [("texto", "¿Algo más?")]
+
+
+def test_archivo_persistente_no_se_reenvia(redis_falso, monkeypatch, tmp_path):
+    # Un archivo que sigue en disco después de enviarse (p. ej. del cache de documentos)
+    ruta = tmp_path / "facturas_pdf.zip"
+    ruta.write_bytes(b"PK")
+    monkeypatch.setattr(ws, "es_archivo_en_cache", lambda r: True)
+    monkeypatch.setattr(ws, "descargar_documentos_zip", lambda **p: {
+        "archivo": str(ruta), "nombre": ruta.name, "incluidos": 1, "fallidos": []})
+    paso_zip = {"servicio": "FACTURACION", "funcion": "descargar_documentos_zip",
+                "params": {"ids": ["F1"]}, "origen": "enrutador"}
+    enviados = []
+    _turno(monkeypatch, "mándame un zip", paso_zip, enviados)
+    assert ("ruta", "facturas_pdf.zip") in enviados
+
+    enviados.clear()
+    _turno(monkeypatch, "gracias", None, enviados)
+    assert enviados == [("texto", "¿Algo más?")]
+
+
+def test_documentos_del_turno_se_cierran_si_el_turno_falla(redis_falso, monkeypatch):
+    from app.utils import archivos_temp
+
+    abiertos = []
+
+    def abrir(**p):
+        abiertos.append(archivos_temp.archivo_temporal("F1.xml", b"<cfdi/>"))
+        return abiertos[-1]
+
+    def plantilla_rota(*a, **k):
+        raise RuntimeError("falla a media respuesta")
+
+    monkeypatch.setattr(ws, "renderizar_respuesta", plantilla_rota)
+    with pytest.raises(RuntimeError):
+        _turno(monkeypatch, "mándame el xml de F1", DESCARGA, [], abrir=abrir)
+    assert len(abiertos) == 1 and abiertos[0].closed
+
+
+def test_documentos_del_turno_se_cierran_al_enviar(redis_falso, monkeypatch):
+    from app.utils import archivos_temp
+
+    abiertos = []
+
+    def abrir(**p):
+        abiertos.append(archivos_temp.archivo_temporal("F1.xml", b"<cfdi/>"))
+        return abiertos[-1]
+
+    enviados = []
+    _turno(monkeypatch, "mándame el xml de F1", DESCARGA, enviados, abrir=abrir)
+    assert ("archivo", "F1.xml") in enviados
+    assert abiertos[0].closed
+
+
+def test_respuesta_de_plantilla_acompana_al_archivo(redis_falso, monkeypatch):
+    enviados = []
+    resultado = _turno(monkeypatch, "mándame el xml de F1", DESCARGA, enviados)
+    assert enviados == [("archivo", "F1.xml"), ("texto", "Aquí tienes tu documento 📄 F1.xml")]
+    assert resultado["respuesta"] == "Aquí tienes tu documento 📄 F1.xml"
@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+from app.services import ia_service
+from app.services.esquemas_planner import PasoInvalido, extraer_json, validar_clasificacion, validar_paso
+
+_PASO = {"servicio": "FACTURACION", "funcion": "consultar_facturas", "params": {"type": "recived", "rfc": "aaa010101aaa"}}
+
+
+@pytest.mark.parametrize("texto", [
+    json.dumps(_PASO),
+    "```json\n" + json.dumps(_PASO) + "\n```",
+    "Claro, este es el paso:\n" + json.dumps(_PASO) + "\nAvísame si necesitas algo más {ok}",
+])
+def test_extraer_json_tolera_texto_alrededor(texto):
+    assert extraer_json(texto) == _PASO
+
+
+@pytest.mark.parametrize("texto", [None, "", "sin json", '{"servicio": ', "{}", "[1, 2]"])
+def test_extraer_json_rechaza(texto):
+    with pytest.raises(PasoInvalido):
+        extraer_json(texto)
+
+
+def test_validar_paso_normaliza_params():
+    paso = validar_paso(json.dumps(_PASO))
+    assert paso["params"] == {"type": "received", "rfc": "AAA010101AAA"}
+
+
+@pytest.mark.parametrize("paso", [
+    {"servicio": "FACTURACION", "funcion": "borrar_todo"},
+    {"servicio": "CORREO", "funcion": "enviar"},
+    {"servicio": "FACTURACION", "funcion": "consultar_facturas", "params": {"status": "vigente"}},
+])
+def test_validar_paso_rechaza_esquema(paso):
+    with pytest.raises(PasoInvalido):
+        validar_paso(json.dumps(paso))
+
+
+def _respuestas(monkeypatch, *respuestas):
+    llamadas = []
+    pendientes = list(respuestas)
+
+    async def preguntar(messages, temperature=0.1, etapa="default", **kwargs):
+        llamadas.append(etapa)
+        return pendientes.pop(0)
+    monkeypatch.setattr(ia_service, "preguntar_a_openai", preguntar)
+    return llamadas
+
+
+def _obtener():
+    return asyncio.run(ia_service._obtener_paso_valido([], 0.1, "clasificar", validar_clasificacion))
+
+
+def test_paso_valido_sin_reparacion(monkeypatch):
+    llamadas = _respuestas(monkeypatch, '{"servicio": "WHATSAPP", "funcion": "respuesta_final"}')
+    assert _obtener()["funcion"] == "respuesta_final"
+    assert llamadas == ["clasificar"]
+
+
+def test_paso_reparado_una_vez(monkeypatch):
+    llamadas = _respuestas(
+        monkeypatch,
+        '{"servicio": "WHATSAPP", "funcion": "consultar_facturas"}',
+        '{"servicio": "FACTURACION", "funcion": "consultar_facturas"}',
+    )
+    assert _obtener()["funcion"] == "consultar_facturas"
+    assert llamadas == ["clasificar", "reparar_json"]
+
+
+def test_paso_que_sigue_invalido_tras_reparar(monkeypatch):
+    llamadas = _respuestas(monkeypatch, "no sé", "sigo sin saber")
+    assert _obtener() is None
+    assert llamadas == ["clasificar", "reparar_json"]
+
+
+def test_sin_respuesta_de_openai_no_repara(monkeypatch):
+    llamadas = _respuestas(monkeypatch, None)
+    assert _obtener() is None
+    assert llamadas == ["clasificar"]
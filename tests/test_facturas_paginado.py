@@ -0,0 +1,65 @@
+import pytest
+
+from app.services import facturacion_service as fs
+
+_FACTURAS = [
+    {"Id": f"F{n}", "Folio": str(n), "Rfc": "XAXX010101000", "Total": n * 10, "Status": "Active",
+     "TaxName": "", "Observations": "largo " * 50, "Items": [{"Description": "x"}]}
+    for n in range(1, 26)
+]
+
+
+@pytest.fixture
+def remoto(redis_falso, monkeypatch):
+    pedidos = []
+
+    def consultar(params):
+        pedidos.append(dict(params))
+        return {"facturas": _FACTURAS}
+    monkeypatch.setattr(fs, "consultar_facturas", consultar)
+    return pedidos
+
+
+def test_primera_pagina_proyecta_campos(remoto):
+    resultado = fs.consultar_facturas_paginado({"type": "issued", "por_pagina": 10})
+
+    assert remoto == [{"type": "issued"}]
+    assert (resultado["total"], resultado["pagina"], resultado["paginas"]) == (25, 1, 3)
+    assert [f["Id"] for f in resultado["facturas"]] == [f"F{n}" for n in range(1, 11)]
+    # Sólo CAMPOS_PROYECCION y sin campos vacíos
+    assert resultado["facturas"][0] == {"Id": "F1", "Folio": "1", "Rfc": "XAXX010101000", "Total": 10, "Status": "Active"}
+
+
+def test_handle_pagina_sin_volver_a_facturama(remoto):
+    handle = fs.consultar_facturas_paginado({"por_pagina": 10})["handle"]
+
+    ultima = fs.consultar_facturas_paginado({"handle": handle, "pagina": 3, "por_pagina": 10})
+    fuera = fs.consultar_facturas_paginado({"handle": handle, "pagina": 4, "por_pagina": 10})
+
+    assert len(remoto) == 1
+    assert ultima["handle"] == fuera["handle"] == handle
+    assert [f["Id"] for f in ultima["facturas"]] == [f"F{n}" for n in range(21, 26)]
+    assert fuera["facturas"] == [] and fuera["paginas"] == 3
+
+
+@pytest.mark.parametrize("pagina, por_pagina, esperado", [
+    (0, 10, (1, 10, 3)),
+    (-5, None, (1, fs.FACTURAS_POR_PAGINA, (25 + fs.FACTURAS_POR_PAGINA - 1) // fs.FACTURAS_POR_PAGINA)),
+    (1, 0, (1, fs.FACTURAS_POR_PAGINA, (25 + fs.FACTURAS_POR_PAGINA - 1) // fs.FACTURAS_POR_PAGINA)),
+    (1, -3, (1, 1, 25)),
+    (1, 1000, (1, 25, 1)),
+])
+def test_limites_de_pagina(remoto, pagina, por_pagina, esperado):
+    resultado = fs.consultar_facturas_paginado({"pagina": pagina, "por_pagina": por_pagina})
+    assert (resultado["pagina"], len(resultado["facturas"]), resultado["paginas"]) == esperado
+
+
+def test_handle_expirado_vuelve_a_consultar(remoto, redis_falso):
+    handle = fs.consultar_facturas_paginado({"type": "issued"})["handle"]
+    redis_falso.flushall()
+
+    resultado = fs.consultar_facturas_paginado({"type": "issued", "handle": handle, "pagina": 2, "por_pagina": 5})
+
+    assert len(remoto) == 2 and remoto[-1] == {"type": "issued"}
+    assert resultado["handle"] != handle
+    assert [f["Id"] for f in resultado["facturas"]] == [f"F{n}" for n in range(6, 11)]
@@ -0,0 +1,61 @@
+import pytest
+
+from app.services import impuestos_service as imp
+
+
+def _factura(*items, rfc="XAXX010101000"):
+    return {"Receiver": {"Rfc": rfc}, "Items": list(items)}
+
+
+def test_iva_por_defecto_en_objeto_02():
+    datos, _ = imp.calcular_factura(_factura({"Quantity": 2, "UnitPrice": 100}))
+    item = datos["Items"][0]
+    assert item["Subtotal"] == 200.0
+    assert item["Taxes"][0]["Total"] == 32.0
+    assert item["Total"] == 232.0
+
+
+def test_retencion_isr_resico_a_persona_moral(monkeypatch):
+    monkeypatch.setattr(imp, "EMISOR_REGIMEN_FISCAL", "626")
+    datos, _ = imp.calcular_factura(_factura({"Quantity": 1, "UnitPrice": 1000}, rfc="ABC010101AB1"))
+    totales = imp.resumen_totales(datos)
+    assert totales == {"Subtotal": 1000.0, "Descuento": 0.0, "Trasladados": 160.0,
+                       "Retenidos": 12.5, "Total": 1147.5}
+
+
+@pytest.mark.parametrize("objeto", ["01", "03"])
+def test_sin_desglose_quita_impuestos(objeto):
+    datos, correcciones = imp.calcular_factura(_factura(
+        {"Description": "x", "Quantity": 1, "UnitPrice": 100, "TaxObject": objeto,
+         "Taxes": [{"Name": "IVA", "Rate": 0.16}]}))
+    assert datos["Items"][0]["Taxes"] == []
+    assert datos["Items"][0]["Total"] == 100.0
+    assert correcciones
+
+
+@pytest.mark.parametrize("objeto", ["04", "05"])
+def test_objeto_04_05_sin_impuestos_por_defecto(objeto):
+    datos, _ = imp.calcular_factura(_factura(
+        {"Quantity": 1, "UnitPrice": 100, "TaxObject": objeto}, rfc="ABC010101AB1"))
+    assert datos["Items"][0]["Taxes"] == []
+    assert imp.resumen_totales(datos)["Total"] == 100.0
+
+
+def test_objeto_04_usa_solo_los_impuestos_indicados():
+    datos, _ = imp.calcular_factura(_factura(
+        {"Quantity": 1, "UnitPrice": 100, "TaxObject": "04",
+         "Taxes": [{"Name": "IVA", "Rate": 0, "IsRetention": False}]}))
+    assert [t["Rate"] for t in datos["Items"][0]["Taxes"]] == [0.0]
+    assert datos["Items"][0]["Total"] == 100.0
+
+
+def test_redondeo_sat_mitad_hacia_arriba():
+    assert list(imp.redondear_sat([0.125, 2.675, -0.005])) == [0.13, 2.68, -0.01]
+
+
+def test_corrige_importes_del_modelo():
+    datos, correcciones = imp.calcular_factura(_factura(
+        {"Description": "a", "Quantity": 3, "UnitPrice": 10, "Subtotal": 31, "Total": 99}))
+    assert datos["Items"][0]["Subtotal"] == 30.0
+    assert datos["Items"][0]["Total"] == 34.8
+    assert len(correcciones) == 2
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from app.services import facturacion_service as fs
+from app.utils import indice_facturas as idx
+
+_FACTURAS = [
+    {"Id": "A1", "Serie": "A", "Folio": "1", "Rfc": "aaa010101aaa", "Date": "2025-01-10T10:00:00", "Total": 100, "Status": "Active"},
+    {"Id": "A2", "Serie": "A", "Folio": "2", "Rfc": "AAA010101AAA", "Date": "2025-01-31T23:59:00", "Total": 200, "Status": "Canceled"},
+    {"Id": "A3", "Serie": "A", "Folio": "10", "Rfc": "BBB010101BBB", "Date": "2025-02-01T08:00:00", "Total": 300, "Status": "Active"},
+]
+
+
+@pytest.fixture
+def indice(tmp_path, monkeypatch):
+    monkeypatch.setattr(idx, "INDICE_FACTURAS_URL", f"sqlite:///{tmp_path / 'indice.db'}")
+    monkeypatch.setattr(idx, "_ES_SQLITE", True)
+    monkeypatch.setattr(idx, "INDICE_ACTIVO", True)
+    monkeypatch.setattr(idx, "_esquema_listo", False)
+    idx.guardar_facturas("c1", "issued", _FACTURAS)
+    return idx
+
+
+def _ids(resultado):
+    return [f["Id"] for f in resultado]
+
+
+@pytest.mark.parametrize("params, esperados", [
+    ({}, ["A3", "A2", "A1"]),
+    ({"status": "all"}, ["A3", "A2", "A1"]),
+    ({"status": "active"}, ["A3", "A1"]),
+    ({"status": "canceled"}, ["A2"]),
+    ({"rfc": " aaa010101aaa "}, ["A2", "A1"]),
+    ({"folioStart": "2"}, ["A3", "A2"]),
+    ({"folioEnd": "2"}, ["A2", "A1"]),
+    ({"folioStart": 2, "folioEnd": 9}, ["A2"]),
+    ({"dateStart": "2025-01-31"}, ["A3", "A2"]),
+    # dateEnd incluye todo el día
+    ({"dateEnd": "2025-01-31"}, ["A2", "A1"]),
+    ({"dateStart": "01/02/2025", "dateEnd": "2025-02-01"}, ["A3"]),
+    ({"type": "received"}, []),
+])
+def test_buscar_facturas_por_filtro(indice, params, esperados):
+    assert _ids(idx.buscar_facturas("c1", params)) == esperados
+
+
+def test_buscar_facturas_separa_cuentas(indice):
+    assert idx.buscar_facturas("otra", {}) == []
+
+
+@pytest.mark.parametrize("params", [{"keyword": "x"}, {"folioStart": "A-1"}, {"dateStart": "ayer"}])
+def test_filtro_no_soportado_va_a_facturama(indice, params):
+    assert idx.buscar_facturas("c1", params) is None
+
+
+def test_upsert_idempotente(indice):
+    assert idx.guardar_facturas("c1", "issued", _FACTURAS) == 3
+    cancelada = dict(_FACTURAS[0], Status="Canceled")
+    idx.guardar_facturas("c1", "issued", [cancelada])
+
+    assert _ids(idx.buscar_facturas("c1", {})) == ["A3", "A2", "A1"]
+    assert _ids(idx.buscar_facturas("c1", {"status": "canceled"})) == ["A2", "A1"]
+
+
+def test_fresco_y_desactualizado(indice):
+    assert not idx.esta_fresco("c1", "issued", 60)
+    idx.marcar_sincronizado("c1", "issued", completo=True)
+    assert idx.esta_fresco("c1", "issued", 60)
+    assert idx.obtener_estado_sync("c1", "issued")["ultima_fecha"] == "2025-02-01T08:00:00"
+
+    idx.marcar_desactualizado("c1")
+    assert not idx.esta_fresco("c1", "issued", 60)
+
+
+def test_sincronizacion_incremental_retoma_desde_el_cursor(indice, monkeypatch):
+    monkeypatch.setattr(fs, "CUENTA_INDICE", "c1")
+    monkeypatch.setattr(fs, "INDICE_FACTURAS_SOLAPE_DIAS", 3)
+    idx.marcar_sincronizado("c1", "issued", completo=True)
+    pedidos = []
+
+    def remoto(params):
+        pedidos.append(dict(params))
+        return [{"Id": "A4", "Folio": "11", "Rfc": "BBB010101BBB", "Date": "2025-02-03T09:00:00", "Total": 50, "Status": "Active"}]
+    monkeypatch.setattr(fs, "_consultar_facturas_remoto", remoto)
+
+    assert fs.sincronizar_indice_facturas(tipos=("issued",)) == {"issued": 1}
+    assert pedidos == [{"type": "issued", "dateStart": "2025-01-29"}]
+    assert idx.obtener_estado_sync("c1", "issued")["ultima_fecha"] == "2025-02-03T09:00:00"
+
+    # La completa vieja fuerza una resincronización total
+    monkeypatch.setattr(fs, "INDICE_FACTURAS_RESYNC_SEGUNDOS", -1)
+    fs.sincronizar_indice_facturas(tipos=("issued",))
+    assert pedidos[-1] == {"type": "issued"}
+    assert time.time() - idx.obtener_estado_sync("c1", "issued")["completo"] < 5
@@ -0,0 +1,32 @@
+from app.utils import redis_client as rc
+from app.utils.bm25 import puntuar
+
+
+def test_recorte_descuenta_frecuencia_documental(redis_falso, monkeypatch):
+    monkeypatch.setattr(rc, "INDICE_MAX_DOCS", 2)
+    rc.indexar_mensaje_historial("u1", "user", "factura acme enero")
+    rc.indexar_mensaje_historial("u1", "user", "factura globex febrero")
+    rc.indexar_mensaje_historial("u1", "user", "pago globex marzo")
+
+    docs, df, n = rc.obtener_indice_historial("u1")
+
+    assert [d["texto"] for d in docs] == ["factura globex febrero", "pago globex marzo"]
+    assert n == 3
+    # "acme" y "enero" sólo estaban en el documento desalojado
+    assert "acme" not in df and "enero" not in df
+    assert df == {"factura": 1, "globex": 2, "febrero": 1, "pago": 1, "marzo": 1}
+
+
+def test_df_coincide_con_los_documentos_que_quedan(redis_falso, monkeypatch):
+    monkeypatch.setattr(rc, "INDICE_MAX_DOCS", 5)
+    for n in range(20):
+        rc.indexar_mensaje_historial("u1", "assistant", f"factura F{n} cliente{n % 3}")
+
+    docs, df, _ = rc.obtener_indice_historial("u1")
+
+    esperado = {}
+    for doc in docs:
+        for termino in doc["tf"]:
+            esperado[termino] = esperado.get(termino, 0) + 1
+    assert df == esperado
+    assert puntuar("cliente1", docs, df)
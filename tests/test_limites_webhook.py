@@ -0,0 +1,90 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import FastAPI
+
+from app.routes import whatsapp_routes
+from app.utils import almacen_archivos
+
+TROZO = b"x" * 1024
+
+
+@pytest.fixture
+def app(redis_falso, monkeypatch):
+    monkeypatch.setattr(whatsapp_routes, "WEBHOOK_MAX_BYTES_TEXTO", 4 * 1024)
+    monkeypatch.setattr(whatsapp_routes, "WEBHOOK_MAX_BYTES_ARCHIVO", 8 * 1024)
+    app = FastAPI()
+    app.include_router(whatsapp_routes.router)
+    return app
+
+
+def _post(app, headers, trozos):
+    """
+    Llama al ASGI app entregando el cuerpo trozo a trozo (como chunked) y
+    devuelve (status, trozos que la app llegó a pedir).
+    """
+    pendientes = list(trozos)
+    leidos = 0
+    respuesta = {}
+
+    async def receive():
+        nonlocal leidos
+        if not pendientes:
+            return {"type": "http.disconnect"}
+        leidos += 1
+        trozo = pendientes.pop(0)
+        return {"type": "http.request", "body": trozo, "more_body": bool(pendientes)}
+
+    async def send(mensaje):
+        if mensaje["type"] == "http.response.start":
+            respuesta["status"] = mensaje["status"]
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/webhook/orquestador", "raw_path": b"/webhook/orquestador",
+        "query_string": b"", "root_path": "", "client": ("test", 1), "server": ("test", 80),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+    asyncio.run(app(scope, receive, send))
+    return respuesta["status"], leidos
+
+
+def _entrantes():
+    return set(os.listdir(almacen_archivos.ARCHIVOS_ENTRANTES_DIR))
+
+
+def test_texto_con_content_length_excedido_no_se_lee(app):
+    headers = {"X-From": "u1", "Content-Type": "text/plain", "Content-Length": str(100 * 1024)}
+    assert _post(app, headers, [TROZO] * 100) == (413, 0)
+
+
+def test_texto_chunked_sin_content_length_se_corta(app):
+    headers = {"X-From": "u1", "Content-Type": "text/plain", "Transfer-Encoding": "chunked"}
+    status, leidos = _post(app, headers, [TROZO] * 100)
+    assert status == 413
+    # Se corta en cuanto pasa de 4 KB, no al terminar el cuerpo
+    assert leidos == 5
+
+
+def test_archivo_con_content_length_excedido_no_se_escribe(app):
+    antes = _entrantes()
+    headers = {"X-From": "u1", "Content-Type": "application/pdf", "X-Filename": "f.pdf",
+               "Content-Length": str(100 * 1024)}
+    assert _post(app, headers, [TROZO] * 100) == (413, 0)
+    assert _entrantes() == antes
+
+
+def test_archivo_chunked_sin_content_length_se_corta_y_borra(app):
+    antes = _entrantes()
+    headers = {"X-From": "u1", "Content-Type": "application/pdf", "X-Filename": "f.pdf",
+               "Transfer-Encoding": "chunked"}
+    status, leidos = _post(app, headers, [TROZO] * 100)
+    assert status == 413
+    assert leidos == 9
+    assert _entrantes() == antes
+
+
+def test_content_length_invalido(app):
+    headers = {"X-From": "u1", "Content-Type": "text/plain", "Content-Length": "mucho"}
+    assert _post(app, headers, [b"hola"])[0] == 400
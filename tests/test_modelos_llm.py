@@ -0,0 +1,66 @@
+import asyncio
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import ia_service
+from app.utils import modelos_llm as ml
+
+
+@pytest.mark.parametrize("etapa, modelo, max_tokens, timeout", [
+    ("clasificar", ml.MODELO_LIGERO, 50, 10),
+    ("parametrizar:consultar_facturas", ml.MODELO_LIGERO, 150, 10),
+    ("parametrizar:crear_factura", ml.MODELO_PESADO, 2500, 60),
+    ("respuesta_final", ml.MODELO_LIGERO, 250, 20),
+    # Las funciones sin ruta propia heredan de 'default'
+    ("parametrizar:funcion_nueva", ml.MODELO_PESADO, 500, 30),
+    ("default", ml.MODELO_PESADO, 500, 30),
+])
+def test_obtener_config_etapa(etapa, modelo, max_tokens, timeout):
+    assert ml.obtener_config_etapa(etapa) == {"modelo": modelo, "max_tokens": max_tokens, "timeout": timeout}
+
+
+def test_obtener_config_etapa_devuelve_copia():
+    ml.obtener_config_etapa("clasificar")["modelo"] = "otro"
+    ml.obtener_config_etapa("parametrizar:funcion_nueva")["timeout"] = 1
+    assert ml.obtener_config_etapa("clasificar")["modelo"] == ml.MODELO_LIGERO
+    assert ml.RUTAS_MODELO["default"]["timeout"] == 30
+
+
+def test_override_por_entorno(monkeypatch):
+    monkeypatch.setenv("OPENAI_RUTAS_MODELO", '{"clasificar": {"timeout": 5}, "etapa_nueva": {"max_tokens": 7}}')
+    try:
+        importlib.reload(ml)
+        assert ml.obtener_config_etapa("clasificar") == {"modelo": ml.MODELO_LIGERO, "max_tokens": 50, "timeout": 5}
+        assert ml.obtener_config_etapa("etapa_nueva") == {"modelo": ml.MODELO_PESADO, "max_tokens": 7, "timeout": 30}
+    finally:
+        monkeypatch.delenv("OPENAI_RUTAS_MODELO")
+        importlib.reload(ml)
+
+
+def test_preguntar_a_openai_usa_la_ruta_de_la_etapa(redis_falso, monkeypatch):
+    llamadas = []
+
+    class _Completions:
+        async def create(self, **kwargs):
+            llamadas.append(kwargs)
+            mensaje = SimpleNamespace(content=" ok ")
+            return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+    class _Cliente:
+        def with_options(self, timeout):
+            llamadas.append({"timeout": timeout})
+            return SimpleNamespace(chat=SimpleNamespace(completions=_Completions()))
+
+    monkeypatch.setattr(ia_service, "client", _Cliente())
+    mensajes = [{"role": "user", "content": "hola"}]
+
+    assert asyncio.run(ia_service.preguntar_a_openai(mensajes, etapa="clasificar")) == "ok"
+    assert asyncio.run(ia_service.preguntar_a_openai(mensajes, etapa="parametrizar:crear_factura", max_tokens=99)) == "ok"
+
+    assert llamadas[0] == {"timeout": 10}
+    assert (llamadas[1]["model"], llamadas[1]["max_tokens"]) == (ml.MODELO_LIGERO, 50)
+    assert llamadas[2] == {"timeout": 60}
+    # max_tokens explícito gana sobre la tabla
+    assert (llamadas[3]["model"], llamadas[3]["max_tokens"]) == (ml.MODELO_PESADO, 99)
@@ -0,0 +1,77 @@
+import time
+import asyncio
+
+from app.services import whatsapp_service as ws
+from app.utils import redis_client as rc
+
+
+def test_efecto_y_cancelacion_se_excluyen(redis_falso):
+    rc.iniciar_turno("u1", "t1")
+    assert rc.reclamar_efecto_turno("u1", "t1")
+    assert not rc.cancelar_turno("u1", "t1")
+    assert rc.turno_con_efectos("u1", "t1")
+
+    rc.iniciar_turno("u1", "t2")
+    assert rc.cancelar_turno("u1", "t2")
+    assert not rc.reclamar_efecto_turno("u1", "t2")
+
+
+def test_turno_viejo_no_reclama_efectos_del_nuevo(redis_falso):
+    rc.iniciar_turno("u1", "t1")
+    rc.iniciar_turno("u1", "t2")
+    assert not rc.reclamar_efecto_turno("u1", "t1")
+    assert not rc.cancelar_turno("u1", "t1")
+    assert rc.reclamar_efecto_turno("u1", "t2")
+
+
+def test_hilo_de_turno_cancelado_no_envia(redis_falso, monkeypatch):
+    enviados = []
+
+    class Respuesta:
+        def raise_for_status(self):
+            pass
+
+    def post(url, data=None, headers=None):
+        enviados.append(data)
+        return Respuesta()
+
+    monkeypatch.setattr(ws.requests, "post", post)
+    monkeypatch.setattr(ws, "SUPERSESION_INTERVALO_SEGUNDOS", 0.02)
+    terminado = []
+
+    def llamada_lenta():
+        # p. ej. una llamada HTTP que sigue en su hilo después de cancelar la tarea
+        time.sleep(0.3)
+        try:
+            ws.enviar_respuesta_a_whatsapp("u1", mensaje="tarde")
+        finally:
+            terminado.append(True)
+
+    async def evento(user_id, event):
+        await asyncio.to_thread(llamada_lenta)
+
+    monkeypatch.setattr(ws, "_procesar_evento", evento)
+
+    async def correr():
+        rc.enqueue_user_message("u1", {"type": "text", "content": "mejor otra cosa"})
+        resultado = await ws._procesar_evento_cancelable("u1", {"type": "text", "content": "hola"})
+        while not terminado:
+            await asyncio.sleep(0.05)
+        return resultado
+
+    assert asyncio.run(correr()) == {"status": "superseded"}
+    assert enviados == []
+
+
+def test_turno_con_efecto_no_se_cancela(redis_falso, monkeypatch):
+    monkeypatch.setattr(ws, "SUPERSESION_INTERVALO_SEGUNDOS", 0.02)
+    monkeypatch.setattr(ws, "enviar_respuesta_a_whatsapp", lambda to, mensaje=None, **k: ws._marcar_efecto(to))
+
+    async def evento(user_id, event):
+        ws.enviar_respuesta_a_whatsapp(user_id, mensaje="listo")
+        await asyncio.sleep(0.1)
+        return {"status": "ok"}
+
+    monkeypatch.setattr(ws, "_procesar_evento", evento)
+    rc.enqueue_user_message("u1", {"type": "text", "content": "otro"})
+    assert asyncio.run(ws._procesar_evento_cancelable("u1", {"type": "text", "content": "hola"})) == {"status": "ok"}
@@ -0,0 +1,19 @@
+import pytest
+
+from app.utils import tokens
+
+
+@pytest.mark.parametrize("con_tiktoken", [True, False])
+def test_recortar_tokens_respeta_el_presupuesto(monkeypatch, con_tiktoken):
+    if not con_tiktoken:
+        monkeypatch.setattr(tokens, "_encoder", lambda modelo: None)
+    elif tokens._encoder("gpt-4o") is None:
+        pytest.skip("tiktoken no instalado")
+    texto = " ".join(f"palabra{n}" for n in range(500))
+
+    recortado = tokens.recortar_tokens(texto, 50)
+
+    assert tokens.contar_tokens(recortado) <= 50
+    assert recortado.endswith("palabra499")
+    assert tokens.recortar_tokens("corto", 50) == "corto"
+    assert tokens.recortar_tokens(texto, 0) == ""
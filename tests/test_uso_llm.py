@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import ia_service
+from app.utils.redis_client import obtener_uso_funciones, obtener_uso_usuario
+
+
+@pytest.fixture
+def respuestas(redis_falso, monkeypatch):
+    """Cliente falso: cada llamada consume la siguiente respuesta y 10+5 tokens."""
+    pendientes = []
+
+    class _Completions:
+        async def create(self, **kwargs):
+            mensaje = SimpleNamespace(content=pendientes.pop(0))
+            usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+            return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=usage)
+
+    class _Cliente:
+        def with_options(self, timeout):
+            return SimpleNamespace(chat=SimpleNamespace(completions=_Completions()))
+
+    monkeypatch.setattr(ia_service, "client", _Cliente())
+    return pendientes
+
+
+def _fecha():
+    return ia_service.datetime.now().strftime("%Y-%m-%d")
+
+
+def test_clasificar_cuenta_por_etapa_y_el_paso_por_funcion(respuestas):
+    respuestas += [
+        '{"servicio": "FACTURACION", "funcion": "consultar_facturas"}',
+        # El paso llega inválido y se repara: ambas llamadas son de consultar_facturas
+        'no es json',
+        '{"servicio": "FACTURACION", "funcion": "consultar_facturas", "params": {}}',
+    ]
+    historial = [{"role": "user", "content": "mis facturas"}]
+
+    paso = asyncio.run(ia_service.clasificar_siguiente_paso(historial, user_id="u1"))
+
+    assert paso["funcion"] == "consultar_facturas"
+    uso = obtener_uso_usuario("u1", _fecha())
+    assert uso["llamadas"] == 3 and uso["total_tokens"] == 45
+    assert uso["etapa:clasificar"] == 15
+    assert uso["etapa:parametrizar:consultar_facturas"] == 15
+    assert uso["etapa:reparar_json"] == 15
+    assert uso["funcion:consultar_facturas"] == 30
+    assert not any(k in uso for k in ("funcion:clasificar", "funcion:reparar_json"))
+    assert obtener_uso_funciones() == {"consultar_facturas": {"llamadas": 2, "total_tokens": 30}}
+
+
+def test_borrador_y_respuesta_final_se_cuentan_en_su_funcion(respuestas):
+    respuestas += ['{"set": {"PaymentForm": "03"}}', "Listo", "resumen"]
+
+    asyncio.run(ia_service.extraer_delta_borrador({}, ["PaymentForm"], "en efectivo", user_id="u1"))
+    asyncio.run(ia_service.generar_respuesta_final([{"role": "user", "content": "hola"}], user_id="u1"))
+    asyncio.run(ia_service.resumir_historial("", [{"role": "user", "content": "hola"}], user_id="u1"))
+
+    uso = obtener_uso_usuario("u1", _fecha())
+    assert uso["funcion:crear_factura"] == 15
+    assert uso["funcion:respuesta_final"] == 15
+    assert uso["etapa:resumir_historial"] == 15
+    assert set(obtener_uso_funciones()) == {"crear_factura", "respuesta_final"}